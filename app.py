@@ -1,13 +1,55 @@
-from flask import Flask, render_template_string, request, redirect, url_for, flash, session, send_from_directory
+from flask import Flask, render_template, request, redirect, url_for, flash, session, send_from_directory, send_file, jsonify, abort, g, has_request_context, before_render_template, template_rendered
+from flask.sessions import SecureCookieSessionInterface, SessionMixin
 from flask_sqlalchemy import SQLAlchemy
-from flask_socketio import SocketIO, emit
+from flask_sqlalchemy.session import Session as SessionFlask
+from flask_socketio import SocketIO, emit, join_room
+from werkzeug.datastructures import CallbackDict
 from werkzeug.utils import secure_filename
-from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.security import generate_password_hash, check_password_hash, safe_join
+from werkzeug.wsgi import wrap_file
+from werkzeug.exceptions import ClientDisconnected
+from werkzeug.middleware.proxy_fix import ProxyFix
+from sqlalchemy import event, func
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import object_session
+from sqlalchemy.exc import IntegrityError, TimeoutError as DelaiPoolDepasse
+from markupsafe import Markup
+from itsdangerous import BadSignature
 import os
+import atexit
+import bisect
+import base64
 import datetime
+import collections
+import contextlib
+import fcntl
+import hashlib
+import io
+import itertools
+import json
+import math
+import mimetypes
+import posixpath
 import random
+import re
 import secrets 
-from PIL import Image 
+import shutil
+import struct
+import subprocess
+import tempfile
+import zipfile
+import zlib
+import threading
+import sys
+import time
+import concurrent.futures
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+try:
+    import redis # Optionnel : présence et file de messages Socket.IO partagées entre workers
+except ImportError:
+    redis = None
 
 # --------------------------
 # 1. INITIALISATION ET CONFIG
@@ -39,28 +81,243 @@ else:
 app.config['SQLALCHEMY_DATABASE_URI'] = database_url
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False 
 
+# Réplica en lecture seule (optionnel) : les lectures marquées par lectures_sur_replica() y sont envoyées
+# (listes d'amis, recherches par pseudo, pages du fil), tout le reste va à la base principale.
+RAW_REPLICA_URL = os.environ.get('DATABASE_REPLICA_URL', '')
+if RAW_REPLICA_URL:
+    app.config['SQLALCHEMY_BINDS'] = {'replica': RAW_REPLICA_URL.replace('postgres://', 'postgresql://', 1)}
+
 # Dossiers d'uploads
 app.config['UPLOAD_FOLDER'] = 'uploads'
 app.config['CONVERTED_FOLDER'] = 'converted'
+# Stockage adressé par contenu (fichiers nommés par leur empreinte SHA-256), sous CONVERTED_FOLDER
+app.config['BLOB_FOLDER'] = os.path.join(app.config['CONVERTED_FOLDER'], 'blobs')
+# Miniatures : cache disque LRU borné en taille (les plus anciennes sont régénérées à la demande)
+app.config['THUMBNAIL_FOLDER'] = os.path.join(app.config['CONVERTED_FOLDER'], 'thumbs')
+app.config['THUMBNAIL_CACHE_MAX_BYTES'] = int(os.environ.get('THUMBNAIL_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+# Envoi des fichiers convertis :
+#  ''           -> par le worker Python, en zéro-copie (sendfile) sous gunicorn
+#  'x-accel'    -> en-tête X-Accel-Redirect, nginx envoie le fichier. Exemple de configuration nginx :
+#                  location /_media/ { internal; alias /chemin/vers/converted/; }
+#  'x-sendfile' -> en-tête X-Sendfile (Apache mod_xsendfile, lighttpd)
+app.config['MEDIA_SENDFILE_MODE'] = os.environ.get('MEDIA_SENDFILE_MODE', '')
+# Streaming adaptatif HLS, produit dans la même passe ffmpeg que le MP4 : "hauteur:débit" par rendition
+# (les renditions plus hautes que la source sont ignorées ; chaîne vide pour désactiver le HLS)
+app.config['HLS_FOLDER'] = os.path.join(app.config['CONVERTED_FOLDER'], 'hls')
+app.config['HLS_RENDITIONS'] = os.environ.get('HLS_RENDITIONS', '1080:5000k,720:2800k,480:1400k,360:800k')
+app.config['HLS_SEGMENT_SECONDS'] = int(os.environ.get('HLS_SEGMENT_SECONDS', 4))
+app.config['MEDIA_ACCEL_PREFIX'] = os.environ.get('MEDIA_ACCEL_PREFIX', '/_media/')
+# Stockage des fichiers servis (blobs, segments HLS) : 'local' (sous CONVERTED_FOLDER) ou 's3' (AWS S3, MinIO, Ceph...).
+# En mode s3, toutes les instances partagent les fichiers : un upload par morceaux peut passer d'une instance
+# à l'autre (multipart S3), et les téléchargements sont redirigés vers des URL présignées (les workers ne relaient
+# plus les octets). Les conversions travaillent sur des copies locales, dans BLOB_FOLDER/tmp.
+# Identifiants : chaîne habituelle de boto3 (AWS_ACCESS_KEY_ID / AWS_SECRET_ACCESS_KEY, rôle IAM...).
+# Conseillé : une règle de cycle de vie « AbortIncompleteMultipartUpload » sur le bucket.
+app.config['STORAGE_BACKEND'] = os.environ.get('STORAGE_BACKEND', 'local')
+app.config['S3_BUCKET'] = os.environ.get('S3_BUCKET')
+app.config['S3_ENDPOINT_URL'] = os.environ.get('S3_ENDPOINT_URL') # ex: http://localhost:9000 pour MinIO
+app.config['S3_REGION'] = os.environ.get('S3_REGION')
+app.config['S3_PREFIX'] = os.environ.get('S3_PREFIX', '') # ex: "site-pro-convert/" pour partager un bucket
+app.config['S3_URL_EXPIRES'] = int(os.environ.get('S3_URL_EXPIRES', 6 * 3600)) # Validité des URL présignées (secondes)
+app.config['S3_PART_SIZE'] = int(os.environ.get('S3_PART_SIZE', 16 * 1024 * 1024)) # Parties des envois multipart
 # CORRECTION DU CARACTÈRE U+00A0 (espace insécable)
 app.config['MAX_CONTENT_LENGTH'] = 100 * 1024 * 1024 # Limite d'upload à 100MB
 
-db = SQLAlchemy(app)
-# SocketIO initialisé sans app context pour permettre la configuration de gunicorn
-socketio = SocketIO(app, cors_allowed_origins="*")
+# Upload par morceaux (reprenable) : la limite de taille s'applique au fichier complet, pas à chaque requête
+app.config['UPLOAD_MAX_SIZE'] = int(os.environ.get('UPLOAD_MAX_SIZE', 2 * 1024 * 1024 * 1024))
+app.config['UPLOAD_CHUNK_MAX'] = 8 * 1024 * 1024 # Taille maximale d'un morceau
+
+# Nombre d'éléments par page du fil (vidéos, images, messages)
+app.config['FEED_PAGE_SIZE'] = int(os.environ.get('FEED_PAGE_SIZE', 24))
+# Fragments HTML du fil gardés en mémoire (nombre d'entrées par processus, 0 pour désactiver)
+app.config['FRAGMENT_CACHE_SIZE'] = int(os.environ.get('FRAGMENT_CACHE_SIZE', 512))
+app.config['UPLOAD_BUFFER_SIZE'] = 64 * 1024 # Tampon fixe utilisé pour écrire le flux sur le disque
+
+# File de conversion : nombre de workers par processus web (chacun pilote un processus ffmpeg).
+# Mettre 0 pour ne convertir que dans des processus dédiés (`python app.py worker`) : c'est ce que fait le
+# Procfile (process `web` à 0, process `worker` à part). La valeur par défaut garde un processus unique
+# (`python app.py`, image Docker) autonome.
+app.config['CONVERSION_WORKERS'] = int(os.environ.get('CONVERSION_WORKERS', 2))
+app.config['CONVERSION_MAX_ATTEMPTS'] = int(os.environ.get('CONVERSION_MAX_ATTEMPTS', 3))
+# Un job resté 'running' plus longtemps que ce délai (en secondes) est considéré comme abandonné
+app.config['CONVERSION_STALE_AFTER'] = int(os.environ.get('CONVERSION_STALE_AFTER', 3600))
+app.config['FFMPEG_PRESET'] = os.environ.get('FFMPEG_PRESET', 'veryfast')
+# Encodage parallèle des vidéos longues : découpage aux images clés, morceaux encodés par ENCODE_WORKERS
+# processus ffmpeg simultanés (partagés entre tous les jobs du processus), puis assemblage sans réencodage
+app.config['ENCODE_WORKERS'] = int(os.environ.get('ENCODE_WORKERS', os.cpu_count() or 1))
+app.config['ENCODE_PARALLEL_MIN_SECONDS'] = float(os.environ.get('ENCODE_PARALLEL_MIN_SECONDS', 120))
+app.config['ENCODE_SEGMENT_SECONDS'] = float(os.environ.get('ENCODE_SEGMENT_SECONDS', 60))
+# Sondage avant conversion : au-delà de ces limites, le fichier est refusé sans avoir été décodé
+app.config['VIDEO_MAX_PIXELS'] = int(os.environ.get('VIDEO_MAX_PIXELS', 7680 * 4320)) # 8K
+app.config['VIDEO_MAX_DURATION'] = int(os.environ.get('VIDEO_MAX_DURATION', 4 * 3600)) # secondes
+app.config['GIF_MAX_PIXELS'] = int(os.environ.get('GIF_MAX_PIXELS', Image.MAX_IMAGE_PIXELS or 89478485)) # par frame
+app.config['GIF_MAX_TOTAL_PIXELS'] = int(os.environ.get('GIF_MAX_TOTAL_PIXELS', 2 * 10**9)) # toutes frames confondues
+# Un job dont le coût estimé (mégapixels à encoder) dépasse ce seuil laisse passer les plus petits,
+# pendant au plus CONVERSION_LARGE_JOB_MAX_WAIT secondes (ensuite, il reprend sa place dans l'ordre d'arrivée)
+app.config['CONVERSION_LARGE_JOB_COST'] = float(os.environ.get('CONVERSION_LARGE_JOB_COST', 50000))
+app.config['CONVERSION_LARGE_JOB_MAX_WAIT'] = int(os.environ.get('CONVERSION_LARGE_JOB_MAX_WAIT', 600))
+
+# Moteur GIF : processus qui transforment les frames, et nombre maximal de frames décodées en mémoire
+app.config['GIF_WORKERS'] = int(os.environ.get('GIF_WORKERS', os.cpu_count() or 2))
+app.config['GIF_FRAMES_IN_FLIGHT'] = int(os.environ.get('GIF_FRAMES_IN_FLIGHT', 32))
+app.config['GIF_SPRITE_MAX_FRAMES'] = 100 # Frames échantillonnées pour une planche de sprites
+# Conversion d'images par lots (/convert_images) : nombre de fichiers et taille décompressée maximale
+app.config['BATCH_MAX_FILES'] = int(os.environ.get('BATCH_MAX_FILES', 200))
+app.config['BATCH_MAX_BYTES'] = int(os.environ.get('BATCH_MAX_BYTES', 500 * 1024 * 1024))
+app.config['IMAGE_MAX_PIXELS'] = int(os.environ.get('IMAGE_MAX_PIXELS', Image.MAX_IMAGE_PIXELS or 89478485))
+# Cycle de vie du stockage. Quotas vérifiés à la réception d'un fichier (0 = illimité) : par utilisateur
+# (vidéos et images publiées, sources en attente, uploads en cours) et pour l'ensemble du stockage
+app.config['QUOTA_USER_BYTES'] = int(os.environ.get('QUOTA_USER_BYTES', 2 * 1024 * 1024 * 1024))
+app.config['STORAGE_MAX_BYTES'] = int(os.environ.get('STORAGE_MAX_BYTES', 0))
+app.config['STORAGE_MIN_FREE_BYTES'] = int(os.environ.get('STORAGE_MIN_FREE_BYTES', 512 * 1024 * 1024)) # Espace disque gardé libre (stockage local)
+# Expiration en jours (0 = jamais) des vidéos et images publiées, et des résultats gardés par le cache de conversion
+app.config['MEDIA_TTL_DAYS'] = int(os.environ.get('MEDIA_TTL_DAYS', 0))
+app.config['CONVERSION_CACHE_TTL_DAYS'] = int(os.environ.get('CONVERSION_CACHE_TTL_DAYS', 30))
+app.config['UPLOAD_SESSION_TTL'] = int(os.environ.get('UPLOAD_SESSION_TTL', 24 * 3600)) # Upload par morceaux abandonné (secondes)
+# Balayage périodique (secondes, 0 pour désactiver) : expirations, fichiers orphelins, anciens fichiers à ranger.
+# Un fichier inconnu de la base n'est supprimé que s'il n'a pas été modifié depuis STORAGE_GRACE_SECONDS.
+app.config['SWEEP_INTERVAL'] = int(os.environ.get('SWEEP_INTERVAL', 900))
+app.config['STORAGE_GRACE_SECONDS'] = int(os.environ.get('STORAGE_GRACE_SECONDS', 3600))
+
+# Socket.IO multi-workers / multi-nœuds : file de messages partagée pour les emits
+# (ex: redis://localhost:6379/0 ; sans valeur, chaque processus ne joint que ses propres sockets)
+app.config['SOCKETIO_MESSAGE_QUEUE'] = os.environ.get('SOCKETIO_MESSAGE_QUEUE')
+# Registre de présence (user -> sockets) : Redis si une URL est donnée, sinon en mémoire du processus
+app.config['PRESENCE_URL'] = os.environ.get('PRESENCE_URL', app.config['SOCKETIO_MESSAGE_QUEUE'])
+# Préfixe du nœud (machine ou conteneur) ; le pid du processus y est ajouté à l'usage, après le fork des workers
+app.config['NODE_ID'] = os.environ.get('NODE_ID', os.uname().nodename)
+
+# Sessions côté serveur : une fois l'utilisateur connecté, le cookie signé ne contient qu'un identifiant aléatoire ;
+# les données (utilisateur, jeton CSRF, messages flash) sont dans Redis si SESSION_URL est donnée (partagées par
+# tous les workers et nœuds), sinon en mémoire du processus : un seul worker web (refusé au démarrage avec
+# WEB_CONCURRENCY > 1) et tout le monde est déconnecté à chaque redémarrage. Les visiteurs non connectés n'ont
+# rien côté serveur. SESSION_TTL : durée de vie depuis la dernière modification.
+app.config['SESSION_URL'] = os.environ.get('SESSION_URL', app.config['PRESENCE_URL'])
+app.config['SESSION_TTL'] = int(os.environ.get('SESSION_TTL', 30 * 24 * 3600))
+app.config['SESSION_MAX'] = int(os.environ.get('SESSION_MAX', 100000)) # En mémoire : sessions gardées au plus
+# Profil de l'utilisateur connecté (id, pseudo, email) en cache, dans le même magasin que les sessions : pas de
+# requête SQL pour savoir qui fait la requête. Invalidé à chaque modification de l'utilisateur ; en mémoire,
+# USER_CACHE_TTL borne le retard des autres processus.
+app.config['USER_CACHE_SIZE'] = int(os.environ.get('USER_CACHE_SIZE', 10000))
+app.config['USER_CACHE_TTL'] = int(os.environ.get('USER_CACHE_TTL', 300))
+
+# Chat : graphe d'amitiés gardé en mémoire (nombre d'utilisateurs, durée de vie d'une entrée en secondes).
+# Les ajouts faits sur ce processus sont appliqués immédiatement ; ceux des autres processus au plus tard après le TTL.
+app.config['FRIEND_CACHE_SIZE'] = int(os.environ.get('FRIEND_CACHE_SIZE', 10000))
+app.config['FRIEND_CACHE_TTL'] = int(os.environ.get('FRIEND_CACHE_TTL', 60))
+# Les messages du chat sont écrits en base par lots, au plus tard après ce délai (en secondes)
+app.config['CHAT_FLUSH_INTERVAL'] = float(os.environ.get('CHAT_FLUSH_INTERVAL', 0.2))
+# Envoi des messages : regroupés par conversation pendant CHAT_BATCH_WINDOW secondes (un événement 'chat_batch'
+# d'au plus CHAT_BATCH_MAX messages, émis une fois vers la salle de la conversation). Une connexion dont plus de
+# CHAT_SEND_QUEUE_MAX paquets attendent d'être écrits (client lent) quitte ses salles jusqu'à ce qu'elle ait rattrapé
+# son retard, puis recharge l'historique.
+app.config['CHAT_BATCH_WINDOW'] = float(os.environ.get('CHAT_BATCH_WINDOW', 0.05))
+app.config['CHAT_BATCH_MAX'] = int(os.environ.get('CHAT_BATCH_MAX', 100))
+app.config['CHAT_SEND_QUEUE_MAX'] = int(os.environ.get('CHAT_SEND_QUEUE_MAX', 500))
+# Messages affichés au chargement de la page ; les plus anciens sont chargés en remontant dans le chat
+app.config['CHAT_PAGE_SIZE'] = int(os.environ.get('CHAT_PAGE_SIZE', 30))
+
+# Instrumentation SQL : nombre et durée des requêtes de chaque requête HTTP.
+# SQL_STATS=1 ajoute les en-têtes X-SQL-Queries / Server-Timing aux réponses ;
+# au-delà de SQL_QUERY_WARN requêtes, un avertissement est toujours affiché (symptôme typique d'un N+1).
+app.config['SQL_STATS'] = os.environ.get('SQL_STATS') == '1'
+app.config['SQL_QUERY_WARN'] = int(os.environ.get('SQL_QUERY_WARN', 25))
+# Jeton (Authorization: Bearer ...) des routes de métriques ; sans jeton, ces routes répondent 404
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN', '')
+# Processus `python app.py worker` (sans serveur web) : port où exposer /metrics (0 = pas d'exposition)
+app.config['METRICS_PORT'] = int(os.environ.get('METRICS_PORT', 0))
+# Profileur par échantillonnage : PROFILING=1 permet de profiler une requête en envoyant l'en-tête
+# `X-Profile: <METRICS_TOKEN>` ; la pile est relevée toutes les PROFILE_INTERVAL secondes, et les
+# PROFILE_KEEP derniers profils restent consultables sur /metrics/profiles/<id>.
+app.config['PROFILING'] = os.environ.get('PROFILING') == '1'
+app.config['PROFILE_INTERVAL'] = float(os.environ.get('PROFILE_INTERVAL', 0.005))
+app.config['PROFILE_KEEP'] = int(os.environ.get('PROFILE_KEEP', 20))
+
+# Mots de passe : hachés dans un pool de processus borné. Changer le nombre d'itérations
+# fait re-hacher chaque mot de passe à la prochaine connexion réussie.
+app.config['PASSWORD_HASH_ITERATIONS'] = int(os.environ.get('PASSWORD_HASH_ITERATIONS', 1000000))
+app.config['PASSWORD_WORKERS'] = int(os.environ.get('PASSWORD_WORKERS', os.cpu_count() or 2))
+# Limitation des tentatives /login et /register (seau de jetons) : rafale autorisée, puis N par minute.
+# Les seaux sont propres à chaque processus : la limite réelle est multipliée par le nombre de workers web.
+app.config['LOGIN_ATTEMPTS_PER_USER'] = int(os.environ.get('LOGIN_ATTEMPTS_PER_USER', 5))
+app.config['LOGIN_ATTEMPTS_PER_IP'] = int(os.environ.get('LOGIN_ATTEMPTS_PER_IP', 20))
+# Nombre de proxys devant l'application pour lire la vraie IP dans X-Forwarded-For. 0 par défaut : exposée
+# directement, un client pourrait choisir son IP (et donc son seau) avec l'en-tête. Le Procfile et l'image
+# Docker le mettent à 1 pour le proxy de Render : sans cela, toutes les requêtes viendraient de l'IP du
+# proxy et partageraient un seul seau par IP.
+app.config['TRUSTED_PROXIES'] = int(os.environ.get('TRUSTED_PROXIES', 0))
+if app.config['TRUSTED_PROXIES']:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['TRUSTED_PROXIES'])
+
+def _mode_asynchrone_detecte():
+    """gevent ou eventlet si le worker a déjà patché la bibliothèque standard (gunicorn -k gevent/eventlet), threading sinon."""
+    if 'gevent' in sys.modules:
+        from gevent import monkey
+        if monkey.is_module_patched('socket'):
+            return 'gevent'
+    if 'eventlet' in sys.modules:
+        from eventlet import patcher
+        if patcher.is_monkey_patched('socket'):
+            return 'eventlet'
+    return 'threading'
+
+# Mode de Socket.IO : suit le worker par défaut (le simple fait qu'eventlet soit installé ne doit pas le choisir)
+app.config['SOCKETIO_ASYNC_MODE'] = os.environ.get('SOCKETIO_ASYNC_MODE') or _mode_asynchrone_detecte()
+
+if app.config['SOCKETIO_ASYNC_MODE'] in ('gevent', 'eventlet') and database_url.startswith('postgresql'):
+    # psycopg2 attend la base dans du code C : sans ce correctif, chaque requête SQL gèlerait tout le worker
+    try:
+        if app.config['SOCKETIO_ASYNC_MODE'] == 'gevent':
+            from psycogreen.gevent import patch_psycopg
+        else:
+            from psycogreen.eventlet import patch_psycopg
+        patch_psycopg()
+    except ImportError:
+        print("Attention : psycogreen n'est pas installé, les requêtes PostgreSQL bloquent le worker coopératif.")
 
-# Créer les dossiers nécessaires s'ils n'existent pas
-for folder in [app.config['UPLOAD_FOLDER'], app.config['CONVERTED_FOLDER']]:
-    if not os.path.exists(folder):
-        os.makedirs(folder)
+# Pool de connexions (par processus, et par base). Les valeurs par défaut dépendent du rôle du processus :
+# worker web (plus large en gevent, où des centaines de requêtes peuvent attendre la base en même temps)
+# ou worker de conversion (`python app.py worker`, DB_ROLE=worker). Au-delà de pool_size + max_overflow
+# connexions, une requête attend DB_POOL_TIMEOUT secondes puis reçoit une 503.
+# DB_POOL_RECYCLE : les connexions plus anciennes sont remplacées (les bases hébergées coupent les connexions inactives) ;
+# DB_POOL_PRE_PING : chaque emprunt vérifie la connexion, plutôt que d'échouer sur une connexion coupée.
+app.config['DB_ROLE'] = os.environ.get('DB_ROLE') or ('worker' if sys.argv[1:2] == ['worker'] else 'web')
+if app.config['DB_ROLE'] == 'worker':
+    _pool_defaut = (4, 4)
+elif app.config['SOCKETIO_ASYNC_MODE'] in ('gevent', 'eventlet'):
+    _pool_defaut = (20, 30)
+else:
+    _pool_defaut = (10, 20)
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'pool_pre_ping': os.environ.get('DB_POOL_PRE_PING', '1') == '1'}
+if not database_url.startswith('sqlite'):
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'].update({
+        'pool_size': int(os.environ.get('DB_POOL_SIZE', _pool_defaut[0])),
+        'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', _pool_defaut[1])),
+        'pool_timeout': float(os.environ.get('DB_POOL_TIMEOUT', 10)),
+        'pool_recycle': int(os.environ.get('DB_POOL_RECYCLE', 1800)),
+        # Réutilise d'abord les connexions les plus récentes : les autres restent inactives et sont recyclées
+        'pool_use_lifo': True,
+    })
+
+class SessionRoutage(SessionFlask):
+    """
+    Session qui envoie au réplica les SELECT exécutés dans un bloc lectures_sur_replica(). Dès que la session
+    a écrit, tout va à la base principale jusqu'à la fin de la requête (on relit ce qu'on vient d'écrire).
+    """
 
-# Listes temporaires pour le contenu (non persistants après redémarrage)
-chat_messages = []
-uploaded_videos = [] 
-uploaded_images = [] 
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None:
+            if self._flushing or getattr(clause, 'is_dml', False):
+                self.info['a_ecrit'] = True
+            elif (self.info.get('replica') and not self.info.get('a_ecrit')
+                  and getattr(clause, 'is_select', False) and 'replica' in self._db.engines):
+                return self._db.engines['replica']
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
 
-# Table pour garder la trace des utilisateurs connectés et de leur ID Socket
-user_sid_map = {} 
+db = SQLAlchemy(app, session_options={'class_': SessionRoutage})
+# SocketIO initialisé sans app context pour permettre la configuration de gunicorn
+socketio = SocketIO(app, cors_allowed_origins="*", message_queue=app.config['SOCKETIO_MESSAGE_QUEUE'],
+                    async_mode=app.config['SOCKETIO_ASYNC_MODE'])
 
 # --------------------------
 # 2. MODÈLES DE BASE DE DONNÉES
@@ -88,30 +345,153 @@ class User(db.Model):
     )
     
     def set_password(self, password):
-        self.password = generate_password_hash(password, method='pbkdf2:sha256')
+        self.password = pool_mots_de_passe().submit(generate_password_hash, password, methode_hachage()).result()
 
     def check_password(self, password):
-        return check_password_hash(self.password, password)
+        return pool_mots_de_passe().submit(check_password_hash, self.password, password).result()
+
+    def password_needs_rehash(self):
+        return self.password.split('$', 1)[0] != methode_hachage()
 
     def add_friend(self, user):
-        if not self.is_friend(user):
-            self.friends.append(user)
-            user.friends.append(self) 
+        ajouter_amities(self.id, [user.id])
 
     def is_friend(self, user):
-        with app.app_context():
-            return self.friends.filter(friends.c.friend_id == user.id).count() > 0
+        return db.session.query(
+            db.exists().where(friends.c.user_id == self.id, friends.c.friend_id == user.id)
+        ).scalar()
 
     def __repr__(self):
         return f"User('{self.username}')"
 
-# Création des tables au démarrage (s'assure que le contexte est là pour la DB)
-with app.app_context():
-    try:
-        db.create_all() 
-        print("Tables de la base de données créées/vérifiées avec succès.")
-    except Exception as e:
-        print(f"Échec de la création des tables lors du démarrage: {e}")
+class UploadSession(db.Model):
+    """Upload par morceaux en cours : `offset` est le nombre d'octets déjà écrits sur le disque."""
+    id = db.Column(db.String(32), primary_key=True, default=lambda: secrets.token_hex(16))
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    filename = db.Column(db.String(255), nullable=False)
+    title = db.Column(db.String(200))
+    kind = db.Column(db.String(10), nullable=False, default='video') # 'video' ou 'gif'
+    options = db.Column(db.Text) # Options de conversion GIF (JSON)
+    size = db.Column(db.BigInteger, nullable=False)
+    offset = db.Column(db.BigInteger, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+    # Envoi côté stockage (voir Stockage.debuter_envoi) : identifiant multipart S3 et identifiants des morceaux (JSON)
+    storage_ref = db.Column(db.String(255))
+    parts = db.Column(db.Text)
+
+class Blob(db.Model):
+    """Fichier du stockage adressé par contenu ; supprimé du disque quand `refcount` retombe à 0."""
+    digest = db.Column(db.String(64), primary_key=True) # SHA-256 hexadécimal
+    size = db.Column(db.BigInteger, nullable=False)
+    refcount = db.Column(db.Integer, nullable=False, default=1)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+
+class ConversionCache(db.Model):
+    """Résultat déjà calculé : (empreinte d'entrée, convertisseur, paramètres) -> blob de sortie."""
+    key = db.Column(db.String(64), primary_key=True)
+    output_digest = db.Column(db.String(64), db.ForeignKey('blob.digest'), nullable=False)
+    output_ext = db.Column(db.String(10), nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+
+class ConversionJob(db.Model):
+    """Job de conversion vidéo persistant (file d'attente partagée par tous les workers)."""
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    title = db.Column(db.String(200), nullable=False)
+    input_digest = db.Column(db.String(64), nullable=False) # Blob de la vidéo source
+    output_filename = db.Column(db.String(200))
+    # 'queued' -> 'running' -> 'done' | 'failed' (retour à 'queued' tant qu'il reste des tentatives)
+    status = db.Column(db.String(20), nullable=False, default='queued', index=True)
+    progress = db.Column(db.Float, nullable=False, default=0.0)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False, default=3)
+    error = db.Column(db.Text)
+    worker = db.Column(db.String(100))
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+
+    user = db.relationship('User')
+
+    def __repr__(self):
+        return f"ConversionJob({self.id}, '{self.status}')"
+
+class MediaProbe(db.Model):
+    """Résultat du sondage d'un fichier source (par empreinte : mêmes octets, même sondage)."""
+    digest = db.Column(db.String(64), primary_key=True)
+    kind = db.Column(db.String(10), nullable=False) # 'video' ou 'gif'
+    container = db.Column(db.String(20)) # Reconnu par les premiers octets (mp4, matroska, avi, gif...)
+    codec = db.Column(db.String(40))
+    width = db.Column(db.Integer)
+    height = db.Column(db.Integer)
+    duration = db.Column(db.Float) # secondes
+    frames = db.Column(db.Integer)
+    audio = db.Column(db.Boolean)
+    cost = db.Column(db.Float) # Estimation du travail : mégapixels à traiter (largeur × hauteur × frames / 10⁶)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+
+class ContentVersion(db.Model):
+    """Compteur incrémenté à chaque ajout dans un fil : sert de clé d'invalidation au cache de fragments."""
+    kind = db.Column(db.String(20), primary_key=True) # 'videos', 'images' ou 'messages'
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+# Contenu du fil : l'index (user_id, created_at) sert aux requêtes par auteur,
+# l'index (created_at, id) à la pagination par curseur du fil global.
+
+class Video(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    job_id = db.Column(db.Integer, db.ForeignKey('conversion_job.id'), index=True)
+    title = db.Column(db.String(200), nullable=False)
+    converted_filename = db.Column(db.String(200))
+    status = db.Column(db.String(20), nullable=False, default='queued') # Recopié du job de conversion
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ix_video_user_created', 'user_id', 'created_at'),
+        db.Index('ix_video_created_id', 'created_at', 'id'),
+    )
+
+    def to_dict(self, username):
+        return {
+            'id': self.id,
+            'title': self.title,
+            'job_id': self.job_id,
+            'converted_filename': self.converted_filename,
+            'hls': playlist_hls(self.converted_filename),
+            'date': self.created_at.strftime("%Y-%m-%d %H:%M"),
+            'user': username,
+            'status': STATUTS_JOB[self.status],
+        }
+
+class ConvertedImage(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    filename = db.Column(db.String(200), nullable=False)
+    format = db.Column(db.String(50), nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ix_converted_image_user_created', 'user_id', 'created_at'),
+        db.Index('ix_converted_image_created_id', 'created_at', 'id'),
+    )
+
+    def to_dict(self, username):
+        return {'id': self.id, 'filename': self.filename, 'format': self.format, 'user': username}
+
+class ChatMessage(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    text = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ix_chat_message_user_created', 'user_id', 'created_at'),
+        db.Index('ix_chat_message_created_id', 'created_at', 'id'),
+    )
+
+    def to_dict(self, username):
+        return {'id': self.id, 'user': username, 'text': self.text}
 
 
 # --------------------------
@@ -124,86 +504,11 @@ HTML_TEMPLATE = """
 <head>
     <title>YouTube Python Social</title>
     <script src="https://cdnjs.cloudflare.com/ajax/libs/socket.io/4.0.1/socket.io.js"></script>
+    <script src="https://cdn.jsdelivr.net/npm/hls.js@1/dist/hls.min.js" defer></script>
     <link href="https://fonts.googleapis.com/icon?family=Material+Icons" rel="stylesheet">
-    <style>
-        @import url('https://fonts.googleapis.com/css2?family=Roboto:wght@400;500;700&display=swap');
-        body { font-family: 'Roboto', sans-serif; margin: 0; padding: 0; background-color: #181818; color: #FFFFFF; }
-        
-        /* Header */
-        .header { background-color: #202020; padding: 10px 20px; display: flex; justify-content: space-between; align-items: center; border-bottom: 1px solid #303030; }
-        .logo { font-size: 24px; font-weight: 700; color: #FFFFFF; }
-        .logo span { color: #FF0000; margin-left: -4px; } 
-
-        /* Conteneur principal */
-        .main-layout { display: flex; max-width: 1600px; margin: 0 auto; }
-
-        /* Sidebar */
-        .sidebar { width: 280px; background-color: #282828; padding: 20px 10px; box-sizing: border-box; height: 100vh; position: sticky; top: 0; border-right: 1px solid #303030; overflow-y: auto; }
-        .sidebar h3 { color: #AAAAAA; font-size: 14px; margin-top: 20px; padding-bottom: 5px; border-bottom: 1px solid #303030; }
-        .sidebar-item { padding: 10px 15px; border-radius: 5px; cursor: pointer; display: flex; align-items: center; font-size: 14px; transition: background-color 0.2s; }
-        .sidebar-item:hover { background-color: #383838; }
-        .sidebar-item .material-icons { margin-right: 15px; font-size: 20px; color: #909090; }
-        .sidebar p strong { color: #00AFFF; font-size: 1em; }
-
-
-        /* Contenu Principal */
-        .content-area { flex-grow: 1; padding: 20px; }
-        
-        /* Grille de Vidéos */
-        .video-grid { 
-            display: grid; 
-            grid-template-columns: repeat(auto-fill, minmax(300px, 1fr)); 
-            gap: 20px; 
-            margin-top: 20px; 
-        }
-        .video-item { color: #FFFFFF; }
-        .thumbnail-placeholder { width: 100%; height: 180px; background-color: #303030; display: flex; align-items: center; justify-content: center; border-radius: 8px; margin-bottom: 10px; position: relative; overflow: hidden;}
-        .thumbnail-placeholder img { width: 100%; height: 100%; object-fit: cover; }
-        .video-details { display: flex; }
-        .video-info { margin-left: 10px; }
-        .video-info h4 { font-size: 16px; font-weight: 500; margin: 0 0 5px 0; line-height: 1.3; }
-        .video-info p { font-size: 12px; color: #AAAAAA; margin: 0; }
-        .channel-icon { width: 36px; height: 36px; background: #FF0000; border-radius: 50%; flex-shrink: 0; }
-        .video-status-download a { color: #00BFFF; font-weight: 500; text-decoration: none; }
-        .video-status-download a:hover { text-decoration: underline; }
-
-        /* Chat Box */
-        .chat-container { margin-top: 40px; padding-top: 20px; border-top: 1px solid #303030; }
-        .chat-box { height: 300px; border: 1px solid #404040; overflow-y: scroll; padding: 15px; margin-bottom: 15px; background-color: #202020; border-radius: 8px; }
-        .message { margin-bottom: 8px; }
-        .user-pseudo { font-weight: 500; color: #4CAF50; margin-right: 8px; } 
-        .message-input { display: flex; }
-        .message-input input { flex-grow: 1; margin-right: 10px; background: #303030; border: 1px solid #404040; color: #FFFFFF; padding: 10px; border-radius: 4px; }
-        .message-input button { background-color: #FF0000; color: white; border: none; padding: 10px 15px; border-radius: 4px; cursor: pointer; transition: background-color 0.2s; }
-        .message-input button:hover { background-color: #CC0000; }
-
-
-        /* Formulaires et Boutons d'Action (Sidebar) */
-        .auth-form input, .upload-form input, .friend-form input, .util-form input { width: 100%; padding: 10px; margin-bottom: 10px; border: 1px solid #404040; border-radius: 4px; background: #303030; color: #FFFFFF; box-sizing: border-box; }
-        .auth-form button, .upload-form button, .friend-form button, .util-form button { width: 100%; padding: 10px; background-color: #FF0000; color: white; border: none; border-radius: 4px; cursor: pointer; font-weight: 500; transition: background-color 0.2s; margin-top: 5px;}
-        .auth-form button:hover, .upload-form button:hover, .friend-form button:hover, .util-form button:hover { background-color: #CC0000; }
-        
-        .logout-button { background-color: #555555 !important; }
-        .logout-button:hover { background-color: #666666 !important; }
-
-        /* Messages Flash */
-        .flash { padding: 15px; margin-bottom: 20px; border-radius: 4px; font-weight: bold; }
-        .success { background-color: #4CAF50; color: white; }
-        .error { background-color: #FF5555; color: white; }
-        .info { background-color: #3498db; color: white; }
-        
-        .section-title { color: #FFFFFF; font-size: 20px; font-weight: 500; margin-top: 30px; margin-bottom: 15px; }
-
-        /* Liste des images GIF converties */
-        .image-grid { display: flex; flex-wrap: wrap; gap: 15px; margin-top: 20px; }
-        .image-item { width: 150px; text-align: center; }
-        .image-item img { width: 100%; height: 100px; object-fit: cover; border-radius: 4px; border: 1px solid #303030; }
-        .image-item a { color: #AAAAAA; text-decoration: none; font-size: 12px; }
-        .image-item a:hover { text-decoration: underline; }
-
-    </style>
+    <link href="{{ asset_url('app.css') }}" rel="stylesheet">
 </head>
-<body>
+<body data-user="{{ user_username or '' }}" data-csrf="{{ csrf_token }}">
     <div class="header">
         <div class="logo">You<span>Tube</span> (Social Python)</div>
         {% if user_username %}
@@ -226,20 +531,46 @@ HTML_TEMPLATE = """
                 
                 <h3>ACTIONS VIDÉO</h3>
                 
-                <form class="upload-form" method="POST" action="{{ url_for('upload_file') }}" enctype="multipart/form-data" style="padding: 10px 0;">
+                <form class="upload-form" id="upload-form" data-kind="video" method="POST" action="{{ url_for('upload_file') }}" enctype="multipart/form-data" style="padding: 10px 0;">
                     <input type="hidden" name="csrf_token" value="{{ csrf_token }}">
                     <input type="text" name="title" placeholder="Titre de la vidéo" required>
                     <input type="file" name="file" required>
                     <button type="submit">Uploader & Publier</button>
+                    <p class="upload-progress" style="font-size: 12px; color: #AAAAAA;"></p>
                 </form>
 
                 <h3>UTILITAIRE</h3>
-                <form class="util-form" method="POST" action="{{ url_for('convert_gif') }}" enctype="multipart/form-data" style="padding: 10px 0;">
+                <form class="util-form" id="gif-form" data-kind="gif" method="POST" action="{{ url_for('convert_gif') }}" enctype="multipart/form-data" style="padding: 10px 0;">
                     <input type="hidden" name="csrf_token" value="{{ csrf_token }}">
                     <input type="file" name="gif_file" accept=".gif" required>
-                    <button type="submit" style="background-color: #9B59B6;">Convertir GIF -> PNG</button>
+                    <select name="gif_format" style="width: 100%; padding: 10px; margin-bottom: 10px; background: #303030; color: #FFFFFF; border: 1px solid #404040; border-radius: 4px;">
+                        <option value="png">PNG (première image)</option>
+                        <option value="webp">WebP animé</option>
+                        <option value="apng">APNG</option>
+                        <option value="mp4">MP4</option>
+                        <option value="sprite">Planche de sprites</option>
+                    </select>
+                    <input type="number" name="gif_width" min="16" max="4096" placeholder="Largeur (optionnel)">
+                    <input type="number" name="gif_colors" min="2" max="256" placeholder="Couleurs max (optionnel)">
+                    <button type="submit" style="background-color: #9B59B6;">Convertir le GIF</button>
+                    <p class="upload-progress" style="font-size: 12px; color: #AAAAAA;"></p>
                 </form>
                 
+                <h3>CONVERSION PAR LOTS</h3>
+                <form class="util-form" id="batch-form" method="POST" action="{{ url_for('convert_images') }}" enctype="multipart/form-data" style="padding: 10px 0;">
+                    <input type="hidden" name="csrf_token" value="{{ csrf_token }}">
+                    <input type="file" name="files" accept="image/*,.zip" multiple required>
+                    <select name="format" style="width: 100%; padding: 10px; margin-bottom: 10px; background: #303030; color: #FFFFFF; border: 1px solid #404040; border-radius: 4px;">
+                        {% for format in formats_image %}
+                        <option value="{{ format }}">{{ format|upper }}</option>
+                        {% endfor %}
+                    </select>
+                    <input type="number" name="quality" min="1" max="100" value="85" placeholder="Qualité (1-100)">
+                    <input type="number" name="width" min="16" max="8192" placeholder="Largeur max (optionnel)">
+                    <button type="submit" style="background-color: #E67E22;">Convertir en zip</button>
+                    <p class="upload-progress" style="font-size: 12px; color: #AAAAAA;"></p>
+                </form>
+
                 <h3>GESTION AMIS</h3>
                 <form class="friend-form" method="POST" action="{{ url_for('add_friend') }}" style="padding: 10px 0;">
                     <input type="hidden" name="csrf_token" value="{{ csrf_token }}">
@@ -282,49 +613,16 @@ HTML_TEMPLATE = """
             {% if user_username %}
 
                 <h2 class="section-title">En Tendances (Vidéos Publiées)</h2>
-                <div class="video-grid">
-                    {% for video in uploaded_videos | reverse %}
-                        <div class="video-item">
-                            <div class="thumbnail-placeholder">
-                                <img src="data:image/svg+xml;charset=UTF-8,%3Csvg%20width%3D%22300%22%20height%3D%22180%22%20xmlns%3D%22http%3A%2F%2Fwww.w3.org%2F2000%2Fsvg%22%20viewBox%3D%220%200%20300%20180%22%20preserveAspectRatio%3D%22none%22%3E%3Crect%20width%3D%22300%22%20height%3D%22180%22%20fill%3D%22%23303030%22%3E%3C%2Frect%3E%3Ctext%20x%3D%2250%25%22%20y%3D%2250%25%22%20fill%3D%22%23AAAAAA%22%20font-family%3D%22sans-serif%22%20font-size%3D%2218%22%20text-anchor%3D%22middle%22%3E{{ video.title }}%3C%2Ftext%3E%3C%2Fsvg%3E" alt="Miniature">
-                            </div>
-                            <div class="video-details">
-                                <div class="channel-icon"></div>
-                                <div class="video-info">
-                                    <h4>{{ video.title }}</h4>
-                                    <p>@{{ video.user }}</p>
-                                    <p>{{ video.date }} | Statut: {{ video.status }}</p>
-                                    {% if video.status == 'Converti (Simulé)' %}
-                                        <div class="video-status-download">
-                                            <a href="{{ url_for('download_file', filename=video.converted_filename) }}" download>Télécharger</a>
-                                        </div>
-                                    {% endif %}
-                                </div>
-                            </div>
-                        </div>
-                    {% endfor %}
-                    {% if not uploaded_videos %}
-                        <p style="font-size: small; color: #AAAAAA;">Aucune vidéo publiée. Utilisez le menu latéral pour uploader votre propre vidéo.</p>
-                    {% endif %}
-                </div>
+                {{ fragments.videos }}
                 
                 <h2 class="section-title" style="margin-top: 50px;">🖼️ Conversions GIF récentes</h2>
-                <div class="image-grid">
-                    {% for img in uploaded_images | reverse %}
-                        <div class="image-item">
-                            <img src="{{ url_for('download_converted_image', filename=img.filename) }}" alt="Image convertie">
-                            <a href="{{ url_for('download_converted_image', filename=img.filename) }}" download>Télécharger {{ img.format }}</a>
-                        </div>
-                    {% endfor %}
-                </div>
+                {{ fragments.images }}
                 
                 <div class="chat-container">
                     <h2 class="section-title">💬 Messagerie Privée (Amis uniquement)</h2>
                     <p style="font-size: small; color: #AAAAAA; margin-bottom: 10px;">Amis : {% for friend_name in friend_names %}@{{ friend_name }}{% if not loop.last %}, {% endif %}{% endfor %}</p>
                     <div class="chat-box" id="messages">
-                        {% for msg in chat_messages %}
-                            <div class="message"><span class="user-pseudo">@{{ msg.user }}</span>: {{ msg.text }}</div>
-                        {% endfor %}
+                        {{ fragments.chat }}
                     </div>
                     <div class="message-input">
                         <input type="text" id="message_input" placeholder="Envoyer un message à vos amis...">
@@ -332,55 +630,7 @@ HTML_TEMPLATE = """
                     </div>
                 </div>
 
-                <script>
-                    var socket = io();
-                    var user_username = "{{ user_username }}";
-
-                    // --- Réception de messages ---
-                    socket.on('broadcast_message', function(data) {
-                        var messagesDiv = document.getElementById('messages');
-                        var div = document.createElement('div');
-                        div.className = 'message';
-                                        
-                        if (data.user === 'Système') {
-                            div.innerHTML = '<span style="font-weight: 700; color: #FF0000;">[' + data.user + ']</span>: ' + data.text;
-                        } else {
-                            div.innerHTML = '<span class="user-pseudo">@' + data.user + '</span>: ' + data.text;
-                        }
-                        
-                        messagesDiv.appendChild(div);
-                        messagesDiv.scrollTop = messagesDiv.scrollHeight;
-                    });
-
-                    // --- Envoi de messages ---
-                    function sendMessage() {
-                        var input = document.getElementById('message_input');
-                        var content = input.value;
-
-                        if (content && user_username) {
-                            socket.emit('new_message', {
-                                user: user_username,
-                                text: content
-                            });
-                            input.value = '';
-                        }
-                    }
-
-                    // Envoyer avec la touche Entrée
-                    document.getElementById('message_input').addEventListener('keypress', function(e) {
-                        if (e.key === 'Enter') {
-                            sendMessage();
-                        }
-                    });
-
-                    // Scroll au bas au chargement
-                    document.addEventListener('DOMContentLoaded', (event) => {
-                        var messagesDiv = document.getElementById('messages');
-                        if (messagesDiv) {
-                            messagesDiv.scrollTop = messagesDiv.scrollHeight;
-                        }
-                    });
-                </script>
+                <script src="{{ asset_url('app.js') }}" defer></script>
 
             {% else %}
                 <h1 style="text-align: center; color: #FFFFFF; margin-top: 50px;">Bienvenue sur YouTube Social Python!</h1>
@@ -392,6 +642,73 @@ HTML_TEMPLATE = """
 </html>
 """
 
+
+# Fragments du fil, rendus séparément pour pouvoir être mis en cache (voir rendre_fragment)
+FRAGMENT_VIDEOS = """
+<div class="video-grid">
+    {% for video in videos %}
+        <div class="video-item">
+            <div class="thumbnail-placeholder">
+                {% if video.hls %}
+                <video class="lecteur-hls" controls preload="none" playsinline
+                       poster="{{ url_for('thumbnail', filename=video.converted_filename, taille='l') }}"
+                       data-hls="{{ url_for('hls', digest=video.converted_filename.split('.')[0], fichier='master.m3u8') }}"
+                       data-mp4="{{ url_for('download_converted_image', filename=video.converted_filename) }}"></video>
+                {% elif video.converted_filename %}
+                <img src="{{ url_for('thumbnail', filename=video.converted_filename, taille='m') }}" srcset="{{ url_for('thumbnail', filename=video.converted_filename, taille='l') }} 2x" alt="Miniature" loading="lazy">
+                {% else %}
+                <img id="job-thumb-{{ video.job_id }}" src="data:image/svg+xml;charset=UTF-8,%3Csvg%20width%3D%22300%22%20height%3D%22180%22%20xmlns%3D%22http%3A%2F%2Fwww.w3.org%2F2000%2Fsvg%22%20viewBox%3D%220%200%20300%20180%22%20preserveAspectRatio%3D%22none%22%3E%3Crect%20width%3D%22300%22%20height%3D%22180%22%20fill%3D%22%23303030%22%3E%3C%2Frect%3E%3Ctext%20x%3D%2250%25%22%20y%3D%2250%25%22%20fill%3D%22%23AAAAAA%22%20font-family%3D%22sans-serif%22%20font-size%3D%2218%22%20text-anchor%3D%22middle%22%3E{{ video.title }}%3C%2Ftext%3E%3C%2Fsvg%3E" alt="Miniature">
+                {% endif %}
+            </div>
+            <div class="video-details">
+                <div class="channel-icon"></div>
+                <div class="video-info">
+                    <h4>{{ video.title }}</h4>
+                    <p>@{{ video.user }}</p>
+                    <p>{{ video.date }} | Statut: <span id="job-status-{{ video.job_id }}">{{ video.status }}</span></p>
+                    <div class="video-status-download" id="job-download-{{ video.job_id }}">
+                        {% if video.converted_filename %}
+                            <a href="{{ url_for('download_file', filename=video.converted_filename) }}" download>Télécharger</a>
+                        {% endif %}
+                    </div>
+                </div>
+            </div>
+        </div>
+    {% endfor %}
+    {% if not videos %}
+        <p style="font-size: small; color: #AAAAAA;">Aucune vidéo publiée. Utilisez le menu latéral pour uploader votre propre vidéo.</p>
+    {% endif %}
+</div>
+{% if next_cursor %}
+    <p class="video-status-download"><a href="{{ url_for('index', videos=next_cursor) }}">Vidéos plus anciennes →</a></p>
+{% endif %}
+"""
+
+FRAGMENT_IMAGES = """
+<div class="image-grid">
+    {% for img in images %}
+        <div class="image-item">
+            <a href="{{ url_for('download_converted_image', filename=img.filename) }}" target="_blank">
+                <img src="{{ url_for('thumbnail', filename=img.filename, taille='s') }}" srcset="{{ url_for('thumbnail', filename=img.filename, taille='m') }} 2x" alt="Image convertie" loading="lazy">
+            </a>
+            <a href="{{ url_for('download_converted_image', filename=img.filename) }}" download>Télécharger {{ img.format }}</a>
+        </div>
+    {% endfor %}
+</div>
+{% if next_cursor %}
+    <p class="video-status-download"><a href="{{ url_for('index', images=next_cursor) }}">Images plus anciennes →</a></p>
+{% endif %}
+"""
+
+FRAGMENT_CHAT = """
+{% if next_cursor %}
+    <button type="button" class="chat-plus-anciens" data-cursor="{{ next_cursor }}">Messages plus anciens</button>
+{% endif %}
+{% for msg in chat_messages %}
+    <div class="message"><span class="user-pseudo">@{{ msg.user }}</span>: {{ msg.text }}</div>
+{% endfor %}
+"""
+
 # --------------------------
 # 4. FONCTIONS UTILITAIRES ET DE SÉCURITÉ
 # --------------------------
@@ -400,331 +717,4019 @@ def generate_unique_filename(extension):
     """Génère un nom de fichier unique."""
     return f"{datetime.datetime.now().strftime('%Y%m%d%H%M%S')}_{random.randint(1000, 9999)}.{extension}"
 
-def convert_to_mp4(input_path, output_dir):
-    """Fonction de conversion DE-ACTIVÉE / SIMULÉE."""
-    # SIMULATION: Crée un fichier placeholder pour démontrer le workflow sans utiliser FFmpeg.
-    print("ATTENTION: La conversion FFmpeg est désactivée. Retourne un fichier de test.")
-    
-    simulated_filename = "simulated_video_" + generate_unique_filename("mp4")
-    try:
-        # Crée un petit fichier vide/placeholder dans le répertoire "converted"
-        with open(os.path.join(output_dir, simulated_filename), 'w') as f:
-            f.write(f"Ceci est un fichier vidéo simulé converti à partir de {os.path.basename(input_path)}.")
-    except Exception as e:
-        print(f"Erreur lors de la création du fichier simulé: {e}")
-        return None
-    finally:
-        # Tente de supprimer le fichier original téléchargé après la simulation
-        if os.path.exists(input_path):
-             os.remove(input_path) 
-        
-    return simulated_filename
+def hors_boucle(fonction, *args):
+    """
+    Appel bloquant sans E/S réseau (Pillow, hachage d'un fichier local). Avec un worker coopératif
+    (gevent/eventlet), il s'exécute sur un vrai thread du système pour ne pas geler les autres connexions
+    du worker ; appel direct en mode threading. `fonction` ne doit utiliser ni la base ni Socket.IO.
+    """
+    if socketio.async_mode == 'gevent':
+        import gevent
+        return gevent.get_hub().threadpool.apply(fonction, args)
+    if socketio.async_mode == 'eventlet':
+        from eventlet import tpool
+        return tpool.execute(fonction, *args)
+    return fonction(*args)
 
-def check_csrf_token(request):
-    """Vérifie si le jeton CSRF est valide (sécurité anti-bot)."""
-    return request.form.get('csrf_token') == session.get('csrf_token')
+class ExecuteurHorsBoucle:
+    """
+    Remplace un ProcessPoolExecutor sous gevent/eventlet : les threads internes de celui-ci (alimentation de
+    la file des tâches) y deviennent des green threads, et leur écriture bloquante dans un tube plein gèle
+    tout le worker. Ici chaque tâche s'exécute sur un vrai thread (hors_boucle), au plus `max_workers` à la
+    fois, et ses futures s'attendent sans bloquer les autres connexions.
+    """
 
+    def __init__(self, max_workers):
+        self._places = threading.BoundedSemaphore(max_workers)
 
-# --------------------------
-# 5. ROUTES FLASK
-# --------------------------
+    def submit(self, fonction, *args):
+        future = concurrent.futures.Future()
 
-@app.route('/', methods=['GET'])
-def index():
-    # 🍪 1. Gestion du Jeton CSRF
-    if 'csrf_token' not in session:
-        session['csrf_token'] = secrets.token_hex(16)
-        
-    current_username = session.get('user_username')
-    friend_names = []
-    
-    if current_username:
-        with app.app_context():
-            current_user = User.query.filter_by(username=current_username).first()
-            if current_user:
-                # Récupère la liste des amis pour l'affichage
-                friend_names = [f.username for f in current_user.friends.all()]
-
-    return render_template_string(
-        HTML_TEMPLATE,
-        user_username=current_username,
-        chat_messages=chat_messages,
-        uploaded_videos=uploaded_videos,
-        uploaded_images=uploaded_images,
-        friend_names=friend_names,
-        csrf_token=session['csrf_token'] 
-    )
+        def executer():
+            with self._places:
+                if not future.set_running_or_notify_cancel():
+                    return
+                try:
+                    future.set_result(hors_boucle(fonction, *args))
+                except BaseException as e:
+                    future.set_exception(e)
 
-@app.route('/register', methods=['POST'])
-def register():
-    # 🔒 2. Vérification du jeton CSRF
-    if not check_csrf_token(request):
-        flash('Erreur de sécurité: Jeton invalide. Veuillez réessayer.', 'error')
-        return redirect(url_for('index'))
-        
-    email = request.form['email']
-    username = request.form['username']
-    password = request.form['password']
+        socketio.start_background_task(executer)
+        return future
 
-    with app.app_context():
-        if User.query.filter_by(email=email).first():
-            flash('Cet email est déjà enregistré.', 'error')
-            return redirect(url_for('index'))
-        
-        if User.query.filter_by(username=username).first():
-            flash('Ce pseudo est déjà utilisé.', 'error')
-            return redirect(url_for('index'))
+    def shutdown(self, wait=True):
+        pass
 
-        new_user = User(email=email, username=username)
-        new_user.set_password(password)
-        
-        db.session.add(new_user)
-        db.session.commit()
-        
-        session['user_username'] = username
-        flash(f'Compte créé et connexion réussie pour @{username}!', 'success')
-        return redirect(url_for('index'))
+class ErreurConversion(Exception):
+    """Levée quand ffmpeg échoue (le message contient la fin de sa sortie d'erreur)."""
 
-@app.route('/login', methods=['POST'])
-def login():
-    # 🔒 2. Vérification du jeton CSRF
-    if not check_csrf_token(request):
-        flash('Erreur de sécurité: Jeton invalide. Veuillez réessayer.', 'error')
-        return redirect(url_for('index'))
-        
-    username = request.form['username']
-    password = request.form['password']
+class FichierRefuse(ValueError):
+    """Levée par le sondage quand un fichier n'est pas un média attendu ou dépasse les limites."""
 
-    with app.app_context():
-        user = User.query.filter_by(username=username).first()
 
-        if user and user.check_password(password):
-            session['user_username'] = username
-            flash(f'Connexion réussie pour @{username}!', 'success')
-        else:
-            flash('Pseudo ou mot de passe incorrect.', 'error')
-            
-        return redirect(url_for('index'))
+def _sonder_avec_ffmpeg(input_path):
+    """Repli sans ffprobe : lit l'en-tête que `ffmpeg -i` affiche sur stderr."""
+    sortie = subprocess.run(['ffmpeg', '-nostdin', '-hide_banner', '-i', input_path],
+                            capture_output=True, text=True, timeout=30).stderr
+    duree = re.search(r'Duration: (\d+):(\d+):(\d+(?:\.\d+)?)', sortie)
+    video = re.search(r'Stream #.*: Video: (\w+).*?, (\d+)x(\d+)', sortie)
+    fps = re.search(r'Stream #.*: Video: .*?, (\d+(?:\.\d+)?) fps', sortie)
+    return {
+        'duree': int(duree[1]) * 3600 + int(duree[2]) * 60 + float(duree[3]) if duree else None,
+        'largeur': int(video[2]) if video else None,
+        'hauteur': int(video[3]) if video else None,
+        'codec': video[1] if video else None,
+        'fps': float(fps[1]) if fps else None,
+        'frames': None,
+        'audio': re.search(r'Stream #.*: Audio: ', sortie) is not None,
+    }
 
-@app.route('/logout', methods=['POST'])
-def logout():
-    # 🔒 2. Vérification du jeton CSRF
-    if not check_csrf_token(request):
-        flash('Erreur de sécurité: Jeton invalide. Veuillez réessayer.', 'error')
-        return redirect(url_for('index'))
-        
-    session.pop('user_username', None)
-    flash('Vous êtes déconnecté.', 'success')
-    return redirect(url_for('index'))
+def sonder_video(input_path):
+    """
+    Durée (secondes), dimensions, codec, images par seconde, nombre d'images et présence d'une piste audio :
+    {'duree', 'largeur', 'hauteur', 'codec', 'fps', 'frames', 'audio'}, les valeurs inconnues valant None.
+    Seuls les en-têtes sont lus : rien n'est décodé.
+    """
+    try:
+        resultat = subprocess.run(
+            ['ffprobe', '-v', 'error', '-show_entries',
+             'format=duration:stream=codec_type,codec_name,width,height,avg_frame_rate,nb_frames',
+             '-of', 'json', input_path],
+            capture_output=True, text=True, timeout=30
+        )
+        donnees = json.loads(resultat.stdout or '{}')
+    except FileNotFoundError:
+        try:
+            return _sonder_avec_ffmpeg(input_path)
+        except (OSError, subprocess.TimeoutExpired):
+            return dict.fromkeys(('duree', 'largeur', 'hauteur', 'codec', 'fps', 'frames', 'audio'))
+    except (OSError, ValueError, subprocess.TimeoutExpired):
+        donnees = {}
 
-@app.route('/upload', methods=['POST'])
-def upload_file():
-    # 🔒 2. Vérification du jeton CSRF
-    if not check_csrf_token(request):
-        flash('Erreur de sécurité: Jeton invalide. Veuillez réessayer.', 'error')
-        return redirect(url_for('index'))
+    flux = donnees.get('streams', [])
+    video = next((f for f in flux if f.get('codec_type') == 'video'), {})
+    try:
+        duree = float(donnees['format']['duration'])
+    except (KeyError, TypeError, ValueError):
+        duree = None
+    try:
+        numerateur, _, denominateur = video.get('avg_frame_rate', '').partition('/')
+        fps = float(numerateur) / float(denominateur or 1) or None
+    except (ValueError, ZeroDivisionError):
+        fps = None
+    return {
+        'duree': duree,
+        'largeur': video.get('width'),
+        'hauteur': video.get('height'),
+        'codec': video.get('codec_name'),
+        'fps': fps,
+        'frames': int(video['nb_frames']) if str(video.get('nb_frames', '')).isdigit() else None,
+        'audio': any(f.get('codec_type') == 'audio' for f in flux) if flux else None,
+    }
 
-    if 'user_username' not in session:
-        flash('Veuillez vous connecter pour publier du contenu.', 'error')
-        return redirect(url_for('index'))
+def sonder_duree(input_path):
+    """Retourne la durée du média en secondes (None si inconnue)."""
+    return sonder_video(input_path)['duree']
 
-    if 'file' not in request.files:
-        flash('Aucun fichier sélectionné.', 'error')
-        return redirect(url_for('index'))
+# --- Stockage des fichiers : disque local ou service compatible S3, derrière la même interface ---
 
-    file = request.files['file']
-    title = request.form.get('title', 'Vidéo sans titre')
+class Stockage:
+    """
+    Fichiers servis (blobs, segments HLS) désignés par une clé relative ('blobs/ab/<empreinte>').
+    Les conversions travaillent toujours sur des fichiers locaux : `fichier_local` fournit un chemin lisible
+    par ffmpeg/Pillow, `importer` range un résultat produit dans l'espace de travail.
+    Les uploads par morceaux passent par `debuter_envoi` / `ecrire_partie` / `terminer_envoi`
+    (`ref` : identifiant de l'envoi côté stockage, à conserver dans la session d'upload).
+    """
+    url_directes = False # True : les téléchargements sont redirigés vers url_signee()
+    taille_min_partie = 0 # Taille minimale des morceaux (sauf le dernier)
 
-    if file.filename == '':
-        flash('Nom de fichier invalide.', 'error')
-        return redirect(url_for('index'))
+    def chemin(self, cle):
+        """Chemin local du fichier (None si le stockage n'est pas un disque local)."""
+        return None
 
-    if file:
-        # Sécurisation du nom de fichier pour éviter les attaques de chemin
-        filename = secure_filename(file.filename)
-        file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        
-        try:
-            # Sauvegarde du fichier temporairement dans /uploads
-            file.save(file_path)
-            
-            # --- CONVERSION (SIMULÉE) ---
-            converted_filename = convert_to_mp4(file_path, app.config['CONVERTED_FOLDER'])
-            
-            if converted_filename:
-                uploaded_videos.append({
-                    'title': title,
-                    'converted_filename': converted_filename,
-                    'date': datetime.datetime.now().strftime("%Y-%m-%d %H:%M"),
-                    'user': session['user_username'],
-                    'status': 'Converti (Simulé)'
-                })
-                flash(f'"{title}" a été simulé et publié !', 'success')
-            else:
-                flash(f'Échec de la simulation de conversion.', 'error')
+    def existe(self, cle):
+        raise NotImplementedError
 
-        except Exception as e:
-            flash(f"Erreur lors de l'enregistrement ou la simulation: {e}", 'error')
+    def ouvrir(self, cle):
+        """Flux binaire en lecture (FileNotFoundError si la clé n'existe pas)."""
+        raise NotImplementedError
 
-        return redirect(url_for('index'))
-    
-    flash('Erreur lors de l\'upload du fichier.', 'error')
-    return redirect(url_for('index'))
+    def importer(self, cle, chemin):
+        """Range le fichier local `chemin` sous `cle` ; le fichier local est consommé."""
+        raise NotImplementedError
 
+    def importer_dossier(self, prefixe, dossier):
+        """Range tout un dossier local sous `prefixe` (le dossier est consommé)."""
+        raise NotImplementedError
 
-@app.route('/convert_gif', methods=['POST'])
-def convert_gif():
-    # 🔒 2. Vérification du jeton CSRF
-    if not check_csrf_token(request):
-        flash('Erreur de sécurité: Jeton invalide. Veuillez réessayer.', 'error')
-        return redirect(url_for('index'))
+    def deplacer(self, source, destination):
+        raise NotImplementedError
 
-    if 'user_username' not in session:
-        flash('Veuillez vous connecter pour utiliser le convertisseur.', 'error')
-        return redirect(url_for('index'))
+    def fichier_local(self, cle):
+        """Gestionnaire de contexte : chemin local du contenu de `cle`, valable pendant le bloc."""
+        raise NotImplementedError
 
-    if 'gif_file' not in request.files:
-        flash('Aucun fichier GIF sélectionné.', 'error')
-        return redirect(url_for('index'))
+    def source_ffmpeg(self, cle):
+        """Comme fichier_local, mais ffmpeg peut aussi lire une URL (il ne lit alors que ce dont il a besoin)."""
+        return self.fichier_local(cle)
 
-    file = request.files['gif_file']
-    if not file.filename or not file.filename.lower().endswith('.gif'):
-        flash("Seuls les fichiers GIF sont supportés.", 'error')
-        return redirect(url_for('index'))
+    def supprimer(self, cle):
+        raise NotImplementedError
 
-    try:
-        # Enregistrer le fichier GIF temporairement
-        gif_filename = secure_filename(file.filename)
-        gif_path = os.path.join(app.config['UPLOAD_FOLDER'], gif_filename)
-        file.save(gif_path)
+    def supprimer_prefixe(self, prefixe):
+        raise NotImplementedError
 
-        # --- CONVERSION AVEC PILLOW (Légère) ---
-        output_filename = generate_unique_filename("png")
-        output_path = os.path.join(app.config['CONVERTED_FOLDER'], output_filename)
-        
-        img = Image.open(gif_path)
-        img.seek(0) # Prend la première image du GIF (car un GIF est une séquence d'images)
-        img.save(output_path, 'PNG')
-        
-        # Suppression du GIF original temporaire
-        os.remove(gif_path) 
-        
-        uploaded_images.append({
-            'filename': output_filename,
-            'format': 'PNG',
-            'user': session['user_username']
-        })
-        flash(f'Conversion GIF -> PNG réussie! Téléchargez l\'image.', 'success')
+    def lister(self, prefixe):
+        """Itère sur (clé, date de modification en timestamp) des fichiers sous `prefixe`, par clé croissante."""
+        raise NotImplementedError
 
-    except Exception as e:
-        flash(f"Erreur de conversion GIF : {e}", 'error')
+    def url_signee(self, cle, nom=None, mimetype=None):
+        """URL de téléchargement direct, ou None si les fichiers doivent être servis par l'application."""
+        return None
 
-    return redirect(url_for('index'))
+    def espace_libre(self):
+        """Octets encore disponibles, ou None si le stockage n'a pas de limite connue (bucket S3)."""
+        return None
 
+    def debuter_envoi(self, envoi_id):
+        raise NotImplementedError
 
-@app.route('/download/<filename>')
-def download_file(filename):
-    """Permet de télécharger les fichiers convertis (vidéos simulées)."""
-    return send_from_directory(app.config['CONVERTED_FOLDER'], filename, as_attachment=True)
+    def ecrire_partie(self, envoi_id, ref, numero, offset, flux):
+        """Écrit le morceau n° `numero` (à partir de 1), qui commence à `offset` ; retourne son identifiant."""
+        raise NotImplementedError
 
-@app.route('/converted_images/<filename>')
-def download_converted_image(filename):
-    """Affiche les images converties (GIF)."""
-    return send_from_directory(app.config['CONVERTED_FOLDER'], filename)
+    def terminer_envoi(self, envoi_id, ref, parties):
+        """Assemble les morceaux ; retourne la clé du fichier complet ('envois/<id>')."""
+        raise NotImplementedError
 
+    def annuler_envoi(self, envoi_id, ref):
+        raise NotImplementedError
 
-@app.route('/add_friend', methods=['POST'])
-def add_friend():
-    # 🔒 2. Vérification du jeton CSRF
-    if not check_csrf_token(request):
-        flash('Erreur de sécurité: Jeton invalide. Veuillez réessayer.', 'error')
-        return redirect(url_for('index'))
-        
-    if 'user_username' not in session:
-        flash('Veuillez vous connecter pour ajouter des amis.', 'error')
-        return redirect(url_for('index'))
-    
-    friend_username = request.form['friend_username']
-    current_username = session['user_username']
+class StockageLocal(Stockage):
+    """Fichiers sous `racine` ; les uploads par morceaux sont écrits à leur offset dans `dossier_envois`/<id>.part."""
 
-    if friend_username == current_username:
-        flash("Vous ne pouvez pas vous ajouter vous-même.", 'error')
-        return redirect(url_for('index'))
-    
-    with app.app_context():
-        current_user = User.query.filter_by(username=current_username).first()
-        friend_user = User.query.filter_by(username=friend_username).first()
+    def __init__(self, racine, dossier_envois):
+        self.racine = racine
+        self.dossier_envois = dossier_envois
 
-        if not friend_user:
-            flash(f"Le pseudo @{friend_username} n'existe pas.", 'error')
-        elif current_user.is_friend(friend_user):
-            flash(f"@{friend_username} est déjà dans votre liste d'amis.", 'info')
-        else:
-            current_user.add_friend(friend_user)
-            db.session.commit()
-            flash(f"@{friend_username} a été ajouté à vos amis!", 'success')
-            
-    return redirect(url_for('index'))
+    def chemin(self, cle):
+        return os.path.join(self.racine, *cle.split('/'))
 
+    def existe(self, cle):
+        return os.path.exists(self.chemin(cle))
 
-# --------------------------
-# 6. SOCKETIO (CHAT PRIVÉ)
-# --------------------------
+    def ouvrir(self, cle):
+        return open(self.chemin(cle), 'rb')
 
-@socketio.on('connect')
-def handle_connect():
-    current_username = session.get('user_username')
-    if current_username:
-        with app.app_context():
-            user = User.query.filter_by(username=current_username).first()
-            if user:
-                # Stocke l'ID du socket pour l'envoi de messages privés
-                user_sid_map[user.id] = request.sid
-                print(f"User @{current_username} connected with SID: {request.sid}")
+    def importer(self, cle, chemin):
+        destination = self.chemin(cle)
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        os.replace(chemin, destination)
 
-@socketio.on('disconnect')
-def handle_disconnect():
-    current_username = session.get('user_username')
-    if current_username:
-        with app.app_context():
-            user = User.query.filter_by(username=current_username).first()
-            # Supprime l'utilisateur de la map s'il est déconnecté
-            if user and user.id in user_sid_map and user_sid_map[user.id] == request.sid:
-                del user_sid_map[user.id]
-                print(f"User @{current_username} disconnected.")
+    def importer_dossier(self, prefixe, dossier):
+        destination = self.chemin(prefixe)
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        shutil.rmtree(destination, ignore_errors=True)
+        os.replace(dossier, destination)
 
+    def deplacer(self, source, destination):
+        self.importer(destination, self.chemin(source))
 
-@socketio.on('new_message')
-def handle_new_message(data):
+    @contextlib.contextmanager
+    def fichier_local(self, cle):
+        chemin = self.chemin(cle)
+        if not os.path.exists(chemin):
+            raise FileNotFoundError(cle)
+        yield chemin
+
+    def supprimer(self, cle):
+        chemin = self.chemin(cle)
+        try:
+            os.remove(chemin)
+            os.rmdir(os.path.dirname(chemin)) # Sous-dossier de répartition devenu vide
+        except OSError:
+            pass
+
+    def supprimer_prefixe(self, prefixe):
+        shutil.rmtree(self.chemin(prefixe), ignore_errors=True)
+
+    def espace_libre(self):
+        return shutil.disk_usage(self.racine).free
+
+    def lister(self, prefixe):
+        for dossier, sous_dossiers, fichiers in os.walk(self.chemin(prefixe.rstrip('/'))):
+            sous_dossiers.sort()
+            for nom in sorted(fichiers):
+                chemin = os.path.join(dossier, nom)
+                try:
+                    mtime = os.stat(chemin).st_mtime
+                except FileNotFoundError:
+                    continue
+                yield os.path.relpath(chemin, self.racine).replace(os.sep, '/'), mtime
+
+    def _partiel(self, envoi_id):
+        return os.path.join(self.dossier_envois, f"{envoi_id}.part")
+
+    def debuter_envoi(self, envoi_id):
+        # Fichier partiel créé vide : les morceaux y sont écrits directement à leur offset
+        open(self._partiel(envoi_id), 'wb').close()
+        return None
+
+    def ecrire_partie(self, envoi_id, ref, numero, offset, flux):
+        with open(self._partiel(envoi_id), 'r+b') as f:
+            f.seek(offset)
+            f.truncate()
+            shutil.copyfileobj(flux, f, app.config['UPLOAD_BUFFER_SIZE'])
+        return None
+
+    def terminer_envoi(self, envoi_id, ref, parties):
+        cle = f"envois/{envoi_id}"
+        self.importer(cle, self._partiel(envoi_id))
+        return cle
+
+    def annuler_envoi(self, envoi_id, ref):
+        try:
+            os.remove(self._partiel(envoi_id))
+        except FileNotFoundError:
+            pass
+
+class StockageS3(Stockage):
+    """
+    Bucket S3 (ou compatible : MinIO, Ceph, R2...). Les gros fichiers sont envoyés en multipart, les uploads
+    par morceaux deviennent des envois multipart (une partie par morceau) et les lectures des clients
+    passent par des URL présignées.
+    """
+    url_directes = True
+    taille_min_partie = 5 * 1024 * 1024 # Minimum imposé par S3 pour toutes les parties sauf la dernière
+
+    def __init__(self, bucket, prefixe='', endpoint_url=None, region=None, duree_url=3600, taille_partie=16 * 1024 * 1024):
+        try:
+            # Importé seulement ici : boto3 coûte plus de 100 ms au démarrage de chaque worker
+            import boto3
+            from boto3.s3.transfer import TransferConfig
+            from botocore.config import Config as ConfigBotocore
+        except ImportError:
+            raise RuntimeError("STORAGE_BACKEND=s3 nécessite le paquet boto3.")
+        if not bucket:
+            raise RuntimeError("STORAGE_BACKEND=s3 nécessite S3_BUCKET.")
+        self.bucket = bucket
+        self.prefixe = prefixe
+        self.duree_url = duree_url
+        # Adressage par chemin pour les services auto-hébergés (MinIO...), sans DNS par bucket
+        self.client = boto3.client('s3', endpoint_url=endpoint_url, region_name=region, config=ConfigBotocore(
+            signature_version='s3v4', s3={'addressing_style': 'path' if endpoint_url else 'auto'}))
+        self.transfert = TransferConfig(multipart_threshold=taille_partie, multipart_chunksize=taille_partie)
+
+    def _cle(self, cle):
+        return self.prefixe + cle
+
+    @staticmethod
+    def _absent(erreur):
+        return erreur.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound')
+
+    def existe(self, cle):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self._cle(cle))
+            return True
+        except self.client.exceptions.ClientError as e:
+            if self._absent(e):
+                return False
+            raise
+
+    def ouvrir(self, cle):
+        try:
+            return self.client.get_object(Bucket=self.bucket, Key=self._cle(cle))['Body']
+        except self.client.exceptions.ClientError as e:
+            if self._absent(e):
+                raise FileNotFoundError(cle)
+            raise
+
+    def importer(self, cle, chemin):
+        self.client.upload_file(chemin, self.bucket, self._cle(cle), Config=self.transfert,
+                                ExtraArgs={'ContentType': mimetypes.guess_type(cle)[0] or 'application/octet-stream'})
+        os.remove(chemin)
+
+    def importer_dossier(self, prefixe, dossier):
+        fichiers = [os.path.join(racine, nom) for racine, _, noms in os.walk(dossier) for nom in noms]
+        # Playlists maîtres en dernier : leur présence signifie que tout le reste est en place
+        for chemin in sorted(fichiers, key=lambda c: os.path.basename(c) == 'master.m3u8'):
+            self.importer(f"{prefixe}/{os.path.relpath(chemin, dossier).replace(os.sep, '/')}", chemin)
+        shutil.rmtree(dossier, ignore_errors=True)
+
+    def deplacer(self, source, destination):
+        # Copie côté serveur (en parties au-delà de 5 Go) : les octets ne repassent pas par l'application
+        self.client.copy({'Bucket': self.bucket, 'Key': self._cle(source)}, self.bucket, self._cle(destination),
+                         Config=self.transfert)
+        self.supprimer(source)
+
+    @contextlib.contextmanager
+    def fichier_local(self, cle):
+        fd, chemin = tempfile.mkstemp(dir=_dossier_tmp_blobs())
+        os.close(fd)
+        try:
+            try:
+                self.client.download_file(self.bucket, self._cle(cle), chemin, Config=self.transfert)
+            except self.client.exceptions.ClientError as e:
+                if self._absent(e):
+                    raise FileNotFoundError(cle)
+                raise
+            yield chemin
+        finally:
+            os.remove(chemin)
+
+    @contextlib.contextmanager
+    def source_ffmpeg(self, cle):
+        yield self.url_signee(cle)
+
+    def supprimer(self, cle):
+        self.client.delete_object(Bucket=self.bucket, Key=self._cle(cle))
+
+    def supprimer_prefixe(self, prefixe):
+        cles = [{'Key': self._cle(cle)} for cle, _ in self.lister(prefixe.rstrip('/') + '/')]
+        for i in range(0, len(cles), 1000):
+            self.client.delete_objects(Bucket=self.bucket, Delete={'Objects': cles[i:i + 1000], 'Quiet': True})
+
+    def lister(self, prefixe):
+        pages = self.client.get_paginator('list_objects_v2').paginate(Bucket=self.bucket, Prefix=self._cle(prefixe))
+        for page in pages:
+            for objet in page.get('Contents', []):
+                yield objet['Key'][len(self.prefixe):], objet['LastModified'].timestamp()
+
+    def url_signee(self, cle, nom=None, mimetype=None):
+        params = {'Bucket': self.bucket, 'Key': self._cle(cle)}
+        if nom:
+            params['ResponseContentDisposition'] = f'attachment; filename="{secure_filename(nom)}"'
+        if mimetype:
+            params['ResponseContentType'] = mimetype
+        return self.client.generate_presigned_url('get_object', Params=params, ExpiresIn=self.duree_url)
+
+    def debuter_envoi(self, envoi_id):
+        return self.client.create_multipart_upload(Bucket=self.bucket, Key=self._cle(f"envois/{envoi_id}"))['UploadId']
+
+    def ecrire_partie(self, envoi_id, ref, numero, offset, flux):
+        return self.client.upload_part(Bucket=self.bucket, Key=self._cle(f"envois/{envoi_id}"), UploadId=ref,
+                                       PartNumber=numero, Body=flux)['ETag']
+
+    def terminer_envoi(self, envoi_id, ref, parties):
+        cle = f"envois/{envoi_id}"
+        self.client.complete_multipart_upload(
+            Bucket=self.bucket, Key=self._cle(cle), UploadId=ref,
+            MultipartUpload={'Parts': [{'ETag': etag, 'PartNumber': i} for i, etag in enumerate(parties, 1)]})
+        return cle
+
+    def annuler_envoi(self, envoi_id, ref):
+        try:
+            self.client.abort_multipart_upload(Bucket=self.bucket, Key=self._cle(f"envois/{envoi_id}"), UploadId=ref)
+        except self.client.exceptions.ClientError as e:
+            if e.response.get('Error', {}).get('Code') != 'NoSuchUpload':
+                raise
+
+def creer_stockage():
+    if app.config['STORAGE_BACKEND'] == 's3':
+        return StockageS3(app.config['S3_BUCKET'], app.config['S3_PREFIX'], app.config['S3_ENDPOINT_URL'],
+                          app.config['S3_REGION'], app.config['S3_URL_EXPIRES'], app.config['S3_PART_SIZE'])
+    return StockageLocal(app.config['CONVERTED_FOLDER'], app.config['UPLOAD_FOLDER'])
+
+stockage = creer_stockage()
+
+# --- Stockage adressé par contenu (déduplication des uploads et des conversions) ---
+
+TAILLE_BUFFER_HASH = 1024 * 1024
+
+def cle_blob(digest):
+    """Clé du blob : deux premiers caractères en sous-dossier pour limiter la taille des dossiers."""
+    return f"blobs/{digest[:2]}/{digest}"
+
+def _dossier_tmp_blobs():
+    """Espace de travail local des conversions (toujours sur disque, quel que soit le stockage)."""
+    dossier = os.path.join(app.config['BLOB_FOLDER'], 'tmp')
+    os.makedirs(dossier, exist_ok=True)
+    return dossier
+
+def hacher_flux(flux):
+    """Retourne (empreinte SHA-256, taille) d'un flux lu par blocs."""
+    hasher = hashlib.sha256()
+    taille = 0
+    while bloc := flux.read(TAILLE_BUFFER_HASH):
+        hasher.update(bloc)
+        taille += len(bloc)
+    return hasher.hexdigest(), taille
+
+def _hacher_fichier(path):
+    with open(path, 'rb') as f:
+        return hacher_flux(f)
+
+def hacher_fichier(path):
+    return hors_boucle(_hacher_fichier, path)
+
+def retenir_blob(digest, size=0, nombre=1):
+    """Ajoute `nombre` références au blob (crée la ligne si ce sont les premières)."""
+    if Blob.query.filter_by(digest=digest).update({'refcount': Blob.refcount + nombre}, synchronize_session=False):
+        db.session.commit()
+        return
+    db.session.add(Blob(digest=digest, size=size, refcount=nombre))
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # Un autre processus a importé les mêmes octets au même moment
+        db.session.rollback()
+        Blob.query.filter_by(digest=digest).update({'refcount': Blob.refcount + nombre}, synchronize_session=False)
+        db.session.commit()
+
+def liberer_blob(digest):
+    """Retire une référence ; le fichier est supprimé quand plus personne ne l'utilise."""
+    Blob.query.filter_by(digest=digest).update({'refcount': Blob.refcount - 1}, synchronize_session=False)
+    supprime = Blob.query.filter(Blob.digest == digest, Blob.refcount <= 0).delete(synchronize_session=False)
+    db.session.commit()
+    if supprime:
+        stockage.supprimer(cle_blob(digest))
+        stockage.supprimer_prefixe(cle_hls(digest)) # Segments HLS produits avec ce fichier
+
+def importer_blob(path, digest, size):
+    """Range un fichier local déjà haché dans le stockage (ou le jette si ces octets y sont déjà)."""
+    if stockage.existe(cle_blob(digest)):
+        os.remove(path)
+    else:
+        stockage.importer(cle_blob(digest), path)
+    retenir_blob(digest, size)
+    return digest
+
+def ranger_blob(cle, digest, size):
+    """Comme importer_blob, pour un fichier déjà dans le stockage (upload par morceaux terminé)."""
+    if stockage.existe(cle_blob(digest)):
+        stockage.supprimer(cle)
+    else:
+        stockage.deplacer(cle, cle_blob(digest))
+    retenir_blob(digest, size)
+    return digest
+
+def stocker_flux(flux, kind=None):
+    """
+    Écrit un flux dans le stockage en le hachant au fil de l'eau ; retourne l'empreinte.
+    Avec `kind`, les premiers octets sont vérifiés avant toute écriture (FichierRefuse sinon).
+    """
+    hasher = hashlib.sha256()
+    taille = 0
+    premier = flux.read(TAILLE_BUFFER_HASH)
+    if kind:
+        verifier_entete(premier, kind)
+    fd, tmp_path = tempfile.mkstemp(dir=_dossier_tmp_blobs())
+    with phase('stockage'):
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                bloc = premier
+                while bloc:
+                    hasher.update(bloc)
+                    f.write(bloc)
+                    taille += len(bloc)
+                    bloc = flux.read(TAILLE_BUFFER_HASH)
+        except BaseException:
+            # Client déconnecté, disque plein... : pas de fichier temporaire abandonné
+            os.remove(tmp_path)
+            raise
+        return importer_blob(tmp_path, hasher.hexdigest(), taille)
+
+def cle_conversion(input_digest, convertisseur, params):
+    """Clé de cache : mêmes octets + même convertisseur + mêmes paramètres = même résultat."""
+    brut = f"{input_digest}:{convertisseur}:{json.dumps(params, sort_keys=True)}"
+    return hashlib.sha256(brut.encode()).hexdigest()
+
+def convertir_avec_cache(input_digest, convertisseur, params, ext, produire):
+    """
+    Retourne le nom public du résultat (`<empreinte>.<ext>`), depuis le cache si cette conversion a déjà
+    été faite, sinon en appelant `produire(chemin_entree, chemin_sortie)`.
+    Le cache garde une référence sur le blob de sortie, et chaque appel en ajoute une pour l'appelant.
+    """
+    cle = cle_conversion(input_digest, convertisseur, params)
+    entree = db.session.get(ConversionCache, cle)
+    if entree and stockage.existe(cle_blob(entree.output_digest)):
+        retenir_blob(entree.output_digest)
+        conversions.inc(converter=convertisseur, result='cache')
+        return f"{entree.output_digest}.{entree.output_ext}"
+
+    fd, tmp_path = tempfile.mkstemp(dir=_dossier_tmp_blobs(), suffix=f".{ext}")
+    os.close(fd)
+    try:
+        # Source copiée dans l'espace de travail si le stockage est distant
+        with stockage.fichier_local(cle_blob(input_digest)) as input_path:
+            debut = time.perf_counter()
+            try:
+                produire(input_path, tmp_path)
+            except Exception:
+                conversions.inc(converter=convertisseur, result='echec')
+                raise
+            duree = time.perf_counter() - debut
+            taille_entree = os.path.getsize(input_path)
+        output_digest, taille = hacher_fichier(tmp_path)
+        observer_conversion(convertisseur, duree, taille_entree, taille)
+        importer_blob(tmp_path, output_digest, taille) # Référence détenue par le cache
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    if entree:
+        entree.output_digest = output_digest
+    else:
+        db.session.add(ConversionCache(key=cle, output_digest=output_digest, output_ext=ext))
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # Conversion identique terminée en parallèle ailleurs : sa ligne de cache fait foi
+        db.session.rollback()
+        liberer_blob(output_digest)
+        return convertir_avec_cache(input_digest, convertisseur, params, ext, produire)
+
+    retenir_blob(output_digest)
+    return f"{output_digest}.{ext}"
+
+def digest_public(filename):
+    """Empreinte d'un nom public `<empreinte>.<ext>` (None pour les anciens noms de fichiers)."""
+    digest, _, ext = filename.partition('.')
+    if len(digest) == 64 and all(c in '0123456789abcdef' for c in digest) and ext.isalnum():
+        return digest
+    return None
+
+def chemin_media(filename):
+    """Retourne (dossier, nom sur disque) d'un fichier converti (stockage local) : blob `<empreinte>.<ext>` ou ancien nom."""
+    digest = digest_public(filename)
+    if digest:
+        return os.path.dirname(stockage.chemin(cle_blob(digest))), digest
+    return app.config['CONVERTED_FOLDER'], filename
+
+# --- Streaming adaptatif (HLS) : segments et playlists rangés sous l'empreinte du MP4 ---
+
+def renditions_hls(hauteur_source=None):
+    """[(hauteur, débit vidéo), ...] de HLS_RENDITIONS, sans celles qui agrandiraient la source."""
+    renditions = []
+    for element in filter(None, (e.strip() for e in app.config['HLS_RENDITIONS'].split(','))):
+        hauteur, _, debit = element.partition(':')
+        renditions.append((int(hauteur), debit))
+    renditions.sort(reverse=True)
+    if hauteur_source:
+        # On garde toujours au moins la plus petite, même pour une source minuscule
+        renditions = [r for r in renditions if r[0] <= hauteur_source] or renditions[-1:]
+    return renditions
+
+def cle_hls(digest):
+    return f"hls/{digest[:2]}/{digest}"
+
+def playlist_hls(filename):
+    """True si la vidéo convertie `filename` a une playlist HLS (master.m3u8)."""
+    digest = digest_public(filename) if filename else None
+    if not digest:
+        return False
+    # Réponse gardée quelques instants : le fil en a besoin pour chaque vidéo, et un stockage distant coûte une requête
+    present = cache_hls.get(digest)
+    if present is None:
+        present = stockage.existe(f"{cle_hls(digest)}/master.m3u8")
+        cache_hls.set(digest, present)
+    return present
+
+def installer_hls(dossier_tmp, output_filename):
+    """Range les segments produits sous l'empreinte du MP4 (une conversion identique a pu le faire avant)."""
+    digest = digest_public(output_filename)
+    if stockage.existe(f"{cle_hls(digest)}/master.m3u8"):
+        shutil.rmtree(dossier_tmp, ignore_errors=True)
+        return
+    stockage.importer_dossier(cle_hls(digest), dossier_tmp)
+    cache_hls.pop(digest)
+
+# --- Encodage vidéo : une passe ffmpeg, ou morceaux encodés en parallèle pour les vidéos longues ---
+
+def executer_ffmpeg(commande, on_temps=None):
+    """
+    Lance ffmpeg et lève ErreurConversion en cas d'échec.
+    `on_temps` reçoit la position atteinte dans la sortie (secondes), lue sur `-progress pipe:1`.
+    """
+    if on_temps:
+        commande = commande + ['-progress', 'pipe:1', '-nostats']
+    # stderr part dans un fichier temporaire : un tube plein bloquerait ffmpeg
+    with tempfile.TemporaryFile(mode='w+') as erreurs:
+        processus = subprocess.Popen(commande, stdout=subprocess.PIPE if on_temps else subprocess.DEVNULL,
+                                     stderr=erreurs, text=True)
+        if on_temps:
+            for ligne in processus.stdout:
+                cle, _, valeur = ligne.strip().partition('=')
+                if cle == 'out_time_us' and valeur.isdigit():
+                    on_temps(int(valeur) / 1_000_000)
+        processus.wait()
+
+        if processus.returncode != 0:
+            erreurs.seek(0)
+            raise ErreurConversion(erreurs.read()[-500:].strip() or f"ffmpeg a retourné {processus.returncode}")
+
+FFMPEG = ['ffmpeg', '-y', '-nostdin', '-hide_banner', '-loglevel', 'error']
+
+def _args_mp4(params):
+    return ['-c:v', 'libx264', '-preset', params['preset'], '-crf', str(params['crf']), '-pix_fmt', 'yuv420p']
+
+def _args_rendition(debit, indice=''):
+    """Débit cible et plafond (VBV) d'une rendition ; `indice` vise un flux précis de la sortie (`:v:1`)."""
+    plafond = f"{int(debit.rstrip('k')) * 3 // 2}k"
+    return [f"-b{indice}", debit, f"-maxrate{indice}", plafond, f"-bufsize{indice}", plafond]
+
+def _args_images_cles(params):
+    """Images clés aux mêmes instants dans toutes les renditions : on peut en changer à chaque segment HLS."""
+    return ['-force_key_frames', f"expr:gte(t,n_forced*{params['hls_time']})", '-sc_threshold', '0']
+
+def _filtre_renditions(renditions, entree='[0:v]'):
+    """Un décodage, N+1 sorties : [mp4] à la taille d'origine et [h0], [h1]... réduites."""
+    sorties = ''.join(f"[v{i}]" for i in range(len(renditions)))
+    echelles = ';'.join(f"[v{i}]scale=-2:'trunc(min({h},ih)/2)*2'[h{i}]" for i, (h, _) in enumerate(renditions))
+    return f"{entree}split={len(renditions) + 1}[mp4]{sorties};{echelles}"
+
+def _sortie_hls(params, nombre, audio, dossier):
+    """Muxer HLS : une playlist par rendition (v0/, v1/...) et une playlist maître qui les référence."""
+    return [
+        '-f', 'hls', '-hls_time', str(params['hls_time']), '-hls_playlist_type', 'vod',
+        '-hls_flags', 'independent_segments', '-hls_segment_type', 'mpegts',
+        '-hls_segment_filename', os.path.join(dossier, 'v%v', 'seg_%05d.ts'),
+        '-master_pl_name', 'master.m3u8',
+        '-var_stream_map', ' '.join(f"v:{i},a:{i}" if audio else f"v:{i}" for i in range(nombre)),
+        os.path.join(dossier, 'v%v', 'index.m3u8'),
+    ]
+
+def _ecrire_debits_master(dossier, renditions, audio):
+    """
+    BANDWIDTH de chaque variante de master.m3u8 d'après les débits de HLS_RENDITIONS. Quand le muxer HLS
+    recopie des flux déjà encodés (-c copy), il ne connaît pas leur débit et met la même valeur partout :
+    le lecteur ne saurait plus choisir sa rendition.
+    """
+    chemin = os.path.join(dossier, 'master.m3u8')
+    with open(chemin) as f:
+        lignes = f.read().splitlines()
+    debit_audio = 128_000 if audio else 0
+    for n, ligne in enumerate(lignes[:-1]):
+        variante = re.fullmatch(r'v(\d+)/index\.m3u8', lignes[n + 1].strip())
+        if ligne.startswith('#EXT-X-STREAM-INF:') and variante:
+            debit = int(renditions[int(variante.group(1))][1].rstrip('k')) * 1000
+            # Crête : le plafond VBV de _args_rendition ; moyenne : le débit cible
+            attributs = re.sub(r',?(AVERAGE-)?BANDWIDTH=\d+', '', ligne[len('#EXT-X-STREAM-INF:'):]).lstrip(',')
+            lignes[n] = (f"#EXT-X-STREAM-INF:BANDWIDTH={debit * 3 // 2 + debit_audio},"
+                         f"AVERAGE-BANDWIDTH={debit + debit_audio}" + (f",{attributs}" if attributs else ''))
+    with open(chemin, 'w') as f:
+        f.write('\n'.join(lignes) + '\n')
+
+def _encoder_une_passe(input_path, output_path, params, renditions, audio, dossier, on_temps):
+    commande = FFMPEG + ['-i', input_path]
+    if renditions:
+        commande += ['-filter_complex', _filtre_renditions(renditions), '-map', '[mp4]', '-map', '0:a:0?']
+    commande += _args_mp4(params) + ['-c:a', 'aac', '-b:a', '128k', '-movflags', '+faststart', output_path]
+    if renditions:
+        for i in range(len(renditions)):
+            commande += ['-map', f"[h{i}]"] + (['-map', '0:a:0'] if audio else [])
+        commande += ['-c:v', 'libx264', '-preset', params['preset'], '-pix_fmt', 'yuv420p'] + _args_images_cles(params)
+        for i, (_, debit) in enumerate(renditions):
+            commande += _args_rendition(debit, f":v:{i}")
+        if audio:
+            commande += ['-c:a', 'aac', '-b:a', '128k', '-ac', '2']
+        commande += _sortie_hls(params, len(renditions), audio, dossier)
+    executer_ffmpeg(commande, on_temps)
+
+class OrdonnanceurSegments:
+    """
+    File d'attente équitable des morceaux à encoder, partagée par tous les jobs du processus :
+    au plus `places` ffmpeg simultanés, et le morceau suivant est pris à tour de rôle dans chaque job,
+    pour qu'une vidéo d'une heure n'affame pas celles qui arrivent après elle.
+    """
+
+    def __init__(self, places):
+        self.places = places
+        self._files = collections.OrderedDict() # job -> deque de (fonction, arguments, future)
+        self._en_cours = 0
+        self._lock = threading.Lock()
+        self._executeur = ThreadPoolExecutor(max_workers=places) # Chaque tâche pilote un processus ffmpeg
+
+    def executer(self, taches, on_termine=None):
+        """
+        Exécute [(fonction, arguments), ...] et retourne les résultats dans l'ordre (lève la première erreur).
+        `on_termine(nombre_termines)` est appelée dans le thread appelant après chaque tâche.
+        """
+        job = object()
+        futures = [concurrent.futures.Future() for _ in taches]
+        with self._lock:
+            self._files[job] = collections.deque((f, a, fut) for (f, a), fut in zip(taches, futures))
+            self._lancer()
+        try:
+            for termines, future in enumerate(concurrent.futures.as_completed(futures), 1):
+                future.result()
+                if on_termine:
+                    on_termine(termines)
+            return [future.result() for future in futures]
+        finally:
+            with self._lock:
+                self._files.pop(job, None) # Après une erreur, les morceaux pas encore lancés sont abandonnés
+
+    def _lancer(self):
+        # Appelée avec le verrou : remplit les places libres, un morceau par job à tour de rôle
+        while self._en_cours < self.places and self._files:
+            job, file = next(iter(self._files.items()))
+            fonction, arguments, future = file.popleft()
+            if file:
+                self._files.move_to_end(job)
+            else:
+                del self._files[job]
+            self._en_cours += 1
+            # Pas de add_done_callback ici : sur une tâche déjà terminée, il rappellerait _termine dans ce
+            # thread, qui détient le verrou (non réentrant)
+            self._executeur.submit(self._executer, fonction, arguments, future)
+
+    def _executer(self, fonction, arguments, future):
+        # Dans un thread de l'exécuteur : la place est libérée avant que l'appelant ne voie le résultat
+        try:
+            resultat = fonction(*arguments)
+        except BaseException as e:
+            self._termine()
+            future.set_exception(e)
+        else:
+            self._termine()
+            future.set_result(resultat)
+
+    def _termine(self):
+        with self._lock:
+            self._en_cours -= 1
+            self._lancer()
+
+_ordonnanceur = None
+_ordonnanceur_lock = threading.Lock()
+
+def ordonnanceur_segments():
+    global _ordonnanceur
+    with _ordonnanceur_lock:
+        if _ordonnanceur is None:
+            _ordonnanceur = OrdonnanceurSegments(app.config['ENCODE_WORKERS'])
+        return _ordonnanceur
+
+def _encoder_morceau(input_path, debut, duree, sorties, params, renditions, fils):
+    """
+    Encode un morceau (vidéo seule) : la qualité MP4 et chaque rendition, en un décodage.
+    Le morceau commence exactement à `debut` secondes (recherche précise : décodé depuis l'image clé
+    précédente), un multiple de la durée d'un segment HLS : la grille des images clés reste celle de la
+    vidéo entière.
+    """
+    commande = FFMPEG + ['-ss', f"{debut:.3f}", '-t', f"{duree:.3f}", '-i', input_path, '-threads', str(fils)]
+    if renditions:
+        commande += ['-filter_complex', _filtre_renditions(renditions), '-map', '[mp4]']
+    commande += _args_mp4(params) + ['-an', sorties[0]]
+    for i, (_, debit) in enumerate(renditions):
+        commande += ['-map', f"[h{i}]", '-c:v', 'libx264', '-preset', params['preset'], '-pix_fmt', 'yuv420p',
+                     '-threads', str(fils)] + _args_images_cles(params) + _args_rendition(debit, ':v') + ['-an', sorties[i + 1]]
+    executer_ffmpeg(commande)
+
+def _liste_concat(dossier, nom, fichiers):
+    """Fichier d'entrée du démultiplexeur concat de ffmpeg."""
+    chemin = os.path.join(dossier, nom)
+    with open(chemin, 'w') as f:
+        for fichier in fichiers:
+            f.write(f"file '{os.path.abspath(fichier)}'\n")
+    return chemin
+
+def _encoder_en_parallele(input_path, output_path, params, renditions, audio, dossier, on_progress, duree):
+    """
+    1. découpe la vidéo (de `duree` secondes) en morceaux dont les bornes sont des multiples de la durée d'un
+       segment HLS : chaque morceau est lu directement dans la source, à partir de sa borne exacte ;
+    2. encode les morceaux en parallèle via l'ordonnanceur (l'audio en même temps, d'un seul tenant) ;
+    3. assemble les morceaux encodés avec le démultiplexeur concat (-c copy, donc sans perte).
+    """
+    travail = tempfile.mkdtemp(dir=_dossier_tmp_blobs())
+    try:
+        pas = params['hls_time']
+        duree_morceau = max(1, round(app.config['ENCODE_SEGMENT_SECONDS'] / pas)) * pas
+        morceaux = [(n * duree_morceau, duree_morceau) for n in range(max(1, math.ceil(duree / duree_morceau)))]
+        variantes = ['mp4'] + [f"r{i}" for i in range(len(renditions))]
+        sorties = [[os.path.join(travail, f"{v}_{n:05d}.mkv") for v in variantes] for n in range(len(morceaux))]
+
+        fils = max(1, (os.cpu_count() or 1) // app.config['ENCODE_WORKERS'])
+        taches = [(_encoder_morceau, (input_path, debut, longueur, sorties[n], params, renditions, fils))
+                  for n, (debut, longueur) in enumerate(morceaux)]
+        piste_audio = os.path.join(travail, 'audio.m4a')
+        if audio:
+            taches.append((executer_ffmpeg, (FFMPEG + ['-i', input_path, '-map', '0:a:0', '-vn', '-c:a', 'aac',
+                                                       '-b:a', '128k', '-ac', '2', piste_audio],)))
+        # L'assemblage final est rapide : les morceaux représentent l'essentiel de la progression
+        ordonnanceur_segments().executer(taches, on_termine=lambda termines: on_progress and on_progress(
+            0.95 * termines / len(taches)))
+
+        listes = [_liste_concat(travail, f"{v}.txt", [s[i] for s in sorties]) for i, v in enumerate(variantes)]
+        entree_audio = ['-i', piste_audio] if audio else []
+        executer_ffmpeg(FFMPEG + ['-f', 'concat', '-safe', '0', '-i', listes[0]] + entree_audio
+                        + ['-map', '0:v'] + (['-map', '1:a'] if audio else [])
+                        + ['-c', 'copy', '-movflags', '+faststart', output_path])
+        if renditions:
+            commande = FFMPEG
+            for liste in listes[1:]:
+                commande = commande + ['-f', 'concat', '-safe', '0', '-i', liste]
+            commande += entree_audio
+            for i in range(len(renditions)):
+                commande += ['-map', f"{i}:v"] + (['-map', f"{len(renditions)}:a"] if audio else [])
+            executer_ffmpeg(commande + ['-c', 'copy'] + _sortie_hls(params, len(renditions), audio, dossier))
+            _ecrire_debits_master(dossier, renditions, audio)
+    finally:
+        shutil.rmtree(travail, ignore_errors=True)
+
+def encoder_video(input_path, output_path, dossier=None, on_progress=None, parallele=None):
+    """
+    Produit le MP4 H.264/AAC dans `output_path` et, si `dossier` est donné, les renditions HLS dedans.
+    Retourne True si le HLS a été produit. Les vidéos assez longues (ENCODE_PARALLEL_MIN_SECONDS) sont
+    encodées par morceaux en parallèle, sauf si `parallele` force le choix.
+    """
+    params = parametres_video()
+    infos = sonder_video(input_path)
+    duree = infos['duree']
+    renditions = renditions_hls(infos['hauteur']) if dossier else []
+    # Piste audio : l'en-tête le dit ; si on ne sait pas, pas de HLS (son mappage l'exige)
+    if infos['audio'] is None:
+        renditions = []
+
+    if parallele is None:
+        parallele = (app.config['ENCODE_WORKERS'] > 1 and duree is not None
+                     and duree >= app.config['ENCODE_PARALLEL_MIN_SECONDS'])
+    if parallele and duree:
+        _encoder_en_parallele(input_path, output_path, params, renditions, infos['audio'], dossier, on_progress, duree)
+    else:
+        on_temps = (lambda t: on_progress(min(t / duree, 1.0))) if on_progress and duree else None
+        _encoder_une_passe(input_path, output_path, params, renditions, infos['audio'], dossier, on_temps)
+    return bool(renditions)
+
+def parametres_video():
+    """Paramètres qui déterminent le résultat d'une conversion vidéo (et donc sa clé de cache)."""
+    return {'preset': app.config['FFMPEG_PRESET'], 'crf': 23, 'audio': 'aac-128k',
+            'hls': app.config['HLS_RENDITIONS'], 'hls_time': app.config['HLS_SEGMENT_SECONDS']}
+
+def convert_to_mp4(input_digest, on_progress=None):
+    """
+    Convertit la vidéo (blob `input_digest`) en MP4 H.264/AAC avec ffmpeg et retourne le nom public du résultat.
+    Les renditions HLS sont produites en même temps (voir HLS_RENDITIONS).
+    `on_progress` reçoit la progression (0.0 -> 1.0).
+    Si les mêmes octets ont déjà été convertis avec les mêmes paramètres, ffmpeg n'est pas relancé.
+    """
+    hls_produit = []
+
+    def produire(input_path, output_path):
+        dossier = tempfile.mkdtemp(dir=_dossier_tmp_blobs())
+        hls_produit.append(dossier)
+        if not encoder_video(input_path, output_path, dossier, on_progress):
+            hls_produit.remove(dossier)
+            shutil.rmtree(dossier, ignore_errors=True)
+
+    try:
+        output_filename = convertir_avec_cache(input_digest, 'mp4', parametres_video(), 'mp4', produire)
+        if hls_produit:
+            installer_hls(hls_produit[0], output_filename)
+    finally:
+        for dossier in hls_produit:
+            shutil.rmtree(dossier, ignore_errors=True)
+    if on_progress:
+        on_progress(1.0)
+    return output_filename
+
+def publier_video(user, title, input_digest):
+    """Inscrit la conversion d'une vidéo reçue et l'ajoute au fil (statut 'en attente')."""
+    job = enqueue_conversion(user, title, input_digest)
+    db.session.add(Video(user_id=user.id, job_id=job.id, title=title, status=job.status))
+    db.session.commit()
+    incrementer_version('videos')
+    return job
+
+# --- Sondage des médias : refuser tôt ce qui n'est pas convertible (ou trop coûteux à convertir) ---
+
+TAILLE_ENTETE = 4096
+
+# (position, octets, conteneur) : signatures des formats acceptés
+SIGNATURES = [
+    (0, b'GIF87a', 'gif'), (0, b'GIF89a', 'gif'),
+    (4, b'ftyp', 'mp4'), # MP4, MOV, M4V, 3GP
+    (4, b'moov', 'mov'), (4, b'mdat', 'mov'), (4, b'wide', 'mov'), (4, b'free', 'mov'),
+    (0, b'\x1a\x45\xdf\xa3', 'matroska'), # MKV, WebM
+    (0, b'FLV', 'flv'),
+    (0, b'OggS', 'ogg'),
+    (0, b'\x00\x00\x01\xba', 'mpeg'),
+    (0, b'\x30\x26\xb2\x75\x8e\x66\xcf\x11', 'asf'), # WMV
+]
+
+def type_media(entete):
+    """Conteneur reconnu d'après les premiers octets (None si inconnu)."""
+    for position, signature, conteneur in SIGNATURES:
+        if entete[position:position + len(signature)] == signature:
+            return conteneur
+    if entete[:4] == b'RIFF' and entete[8:12] == b'AVI ':
+        return 'avi'
+    if len(entete) > 376 and entete[0] == entete[188] == entete[376] == 0x47:
+        return 'mpegts'
+    return None
+
+def verifier_entete(entete, kind):
+    """Vérifie les premiers octets d'un upload ('video' ou 'gif') ; retourne le conteneur ou lève FichierRefuse."""
+    conteneur = type_media(entete)
+    if kind == 'gif':
+        if conteneur != 'gif':
+            raise FichierRefuse("Ce fichier n'est pas un GIF.")
+        # Taille de l'écran logique, lue avant d'écrire le reste du fichier
+        largeur, hauteur = struct.unpack('<HH', entete[6:10])
+        if largeur * hauteur > app.config['GIF_MAX_PIXELS']:
+            raise FichierRefuse(f"GIF trop grand ({largeur}x{hauteur}).")
+    elif conteneur is None or conteneur == 'gif':
+        raise FichierRefuse("Format vidéo non reconnu.")
+    return conteneur
+
+def inspecter_gif(chemin):
+    """
+    Dimensions, nombre de frames, durée (secondes) et PGCD des durées des frames (ms) d'un GIF, en
+    parcourant ses blocs sans décompresser aucune image : le coût ne dépend que de la taille du fichier.
+    """
+    with open(chemin, 'rb') as f:
+        entete = f.read(13)
+        if len(entete) < 13 or type_media(entete) != 'gif':
+            raise FichierRefuse("Ce fichier n'est pas un GIF.")
+        largeur, hauteur, drapeaux = struct.unpack('<HHB', entete[6:11])
+        if drapeaux & 0x80: # Palette globale
+            f.seek(3 * 2 ** ((drapeaux & 7) + 1), os.SEEK_CUR)
+
+        def sauter_sous_blocs():
+            while (taille := f.read(1)) and taille[0]:
+                f.seek(taille[0], os.SEEK_CUR)
+
+        frames, centiemes, delai, intervalle = 0, 0, 0, 0
+        while (introducteur := f.read(1)) and introducteur != b';':
+            if introducteur == b'!': # Extension
+                if f.read(1) == b'\xf9': # Graphic Control : délai de la frame suivante
+                    bloc = f.read(6)
+                    if len(bloc) == 6:
+                        delai = struct.unpack('<H', bloc[2:4])[0]
+                        centiemes += delai
+                else:
+                    sauter_sous_blocs()
+            elif introducteur == b',': # Image
+                descripteur = f.read(9)
+                if len(descripteur) < 9:
+                    break
+                x, y, l, h, drapeaux = struct.unpack('<HHHHB', descripteur)
+                largeur, hauteur = max(largeur, x + l), max(hauteur, y + h)
+                frames += 1
+                # Même durée par défaut que iterer_frames_gif (100 ms si absente ou nulle)
+                intervalle = math.gcd(intervalle, 10 * delai or 100)
+                delai = 0
+                if drapeaux & 0x80: # Palette locale
+                    f.seek(3 * 2 ** ((drapeaux & 7) + 1), os.SEEK_CUR)
+                f.read(1) # Taille de code LZW
+                sauter_sous_blocs()
+            else:
+                break # Fichier tronqué : Pillow s'arrêtera au même endroit
+    return {'largeur': largeur, 'hauteur': hauteur, 'frames': frames, 'duree': centiemes / 100,
+            'intervalle': intervalle or 100}
+
+def sonder_media(input_digest, kind):
+    """
+    Sonde le blob (en-têtes seulement), applique les limites et enregistre le résultat (MediaProbe).
+    Un fichier refusé lève FichierRefuse et la référence de l'appelant sur le blob est libérée.
+    """
+    cle = cle_blob(input_digest)
+    sonde = db.session.get(MediaProbe, input_digest)
+    try:
+        if sonde is None or sonde.kind != kind:
+            with contextlib.closing(stockage.ouvrir(cle)) as f:
+                conteneur = verifier_entete(f.read(TAILLE_ENTETE), kind)
+            if kind == 'gif':
+                with stockage.fichier_local(cle) as chemin:
+                    infos = inspecter_gif(chemin)
+                infos.update(codec='gif', audio=False)
+            else:
+                with stockage.source_ffmpeg(cle) as source:
+                    infos = sonder_video(source)
+                if infos['duree'] and infos['fps'] and not infos['frames']:
+                    infos['frames'] = int(infos['duree'] * infos['fps'])
+            pixels = (infos['largeur'] or 0) * (infos['hauteur'] or 0)
+            sonde = MediaProbe(digest=input_digest, kind=kind, container=conteneur, codec=infos['codec'],
+                               width=infos['largeur'], height=infos['hauteur'], duration=infos['duree'],
+                               frames=infos['frames'], audio=infos['audio'],
+                               cost=pixels * (infos['frames'] or 1) / 1e6)
+        _verifier_limites(sonde)
+    except FichierRefuse:
+        db.session.rollback()
+        liberer_blob(input_digest)
+        raise
+
+    if sonde not in db.session:
+        db.session.add(sonde)
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback() # Même fichier sondé en parallèle : le résultat est identique
+    return sonde
+
+def _verifier_limites(sonde):
+    pixels = (sonde.width or 0) * (sonde.height or 0)
+    if sonde.kind == 'gif':
+        if not sonde.frames:
+            raise FichierRefuse("GIF sans aucune image.")
+        if pixels > app.config['GIF_MAX_PIXELS']:
+            raise FichierRefuse(f"GIF trop grand ({sonde.width}x{sonde.height}).")
+        if pixels * sonde.frames > app.config['GIF_MAX_TOTAL_PIXELS']:
+            raise FichierRefuse(f"GIF trop lourd à convertir ({sonde.frames} images de {sonde.width}x{sonde.height}).")
+        return
+    if not pixels:
+        raise FichierRefuse("Aucune piste vidéo lisible dans ce fichier.")
+    if pixels > app.config['VIDEO_MAX_PIXELS']:
+        raise FichierRefuse(f"Résolution trop élevée ({sonde.width}x{sonde.height}).")
+    if sonde.duration and sonde.duration > app.config['VIDEO_MAX_DURATION']:
+        raise FichierRefuse(f"Vidéo trop longue ({int(sonde.duration // 60)} min).")
+
+# --- Moteur de conversion GIF (toutes les frames) ---
+
+# format demandé -> (extension du résultat, libellé affiché)
+FORMATS_GIF = {
+    'png': ('png', 'PNG'),
+    'webp': ('webp', 'WebP animé'),
+    'apng': ('png', 'APNG'),
+    'mp4': ('mp4', 'MP4'),
+    'sprite': ('png', 'Planche de sprites'),
+}
+
+# Arguments ffmpeg des formats animés : les frames lui arrivent en RGBA brut sur stdin
+CODECS_GIF_FFMPEG = {
+    'webp': ['-c:v', 'libwebp_anim', '-lossless', '0', '-quality', '80', '-loop', '0', '-f', 'webp'],
+    'apng': ['-c:v', 'apng', '-plays', '0', '-f', 'apng'],
+    'mp4': ['-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2', '-c:v', 'libx264', '-crf', '23',
+            '-pix_fmt', 'yuv420p', '-movflags', '+faststart', '-f', 'mp4'],
+}
+
+_pool_gif = None
+_pool_gif_lock = threading.Lock()
+
+def pool_gif():
+    """
+    Pool Pillow (moteur GIF, images par lots), créé à la première utilisation dans chaque processus : des
+    processus en mode threading, de vrais threads sous gevent/eventlet (voir ExecuteurHorsBoucle).
+    """
+    global _pool_gif
+    with _pool_gif_lock:
+        if _pool_gif is None:
+            if socketio.async_mode in ('gevent', 'eventlet'):
+                _pool_gif = ExecuteurHorsBoucle(app.config['GIF_WORKERS'])
+            else:
+                _pool_gif = ProcessPoolExecutor(max_workers=app.config['GIF_WORKERS'])
+        return _pool_gif
+
+def options_gif(valeurs):
+    """Valide les options du formulaire GIF ; retourne (format, largeur, couleurs) ou lève ValueError."""
+    format = valeurs.get('gif_format') or 'png'
+    if format not in FORMATS_GIF:
+        raise ValueError("Format de sortie inconnu.")
+    try:
+        largeur = int(valeurs['gif_width']) if valeurs.get('gif_width') else None
+        couleurs = int(valeurs['gif_colors']) if valeurs.get('gif_colors') else None
+    except (TypeError, ValueError):
+        raise ValueError("Largeur ou nombre de couleurs invalide.")
+    if largeur is not None and not 16 <= largeur <= 4096:
+        raise ValueError("La largeur doit être comprise entre 16 et 4096 pixels.")
+    if couleurs is not None and not 2 <= couleurs <= 256:
+        raise ValueError("Le nombre de couleurs doit être compris entre 2 et 256.")
+    return format, largeur, couleurs
+
+def _transformer_frame(donnees, taille, largeur, couleurs):
+    """Exécutée dans le pool : redimensionne et/ou réduit la palette d'une frame RGBA brute."""
+    img = Image.frombytes('RGBA', taille, donnees)
+    if largeur and img.width != largeur:
+        hauteur = max(1, round(img.height * largeur / img.width))
+        img = img.resize((largeur, hauteur), Image.Resampling.LANCZOS)
+    if couleurs:
+        img = img.quantize(colors=couleurs, method=Image.Quantize.FASTOCTREE).convert('RGBA')
+    return img.tobytes(), img.size
+
+def _decoder_frame(gif, index):
+    """Frame `index` du GIF ouvert, en RGBA : (image, durée en ms)."""
+    gif.seek(index)
+    return gif.convert('RGBA'), gif.info.get('duration') or 100
+
+def iterer_frames_gif(input_path, largeur=None, couleurs=None, indices=None, fenetre=None, pool=None):
+    """
+    Décode les frames du GIF et, s'il y a un redimensionnement ou une réduction de palette à faire, fait
+    transformer chacune dans le pool : seules ces transformations sont parallèles. Le décodage reste
+    séquentiel (une frame GIF se dessine par-dessus la précédente), mais au plus `fenetre` frames sont
+    en vol à la fois : la mémoire ne dépend pas du nombre de frames.
+    Produit, dans l'ordre, des tuples (octets RGBA, (largeur, hauteur), durée en ms).
+    """
+    fenetre = fenetre or app.config['GIF_FRAMES_IN_FLIGHT']
+    en_vol = collections.deque()
+
+    if indices is None:
+        indices = range(inspecter_gif(input_path)['frames'] or 1) # n_frames décoderait tout le GIF
+
+    with Image.open(input_path) as gif:
+        for index in indices:
+            # Décodage hors de la boucle d'événements : sous gevent, il gèlerait les autres connexions du worker
+            try:
+                frame, duree = hors_boucle(_decoder_frame, gif, index)
+            except EOFError:
+                break # Moins de frames lisibles que de blocs image (fichier tronqué)
+            if not largeur and not couleurs:
+                # Rien à transformer : un aller-retour par le pool ne ferait que copier les octets
+                yield frame.tobytes(), frame.size, duree
+                continue
+            pool = pool or pool_gif()
+            en_vol.append((pool.submit(_transformer_frame, frame.tobytes(), frame.size, largeur, couleurs), duree))
+            del frame
+
+            if len(en_vol) >= fenetre:
+                futur, duree = en_vol.popleft()
+                yield (*futur.result(), duree)
+
+    while en_vol:
+        futur, duree = en_vol.popleft()
+        yield (*futur.result(), duree)
+
+# Intervalle minimal entre deux images d'une animation produite par ffmpeg (ms) : 50 images/s au plus
+INTERVALLE_MIN_ANIMATION = 20
+
+def _encoder_frames_ffmpeg(frames, output_path, format, intervalle):
+    """
+    Envoie les frames à ffmpeg au fil de l'eau (mémoire constante, même pour des milliers de frames).
+    `intervalle` (ms) fixe la fréquence de sortie : le PGCD des durées des frames, pour qu'aucune ne soit perdue.
+    """
+    premiere = next(frames, None)
+    if premiere is None:
+        raise ErreurConversion("Le GIF ne contient aucune image.")
+    _, (largeur, hauteur), _ = premiere
+    intervalle = max(intervalle, INTERVALLE_MIN_ANIMATION)
+
+    commande = [
+        'ffmpeg', '-y', '-hide_banner', '-loglevel', 'error',
+        '-f', 'rawvideo', '-pix_fmt', 'rgba', '-s', f"{largeur}x{hauteur}",
+        '-framerate', f"{1000 / intervalle:.4f}", '-i', 'pipe:0',
+        *CODECS_GIF_FFMPEG[format], output_path
+    ]
+    with tempfile.TemporaryFile(mode='w+') as erreurs:
+        processus = subprocess.Popen(commande, stdin=subprocess.PIPE, stderr=erreurs)
+        try:
+            # Fréquence constante pour ffmpeg : une frame plus longue que l'intervalle est répétée ; seule
+            # une frame plus courte que INTERVALLE_MIN_ANIMATION peut être sautée, sans dériver par
+            # rapport aux durées du GIF.
+            temps = 0
+            for donnees, _, duree in itertools.chain([premiere], frames):
+                repetitions = round((temps + duree) / intervalle) - round(temps / intervalle)
+                temps += duree
+                for _ in range(repetitions):
+                    processus.stdin.write(donnees)
+            processus.stdin.close()
+        except BrokenPipeError:
+            pass
+        processus.wait()
+
+        if processus.returncode != 0:
+            erreurs.seek(0)
+            raise ErreurConversion(erreurs.read()[-500:].strip() or f"ffmpeg a retourné {processus.returncode}")
+
+def moteur_gif(input_path, output_path, format='png', largeur=None, couleurs=None, fenetre=None, pool=None):
+    """Convertit un GIF (toutes ses frames) vers `format` (voir FORMATS_GIF) dans `output_path`."""
+    if format in CODECS_GIF_FFMPEG:
+        _encoder_frames_ffmpeg(iterer_frames_gif(input_path, largeur, couleurs, fenetre=fenetre, pool=pool),
+                               output_path, format, inspecter_gif(input_path)['intervalle'])
+        return
+
+    if format == 'png':
+        indices = [0] # Comme avant : uniquement la première image
+    else:
+        # Planche de sprites : au plus GIF_SPRITE_MAX_FRAMES frames réparties sur toute l'animation
+        total = inspecter_gif(input_path)['frames'] or 1
+        nombre = min(total, app.config['GIF_SPRITE_MAX_FRAMES'])
+        indices = sorted({i * total // nombre for i in range(nombre)})
+
+    colonnes = min(len(indices), 10)
+    planche = None
+    for position, (donnees, taille, _) in enumerate(iterer_frames_gif(input_path, largeur, couleurs, indices, fenetre, pool)):
+        if planche is None:
+            lignes = -(-len(indices) // colonnes)
+            planche = Image.new('RGBA', (taille[0] * colonnes, taille[1] * lignes))
+        x, y = position % colonnes, position // colonnes
+        planche.paste(Image.frombytes('RGBA', taille, donnees), (x * taille[0], y * taille[1]))
+    hors_boucle(planche.save, output_path, 'PNG')
+
+# --- Miniatures et posters (cache disque LRU) ---
+
+# Taille demandée -> boîte (largeur, hauteur) dans laquelle l'image est réduite
+TAILLES_MINIATURES = {'s': (160, 100), 'm': (320, 180), 'l': (640, 360)}
+VERSION_MINIATURES = 1 # À incrémenter si le rendu change : les ETag changent avec le nom
+UN_AN = 365 * 24 * 3600
+EXTENSIONS_VIDEO = {'mp4'}
+
+class CacheDisqueLRU:
+    """
+    Dossier de fichiers borné en taille : au-delà de `taille_max`, les fichiers les moins
+    récemment servis sont supprimés. L'ordre LRU est gardé en mémoire et reconstruit au démarrage
+    à partir des dates de modification (mises à jour à chaque lecture).
+    """
+
+    def __init__(self, dossier, taille_max):
+        self.dossier = dossier
+        self.taille_max = taille_max
+        self._index = None # OrderedDict nom -> taille, du moins au plus récemment utilisé
+        self._taille = 0
+        self._lock = threading.Lock()
+
+    def _charger(self):
+        if self._index is not None:
+            return
+        os.makedirs(self.dossier, exist_ok=True)
+        entrees = sorted(
+            (entree.stat().st_mtime, entree.name, entree.stat().st_size)
+            for entree in os.scandir(self.dossier) if entree.is_file() and not entree.name.startswith('.')
+        )
+        self._index = collections.OrderedDict((nom, taille) for _, nom, taille in entrees)
+        self._taille = sum(self._index.values())
+
+    def _evincer(self):
+        while self._taille > self.taille_max and len(self._index) > 1:
+            nom, taille = self._index.popitem(last=False)
+            self._taille -= taille
+            try:
+                os.remove(os.path.join(self.dossier, nom))
+            except FileNotFoundError:
+                pass
+
+    def lire(self, nom):
+        """Chemin du fichier s'il est en cache (et le marque comme récent), sinon None."""
+        chemin = os.path.join(self.dossier, nom)
+        with self._lock:
+            self._charger()
+            if not os.path.exists(chemin):
+                # Évincé entre-temps (éventuellement par un autre processus)
+                self._taille -= self._index.pop(nom, 0)
+                return None
+            if nom not in self._index:
+                # Écrit par un autre processus
+                self._index[nom] = os.path.getsize(chemin)
+                self._taille += self._index[nom]
+            self._index.move_to_end(nom)
+        try:
+            os.utime(chemin)
+        except OSError:
+            pass
+        return chemin
+
+    def ecrire(self, nom, donnees):
+        """Écrit le fichier de façon atomique puis évince les plus anciens si besoin."""
+        chemin = os.path.join(self.dossier, nom)
+        with self._lock:
+            self._charger()
+            tmp_path = f"{chemin}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(donnees)
+            os.replace(tmp_path, chemin)
+            self._taille += len(donnees) - self._index.pop(nom, 0)
+            self._index[nom] = len(donnees)
+            self._evincer()
+        return chemin
+
+cache_miniatures = CacheDisqueLRU(app.config['THUMBNAIL_FOLDER'], app.config['THUMBNAIL_CACHE_MAX_BYTES'])
+
+def nom_miniature(digest, taille):
+    return f"{digest}_{taille}_v{VERSION_MINIATURES}.jpg"
+
+def _poster_video(chemin):
+    """Extrait une image vers 10 % de la vidéo (au plus à 5 s) avec ffmpeg."""
+    duree = sonder_duree(chemin)
+    instant = min(duree * 0.1, 5.0) if duree else 0
+    largeur_max = max(l for l, _ in TAILLES_MINIATURES.values())
+    resultat = subprocess.run(
+        ['ffmpeg', '-nostdin', '-hide_banner', '-loglevel', 'error', '-ss', f"{instant:.2f}", '-i', chemin,
+         '-frames:v', '1', '-vf', f"scale='min({largeur_max},iw)':-2", '-f', 'image2pipe', '-c:v', 'png', 'pipe:1'],
+        capture_output=True, timeout=60
+    )
+    if resultat.returncode != 0 or not resultat.stdout:
+        raise ErreurConversion(resultat.stderr.decode(errors='replace')[-500:].strip() or "Aucune image extraite.")
+    return Image.open(io.BytesIO(resultat.stdout))
+
+def generer_miniatures(filename, tailles=None):
+    """Génère les miniatures JPEG d'un fichier converti (poster ffmpeg pour les vidéos, Pillow sinon)."""
+    digest = digest_public(filename)
+    ext = filename.rsplit('.', 1)[-1]
+
+    video = ext in EXTENSIONS_VIDEO
+    with (stockage.source_ffmpeg if video else stockage.fichier_local)(cle_blob(digest)) as chemin:
+        source = _poster_video(chemin) if video else Image.open(chemin)
+        with source:
+            vignettes = hors_boucle(_encoder_miniatures, source, tailles or list(TAILLES_MINIATURES))
+
+    for taille, donnees in vignettes.items():
+        cache_miniatures.ecrire(nom_miniature(digest, taille), donnees)
+
+def _encoder_miniatures(source, tailles):
+    """Pillow seul (voir hors_boucle) : {taille: JPEG}."""
+    # La transparence est aplatie sur le fond des vignettes de la page
+    image = Image.new('RGB', source.size, (48, 48, 48))
+    rgba = source.convert('RGBA')
+    image.paste(rgba, mask=rgba)
+
+    vignettes = {}
+    for taille in tailles:
+        miniature = image.copy()
+        miniature.thumbnail(TAILLES_MINIATURES[taille], Image.Resampling.LANCZOS)
+        tampon = io.BytesIO()
+        miniature.save(tampon, 'JPEG', quality=82, optimize=True, progressive=True)
+        vignettes[taille] = tampon.getvalue()
+    return vignettes
+
+def generer_miniatures_sans_erreur(filename):
+    """Appelée juste après une conversion : une miniature ratée ne doit pas faire échouer la conversion."""
+    try:
+        generer_miniatures(filename)
+    except Exception as e:
+        print(f"Miniatures de {filename} non générées: {e}")
+
+def convertir_gif(input_digest, user, format='png', largeur=None, couleurs=None):
+    """Convertit le GIF (blob `input_digest`) vers `format`, libère le GIF et retourne le nom du résultat."""
+    ext, libelle = FORMATS_GIF[format]
+    params = {'format': format, 'largeur': largeur, 'couleurs': couleurs}
+
+    def produire(input_path, output_path):
+        moteur_gif(input_path, output_path, format, largeur, couleurs)
+
+    try:
+        output_filename = convertir_avec_cache(input_digest, 'gif', params, ext, produire)
+    finally:
+        # Le GIF original n'est plus utile, que la conversion ait réussi ou non
+        liberer_blob(input_digest)
+
+    generer_miniatures_sans_erreur(output_filename)
+    db.session.add(ConvertedImage(user_id=user.id, filename=output_filename, format=libelle))
+    db.session.commit()
+    incrementer_version('images')
+    return output_filename
+
+# --- Conversion d'images par lots : pool Pillow, progression par Socket.IO, zip produit au fil de l'eau ---
+
+# format demandé -> (format Pillow, extension) ; seuls ceux que ce Pillow sait écrire sont proposés
+_FORMATS_IMAGE = {'png': ('PNG', 'png'), 'jpeg': ('JPEG', 'jpg'), 'webp': ('WEBP', 'webp'), 'avif': ('AVIF', 'avif')}
+Image.init()
+FORMATS_IMAGE = {nom: valeur for nom, valeur in _FORMATS_IMAGE.items() if valeur[0] in Image.SAVE}
+
+def options_images(valeurs):
+    """Valide les options du lot ; retourne (format, qualité, largeur) ou lève ValueError."""
+    format = valeurs.get('format') or 'webp'
+    if format not in FORMATS_IMAGE:
+        raise ValueError("Format de sortie non disponible.")
+    try:
+        qualite = int(valeurs.get('quality') or 85)
+        largeur = int(valeurs['width']) if valeurs.get('width') else None
+    except (TypeError, ValueError):
+        raise ValueError("Qualité ou largeur invalide.")
+    if not 1 <= qualite <= 100:
+        raise ValueError("La qualité doit être comprise entre 1 et 100.")
+    if largeur is not None and not 16 <= largeur <= 8192:
+        raise ValueError("La largeur doit être comprise entre 16 et 8192 pixels.")
+    return format, qualite, largeur
+
+def _convertir_image(donnees, format, qualite, largeur, max_pixels):
+    """
+    Exécutée dans le pool : décode une image (première frame si animée), applique l'orientation EXIF,
+    redimensionne et l'encode. Les dimensions sont vérifiées sur l'en-tête avant tout décodage.
+    """
+    try:
+        img = Image.open(io.BytesIO(donnees))
+    except UnidentifiedImageError:
+        raise ValueError("format d'image non reconnu")
+    if img.width * img.height > max_pixels:
+        raise ValueError(f"image trop grande ({img.width}x{img.height})")
+    img = ImageOps.exif_transpose(img)
+    if largeur and img.width > largeur:
+        img = img.resize((largeur, max(1, round(img.height * largeur / img.width))), Image.Resampling.LANCZOS)
+
+    format_pillow, _ = FORMATS_IMAGE[format]
+    options = {'quality': qualite}
+    if format_pillow == 'JPEG':
+        if img.mode in ('RGBA', 'LA', 'P'):
+            # Pas de transparence en JPEG : fond blanc
+            img = img.convert('RGBA')
+            fond = Image.new('RGB', img.size, (255, 255, 255))
+            fond.paste(img, mask=img.getchannel('A'))
+            img = fond
+        img = img.convert('RGB')
+        options.update(optimize=True, progressive=True)
+    elif format_pillow == 'PNG':
+        options = {'optimize': True} # Sans perte : la qualité ne s'applique pas
+    elif img.mode not in ('RGB', 'RGBA'):
+        img = img.convert('RGBA' if 'transparency' in img.info or img.mode in ('LA', 'PA') else 'RGB')
+    sortie = io.BytesIO()
+    img.save(sortie, format_pillow, **options)
+    return sortie.getvalue()
+
+def lire_fichiers_lot(fichiers, pile):
+    """
+    [(nom, taille, lire), ...] des images envoyées : fichiers directs ou contenu d'archives zip. Rien n'est lu
+    en mémoire ici : chaque envoi est copié dans un fichier temporaire (qui survit à la requête pendant que la
+    réponse est produite), et `lire()` retourne les octets d'une image au moment de la convertir.
+    Les fichiers temporaires et archives ouvertes sont confiés à `pile` (contextlib.ExitStack).
+    Les limites de nombre et de taille sont vérifiées sur l'index du zip, avant toute décompression.
+    """
+    elements, total = [], 0
+
+    def ajouter(nom, taille, lire):
+        nonlocal total
+        total += taille
+        if len(elements) >= app.config['BATCH_MAX_FILES']:
+            raise FichierRefuse(f"Au plus {app.config['BATCH_MAX_FILES']} fichiers par lot.")
+        if total > app.config['BATCH_MAX_BYTES']:
+            raise FichierRefuse("Lot trop volumineux.")
+        elements.append((nom, taille, lire))
+
+    def lire_membre(archive, info):
+        try:
+            return archive.read(info)
+        except (zipfile.BadZipFile, zlib.error, EOFError):
+            # Erreur de CRC ou données tronquées : seul ce fichier du lot échoue
+            raise FichierRefuse(f"Fichier corrompu dans l'archive : {info.filename}")
+
+    def lire_fichier(copie):
+        copie.seek(0)
+        return copie.read()
+
+    for fichier in fichiers:
+        copie = pile.enter_context(tempfile.TemporaryFile(dir=_dossier_tmp_blobs()))
+        shutil.copyfileobj(fichier.stream, copie, TAILLE_BUFFER_HASH)
+        copie.seek(0)
+        if copie.read(4) == b'PK\x03\x04':
+            copie.seek(0)
+            try:
+                archive = pile.enter_context(zipfile.ZipFile(copie))
+            except zipfile.BadZipFile:
+                raise FichierRefuse(f"Archive zip illisible : {fichier.filename}")
+            for info in archive.infolist():
+                nom = os.path.basename(info.filename)
+                if info.is_dir() or not nom or nom.startswith('.') or '__MACOSX' in info.filename:
+                    continue
+                ajouter(nom, info.file_size, lambda archive=archive, info=info: lire_membre(archive, info))
+        else:
+            ajouter(secure_filename(fichier.filename) or 'image', copie.seek(0, os.SEEK_END),
+                    lambda copie=copie: lire_fichier(copie))
+    if not elements:
+        raise FichierRefuse("Aucun fichier à convertir.")
+    return elements
+
+class _FluxZip:
+    """Destination non adressable de zipfile : les octets écrits sont repris au fur et à mesure."""
+
+    def __init__(self):
+        self._morceaux = []
+
+    def write(self, donnees):
+        self._morceaux.append(bytes(donnees))
+        return len(donnees)
+
+    def flush(self):
+        pass
+
+    def vider(self):
+        donnees = b''.join(self._morceaux)
+        self._morceaux.clear()
+        return donnees
+
+def convertir_lot(elements, format, qualite, largeur, on_fichier=None):
+    """
+    Générateur des octets d'un zip contenant les images converties, produit pendant la conversion :
+    chaque image est lue (voir lire_fichiers_lot) au moment de sa soumission au pool et ajoutée dès qu'elle
+    est prête (ordre d'achèvement) : au plus 2 × GIF_WORKERS images sont en mémoire à la fois. `on_fichier(index, nom, erreur)` est appelée après chacune.
+    Les échecs sont listés dans ERREURS.txt à la fin de l'archive.
+    """
+    _, ext = FORMATS_IMAGE[format]
+    pool = pool_gif()
+    fenetre = 2 * app.config['GIF_WORKERS']
+    max_pixels = app.config['IMAGE_MAX_PIXELS']
+    flux = _FluxZip()
+    noms, erreurs = set(), []
+
+    def nom_sortie(nom):
+        base = os.path.splitext(nom)[0] or 'image'
+        candidat, n = f"{base}.{ext}", 1
+        while candidat in noms:
+            n += 1
+            candidat = f"{base}_{n}.{ext}"
+        noms.add(candidat)
+        return candidat
+
+    # Les images sont déjà compressées : ZIP_STORED évite de payer une deuxième compression pour rien
+    with zipfile.ZipFile(flux, 'w', zipfile.ZIP_STORED) as archive:
+        en_cours = {}
+        restants = iter(enumerate(elements))
+        while True:
+            for index, (nom, taille, lire) in itertools.islice(restants, fenetre - len(en_cours)):
+                future = concurrent.futures.Future()
+                try:
+                    future = pool.submit(_convertir_image, lire(), format, qualite, largeur, max_pixels)
+                except FichierRefuse as e:
+                    future.set_exception(e) # Traité comme un échec de conversion de ce fichier
+                en_cours[future] = (index, nom, taille, time.perf_counter())
+            if not en_cours:
+                break
+            termines, _ = concurrent.futures.wait(en_cours, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in termines:
+                index, nom, taille_entree, debut = en_cours.pop(future)
+                try:
+                    resultat = future.result()
+                    # Durée depuis la soumission au pool (attente d'un processus libre comprise)
+                    observer_conversion('image', time.perf_counter() - debut, taille_entree, len(resultat))
+                    archive.writestr(nom_sortie(nom), resultat)
+                    erreur = None
+                except Exception as e:
+                    conversions.inc(converter='image', result='echec')
+                    erreur = str(e) or e.__class__.__name__
+                    erreurs.append(f"{nom} : {erreur}")
+                if on_fichier:
+                    on_fichier(index, nom, erreur)
+            yield flux.vider()
+        if erreurs:
+            archive.writestr('ERREURS.txt', '\n'.join(erreurs) + '\n')
+    yield flux.vider()
+
+# --- Envoi des fichiers convertis : ETag, plages d'octets, zéro-copie ---
+
+def _lire_plage(chemin, debut, longueur, taille_bloc=64 * 1024):
+    """Corps d'une réponse partielle quand le serveur WSGI ne sait pas limiter un file_wrapper."""
+    with open(chemin, 'rb') as f:
+        f.seek(debut)
+        while longueur > 0:
+            bloc = f.read(min(taille_bloc, longueur))
+            if not bloc:
+                break
+            longueur -= len(bloc)
+            yield bloc
+
+def servir_media(filename, as_attachment=False):
+    """
+    Réponse pour un fichier converti. L'ETag est l'empreinte du contenu (le nom des blobs), d'où
+    des 304 sans lire le disque et un cache navigateur d'un an. Une plage `Range: bytes=...` donne
+    une réponse 206, ce qui permet de se déplacer dans une vidéo sans la retélécharger.
+    Avec un stockage objet, le client est redirigé vers une URL présignée : le service gère alors
+    lui-même plages, ETag et envoi, et aucun octet ne passe par le worker.
+    """
+    digest = digest_public(filename)
+    if digest and stockage.url_directes:
+        reponse = redirect(stockage.url_signee(cle_blob(digest), filename if as_attachment else None,
+                                               mimetypes.guess_type(filename)[0]))
+        reponse.cache_control.private = True
+        reponse.cache_control.max_age = app.config['S3_URL_EXPIRES'] // 2 # L'URL reste valide au moins autant
+        return reponse
+
+    dossier, nom = chemin_media(filename)
+    chemin = safe_join(dossier, nom)
+    if chemin is None or not os.path.isfile(chemin):
+        abort(404)
+    taille = os.path.getsize(chemin)
+    # Anciens fichiers (nom non dérivé du contenu) : ETag tiré de la date de modification et de la taille
+    etag = digest or f"{int(os.path.getmtime(chemin))}-{taille}"
+
+    reponse = app.response_class(mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream',
+                                 direct_passthrough=True)
+    reponse.set_etag(etag)
+    reponse.accept_ranges = 'bytes'
+    if digest:
+        reponse.cache_control.public = True
+        reponse.cache_control.max_age = UN_AN
+        reponse.cache_control.immutable = True
+    else:
+        reponse.cache_control.no_cache = True
+    if as_attachment:
+        reponse.headers.set('Content-Disposition', 'attachment', filename=filename)
+
+    if request.if_none_match.contains(etag):
+        reponse.status_code = 304
+        return reponse
+
+    # Le proxy envoie les octets (et gère lui-même les plages) : le worker ne fait que les en-têtes
+    mode = app.config['MEDIA_SENDFILE_MODE']
+    if mode == 'x-accel':
+        relatif = os.path.relpath(chemin, app.config['CONVERTED_FOLDER']).replace(os.sep, '/')
+        reponse.headers['X-Accel-Redirect'] = app.config['MEDIA_ACCEL_PREFIX'] + relatif
+        return reponse
+    if mode == 'x-sendfile':
+        reponse.headers['X-Sendfile'] = os.path.abspath(chemin)
+        return reponse
+
+    debut, longueur = 0, taille
+    plage = request.range
+    # If-Range : la plage n'est honorée que si le client parle bien de ce contenu-ci
+    if_range = request.if_range
+    plage_valide = (not if_range.etag and not if_range.date) or if_range.etag == etag
+    if plage and plage_valide and plage.units == 'bytes' and len(plage.ranges) == 1:
+        bornes = plage.range_for_length(taille)
+        if bornes is None:
+            reponse.status_code = 416
+            reponse.headers['Content-Range'] = f"bytes */{taille}"
+            return reponse
+        debut, fin = bornes
+        longueur = fin - debut
+        reponse.status_code = 206
+        reponse.headers['Content-Range'] = f"bytes {debut}-{fin - 1}/{taille}"
+
+    reponse.content_length = longueur
+    if longueur == taille or 'gunicorn' in request.environ.get('SERVER_SOFTWARE', ''):
+        # gunicorn envoie le file_wrapper par sendfile() depuis la position courante, jusqu'à Content-Length
+        f = open(chemin, 'rb')
+        f.seek(debut)
+        reponse.response = wrap_file(request.environ, f)
+    else:
+        reponse.response = _lire_plage(chemin, debut, longueur)
+    return reponse
+
+# --- Cycle de vie du stockage : quotas, expiration et balayage (réconciliation disque <-> base) ---
+
+LOT_BALAYAGE = 500 # Lignes traitées par requête de balayage (une passe peut en enchaîner plusieurs)
+
+class QuotaDepasse(FichierRefuse):
+    """Le fichier ferait dépasser un quota de stockage (utilisateur, global) ou l'espace disque à garder libre."""
+
+def _en_mo(octets):
+    mo = octets / 1024 / 1024
+    return f"{mo:.0f} Mo" if mo >= 10 else f"{mo:.1f} Mo"
+
+def _octets_blobs(modele, colonne, *filtres):
+    """Sous-requête : taille cumulée des blobs désignés par `colonne` (empreinte ou nom public `<empreinte>.<ext>`)."""
+    return db.select(func.coalesce(func.sum(Blob.size), 0)).select_from(modele) \
+        .join(Blob, Blob.digest == func.substr(colonne, 1, 64)).where(*filtres).scalar_subquery()
+
+def espace_utilise(user_id):
+    """
+    Octets imputés à l'utilisateur (une seule requête) : vidéos et images publiées, sources en attente
+    de conversion et uploads par morceaux en cours (taille annoncée). Un fichier dédupliqué compte pour chacun.
+    """
+    return db.session.query(
+        _octets_blobs(Video, Video.converted_filename, Video.user_id == user_id)
+        + _octets_blobs(ConvertedImage, ConvertedImage.filename, ConvertedImage.user_id == user_id)
+        + _octets_blobs(ConversionJob, ConversionJob.input_digest, ConversionJob.user_id == user_id,
+                        ConversionJob.status.in_(('queued', 'running')))
+        + db.select(func.coalesce(func.sum(UploadSession.size), 0))
+            .where(UploadSession.user_id == user_id).scalar_subquery()
+    ).scalar()
+
+def espace_total():
+    """Octets de tout le stockage : blobs, plus les uploads par morceaux en cours (taille annoncée)."""
+    return db.session.query(
+        db.select(func.coalesce(func.sum(Blob.size), 0)).scalar_subquery()
+        + db.select(func.coalesce(func.sum(UploadSession.size), 0)).scalar_subquery()
+    ).scalar()
+
+def verifier_quota(user_id, taille):
+    """Lève QuotaDepasse si `taille` octets de plus dépassaient un quota ou entamaient l'espace disque à garder libre."""
+    quota = app.config['QUOTA_USER_BYTES']
+    if quota:
+        utilise = espace_utilise(user_id)
+        if utilise + taille > quota:
+            raise QuotaDepasse(f"Quota de stockage dépassé ({_en_mo(utilise)} utilisés sur {_en_mo(quota)}).")
+    if app.config['STORAGE_MAX_BYTES'] and espace_total() + taille > app.config['STORAGE_MAX_BYTES']:
+        raise QuotaDepasse("Le stockage du site est plein, réessayez plus tard.")
+    libre = stockage.espace_libre()
+    if libre is not None and libre - taille < app.config['STORAGE_MIN_FREE_BYTES']:
+        raise QuotaDepasse("Espace disque insuffisant sur le serveur, réessayez plus tard.")
+
+def liberer_media(filename):
+    """Libère le fichier d'une vidéo ou d'une image supprimée : blob, ou ancien fichier à la racine de converted/."""
+    digest = digest_public(filename)
+    if digest:
+        liberer_blob(digest)
+        return
+    chemin = safe_join(app.config['CONVERTED_FOLDER'], filename)
+    if chemin and os.path.isfile(chemin):
+        os.remove(chemin)
+
+def expirer_contenus():
+    """Supprime les vidéos et images plus vieilles que MEDIA_TTL_DAYS et les entrées de cache de conversion périmées."""
+    maintenant = datetime.datetime.utcnow()
+    stats = {'videos_expirees': 0, 'images_expirees': 0, 'cache_expire': 0}
+
+    # Chaque ligne est supprimée par un DELETE conditionnel : si deux balayages se croisent,
+    # seul celui qui a effectivement supprimé la ligne libère la référence sur le fichier.
+    if app.config['MEDIA_TTL_DAYS']:
+        limite = maintenant - datetime.timedelta(days=app.config['MEDIA_TTL_DAYS'])
+        while lot := db.session.query(Video.id, Video.job_id, Video.converted_filename).filter(
+                Video.created_at < limite, Video.status.in_(('done', 'failed'))).limit(LOT_BALAYAGE).all():
+            for video_id, job_id, filename in lot:
+                if Video.query.filter_by(id=video_id).delete(synchronize_session=False):
+                    ConversionJob.query.filter_by(id=job_id).delete(synchronize_session=False)
+                    db.session.commit()
+                    stats['videos_expirees'] += 1
+                    if filename:
+                        liberer_media(filename)
+        while lot := db.session.query(ConvertedImage.id, ConvertedImage.filename).filter(
+                ConvertedImage.created_at < limite).limit(LOT_BALAYAGE).all():
+            for image_id, filename in lot:
+                if ConvertedImage.query.filter_by(id=image_id).delete(synchronize_session=False):
+                    db.session.commit()
+                    stats['images_expirees'] += 1
+                    liberer_media(filename)
+
+    if app.config['CONVERSION_CACHE_TTL_DAYS']:
+        limite = maintenant - datetime.timedelta(days=app.config['CONVERSION_CACHE_TTL_DAYS'])
+        stats['cache_expire'] = _evincer_cache_conversion(ConversionCache.created_at < limite)
+
+    if stats['videos_expirees']:
+        incrementer_version('videos')
+    if stats['images_expirees']:
+        incrementer_version('images')
+    return stats
+
+def _evincer_cache_conversion(filtre, limite=None):
+    """Supprime les entrées du cache de conversion (les plus anciennes d'abord) et libère leur résultat."""
+    evincees = 0
+    while limite is None or evincees < limite:
+        lot = db.session.query(ConversionCache.key, ConversionCache.output_digest).filter(filtre) \
+            .order_by(ConversionCache.created_at).limit(min(LOT_BALAYAGE, (limite or LOT_BALAYAGE) - evincees)).all()
+        if not lot:
+            break
+        for cle, output_digest in lot:
+            if ConversionCache.query.filter_by(key=cle).delete(synchronize_session=False):
+                db.session.commit()
+                evincees += 1
+                liberer_blob(output_digest)
+    return evincees
+
+def _supprimer_chemin(chemin):
+    if os.path.isdir(chemin) and not os.path.islink(chemin):
+        shutil.rmtree(chemin, ignore_errors=True)
+    else:
+        try:
+            os.remove(chemin)
+        except FileNotFoundError:
+            pass
+
+def _entrees_anciennes(dossier, limite, ignorer=()):
+    """Entrées (fichiers ou dossiers) de `dossier` non modifiées depuis le timestamp `limite`."""
+    try:
+        with os.scandir(dossier) as entrees:
+            entrees = [e for e in entrees if e.name not in ignorer]
+    except FileNotFoundError:
+        return []
+    anciennes = []
+    for entree in entrees:
+        try:
+            if entree.stat(follow_symlinks=False).st_mtime < limite:
+                anciennes.append(entree)
+        except FileNotFoundError:
+            pass
+    return anciennes
+
+def _empreintes_connues(digests):
+    """Sous-ensemble de `digests` ayant une ligne Blob (requêtes IN par lots)."""
+    digests = list(digests)
+    connues = set()
+    for i in range(0, len(digests), LOT_BALAYAGE):
+        connues.update(d for (d,) in db.session.query(Blob.digest).filter(Blob.digest.in_(digests[i:i + LOT_BALAYAGE])))
+    return connues
+
+def _nettoyer_uploads(limite):
+    """Sessions d'upload par morceaux abandonnées, puis fichiers de uploads/ n'appartenant à aucune session."""
+    stats = {'uploads_abandonnes': 0, 'orphelins_uploads': 0}
+    perime = datetime.datetime.utcnow() - datetime.timedelta(seconds=app.config['UPLOAD_SESSION_TTL'])
+    while lot := db.session.query(UploadSession.id, UploadSession.storage_ref) \
+            .filter(UploadSession.updated_at < perime).limit(LOT_BALAYAGE).all():
+        for upload_id, ref in lot:
+            # Condition répétée : un morceau reçu entre-temps rend la session à nouveau active
+            if UploadSession.query.filter(UploadSession.id == upload_id, UploadSession.updated_at < perime) \
+                    .delete(synchronize_session=False):
+                db.session.commit()
+                _empreintes_uploads.pop(upload_id, None)
+                stockage.annuler_envoi(upload_id, ref)
+                stats['uploads_abandonnes'] += 1
+
+    # Fichiers .part sans session, et fichiers laissés par les anciennes versions (conversions échouées)
+    anciennes = _entrees_anciennes(app.config['UPLOAD_FOLDER'], limite)
+    ids = [e.name[:-len('.part')] for e in anciennes if e.name.endswith('.part')]
+    actives = set()
+    for i in range(0, len(ids), LOT_BALAYAGE):
+        actives.update(u for (u,) in db.session.query(UploadSession.id).filter(UploadSession.id.in_(ids[i:i + LOT_BALAYAGE])))
+    for entree in anciennes:
+        if entree.name.endswith('.part') and entree.name[:-len('.part')] in actives:
+            continue
+        _supprimer_chemin(entree.path)
+        stats['orphelins_uploads'] += 1
+    return stats
+
+def _empreintes_en_base():
+    """Toutes les empreintes de la table Blob, par ordre croissant, lues par lots."""
+    dernier = ''
+    while lot := [d for (d,) in db.session.query(Blob.digest).filter(Blob.digest > dernier)
+                  .order_by(Blob.digest).limit(LOT_BALAYAGE)]:
+        yield from lot
+        dernier = lot[-1]
+
+def _nettoyer_blobs(limite):
+    """
+    Fichiers temporaires abandonnés, blobs et segments HLS sans ligne Blob, uploads assemblés mais jamais rangés,
+    et blobs enregistrés mais absents du stockage (signalés seulement : convertir_avec_cache recalcule ces résultats).
+    """
+    stats = {'temporaires': 0, 'orphelins_blobs': 0, 'orphelins_hls': 0, 'envois_orphelins': 0, 'blobs_manquants': 0}
+    for entree in _entrees_anciennes(_dossier_tmp_blobs(), limite):
+        _supprimer_chemin(entree.path)
+        stats['temporaires'] += 1
+
+    # Fusion de deux listes triées par empreinte (stockage et table Blob) : mémoire constante
+    en_base = _empreintes_en_base()
+    attendu = next(en_base, None)
+    for cle, mtime in stockage.lister('blobs/'):
+        digest = cle.rsplit('/', 1)[-1]
+        if cle != cle_blob(digest) or not digest_public(f"{digest}.bin"):
+            continue # Espace de travail (blobs/tmp) en stockage local
+        while attendu is not None and attendu < digest:
+            stats['blobs_manquants'] += 1
+            attendu = next(en_base, None)
+        if attendu == digest:
+            attendu = next(en_base, None)
+        elif mtime < limite:
+            stockage.supprimer(cle)
+            stats['orphelins_blobs'] += 1
+    stats['blobs_manquants'] += (attendu is not None) + sum(1 for _ in en_base)
+
+    # Segments HLS : un dossier par MP4 ; supprimé si le MP4 n'existe plus et que rien n'y a été écrit récemment
+    recents = {}
+    for cle, mtime in stockage.lister('hls/'):
+        parties = cle.split('/')
+        if len(parties) > 3:
+            recents[parties[2]] = recents.get(parties[2], False) or mtime >= limite
+    digests = [d for d, recent in recents.items() if not recent]
+    for i in range(0, len(digests), LOT_BALAYAGE):
+        lot = digests[i:i + LOT_BALAYAGE]
+        for digest in set(lot) - _empreintes_connues(lot):
+            stockage.supprimer_prefixe(cle_hls(digest))
+            cache_hls.pop(digest)
+            stats['orphelins_hls'] += 1
+
+    # Uploads par morceaux assemblés puis interrompus avant d'être rangés sous leur empreinte
+    for cle, mtime in stockage.lister('envois/'):
+        if mtime < limite:
+            stockage.supprimer(cle)
+            stats['envois_orphelins'] += 1
+    return stats
+
+def rapatrier_fichier_historique(nom):
+    """
+    Range un fichier converti par une ancienne version (nom aléatoire à la racine de converted/) dans le
+    stockage adressé par contenu, et renomme les vidéos/images qui le désignent. Retourne le nouveau nom.
+    """
+    chemin = os.path.join(app.config['CONVERTED_FOLDER'], nom)
+    digest, taille = hacher_fichier(chemin)
+    ext = nom.rsplit('.', 1)[-1].lower() if '.' in nom else 'bin'
+    nouveau = f"{digest}.{ext}"
+    if not stockage.existe(cle_blob(digest)):
+        # Lien dur (ou copie) importé : l'ancien nom reste valide tant que la base n'est pas à jour
+        tmp_path = os.path.join(_dossier_tmp_blobs(), f"{digest}.{os.getpid()}")
+        try:
+            os.link(chemin, tmp_path)
+        except OSError:
+            shutil.copyfile(chemin, tmp_path)
+        stockage.importer(cle_blob(digest), tmp_path)
+
+    references = Video.query.filter_by(converted_filename=nom).update({'converted_filename': nouveau}, synchronize_session=False)
+    references += ConvertedImage.query.filter_by(filename=nom).update({'filename': nouveau}, synchronize_session=False)
+    ConversionJob.query.filter_by(output_filename=nom).update({'output_filename': nouveau}, synchronize_session=False)
+    if not references:
+        db.session.rollback() # Déjà rapatrié par un autre balayage, ou plus référencé
+        return None
+    retenir_blob(digest, taille, references) # Même transaction que les renommages
+    _supprimer_chemin(chemin)
+    return nouveau
+
+def _ranger_fichiers_historiques(limite):
+    """Anciens fichiers à la racine de converted/ : rangés dans le stockage s'ils sont publiés, supprimés sinon."""
+    stats = {'rapatries': 0, 'orphelins_convertis': 0}
+    reserves = {os.path.basename(app.config[cle]) for cle in ('BLOB_FOLDER', 'THUMBNAIL_FOLDER', 'HLS_FOLDER')}
+    try:
+        with os.scandir(app.config['CONVERTED_FOLDER']) as entrees:
+            fichiers = [e.name for e in entrees if e.is_file(follow_symlinks=False) and e.name not in reserves
+                        and not e.name.startswith('.')]
+    except FileNotFoundError:
+        return stats
+
+    for i in range(0, len(fichiers), LOT_BALAYAGE):
+        noms = fichiers[i:i + LOT_BALAYAGE]
+        publies = {n for (n,) in db.session.query(Video.converted_filename).filter(Video.converted_filename.in_(noms))}
+        publies.update(n for (n,) in db.session.query(ConvertedImage.filename).filter(ConvertedImage.filename.in_(noms)))
+        for nom in noms:
+            chemin = os.path.join(app.config['CONVERTED_FOLDER'], nom)
+            if nom in publies:
+                try:
+                    if rapatrier_fichier_historique(nom):
+                        stats['rapatries'] += 1
+                except FileNotFoundError:
+                    db.session.rollback()
+            elif os.path.exists(chemin) and os.path.getmtime(chemin) < limite:
+                _supprimer_chemin(chemin)
+                stats['orphelins_convertis'] += 1
+    if stats['rapatries']:
+        incrementer_version('videos')
+        incrementer_version('images')
+    return stats
+
+def balayer_stockage():
+    """
+    Une passe complète du cycle de vie : expirations, réconciliation du disque avec la base, puis éviction
+    du cache de conversion si le stockage dépasse STORAGE_MAX_BYTES. Retourne le nombre d'éléments traités
+    par catégorie, ou None si un autre processus est déjà en train de balayer.
+    """
+    os.makedirs(app.config['CONVERTED_FOLDER'], exist_ok=True)
+    with open(os.path.join(app.config['CONVERTED_FOLDER'], '.balayage.lock'), 'w') as verrou:
+        try:
+            fcntl.flock(verrou, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return None
+
+        limite = time.time() - app.config['STORAGE_GRACE_SECONDS']
+        stats = expirer_contenus()
+        stats.update(_nettoyer_uploads(limite))
+        stats.update(_nettoyer_blobs(limite))
+        stats.update(_ranger_fichiers_historiques(limite))
+        MediaProbe.query.filter(~db.exists().where(Blob.digest == MediaProbe.digest)) \
+            .delete(synchronize_session=False) # Sondages de sources déjà converties et libérées
+        db.session.commit()
+
+        stats['cache_evince'] = 0
+        while app.config['STORAGE_MAX_BYTES'] and espace_total() > app.config['STORAGE_MAX_BYTES']:
+            evincees = _evincer_cache_conversion(db.true(), limite=LOT_BALAYAGE // 5)
+            if not evincees:
+                break
+            stats['cache_evince'] += evincees
+        return stats
+
+# --- Gabarits compilés une seule fois et cache de fragments ---
+
+class CacheMemoireLRU:
+    """Dictionnaire borné en nombre d'entrées (les moins récemment lues sont évincées), avec expiration optionnelle."""
+
+    def __init__(self, taille_max, ttl=None):
+        self.taille_max = taille_max
+        self.ttl = ttl
+        self._entrees = collections.OrderedDict() # clé -> (expiration, valeur)
+        self._lock = threading.Lock()
+
+    def get(self, cle, defaut=None):
+        with self._lock:
+            entree = self._entrees.get(cle)
+            if entree is None:
+                return defaut
+            if entree[0] is not None and entree[0] < time.monotonic():
+                del self._entrees[cle]
+                return defaut
+            self._entrees.move_to_end(cle)
+            return entree[1]
+
+    def set(self, cle, valeur):
+        if self.taille_max <= 0:
+            return
+        expiration = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            self._entrees[cle] = (expiration, valeur)
+            self._entrees.move_to_end(cle)
+            while len(self._entrees) > self.taille_max:
+                self._entrees.popitem(last=False)
+
+    def pop(self, cle):
+        with self._lock:
+            self._entrees.pop(cle, None)
+
+    def clear(self):
+        with self._lock:
+            self._entrees.clear()
+
+TEMPLATE_INDEX = app.jinja_env.from_string(HTML_TEMPLATE)
+FRAGMENTS = {
+    'videos': app.jinja_env.from_string(FRAGMENT_VIDEOS),
+    'images': app.jinja_env.from_string(FRAGMENT_IMAGES),
+    'chat': app.jinja_env.from_string(FRAGMENT_CHAT),
+}
+cache_fragments = CacheMemoireLRU(app.config['FRAGMENT_CACHE_SIZE'])
+cache_hls = CacheMemoireLRU(4096, ttl=60) # Empreinte du MP4 -> playlist HLS présente (voir playlist_hls)
+
+def versions_contenu():
+    """Version courante de chaque fil, en une requête (0 si rien n'a encore été publié)."""
+    versions = dict.fromkeys(('videos', 'images', 'messages'), 0)
+    versions.update(db.session.query(ContentVersion.kind, ContentVersion.version).all())
+    return versions
+
+def incrementer_version(kind):
+    """Invalide les fragments d'un fil pour tous les processus (la version fait partie de la clé de cache)."""
+    if ContentVersion.query.filter_by(kind=kind).update({'version': ContentVersion.version + 1}, synchronize_session=False):
+        db.session.commit()
+        return
+    db.session.add(ContentVersion(kind=kind, version=1))
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        ContentVersion.query.filter_by(kind=kind).update({'version': ContentVersion.version + 1}, synchronize_session=False)
+        db.session.commit()
+
+def rendre_fragment(nom, cle, calculer):
+    """
+    Retourne le HTML du fragment, depuis le cache si possible.
+    `cle` contient la version du fil : après un ajout, l'ancienne entrée n'est plus jamais lue.
+    `calculer()` retourne les variables du fragment et n'est appelé qu'en cas d'absence.
+    """
+    cle = (nom, *cle)
+    html = cache_fragments.get(cle)
+    if html is None:
+        variables = calculer()
+        with phase('jinja'):
+            html = Markup(FRAGMENTS[nom].render(**variables))
+        cache_fragments.set(cle, html)
+    return html
+
+# --- Sessions côté serveur et profil de l'utilisateur connecté ---
+
+class MagasinCleValeur:
+    """Interface commune des magasins de sessions et de profils : clé -> valeur JSON, avec durée de vie."""
+
+    def lire(self, cle):
+        raise NotImplementedError
+
+    def ecrire(self, cle, valeur):
+        raise NotImplementedError
+
+    def supprimer(self, cle):
+        raise NotImplementedError
+
+class MagasinMemoire(MagasinCleValeur):
+    """Propre au processus : suffisant avec un seul worker (les entrées les moins récemment lues sont évincées)."""
+
+    def __init__(self, taille_max, ttl):
+        self._cache = CacheMemoireLRU(taille_max, ttl)
+
+    def lire(self, cle):
+        brut = self._cache.get(cle)
+        # Gardé sérialisé : chaque lecture donne une copie indépendante, comme avec Redis
+        return None if brut is None else json.loads(brut)
+
+    def ecrire(self, cle, valeur):
+        self._cache.set(cle, json.dumps(valeur))
+
+    def supprimer(self, cle):
+        self._cache.pop(cle)
+
+class MagasinRedis(MagasinCleValeur):
+    """Partagé par tous les workers et nœuds ; l'expiration est gérée par Redis."""
+
+    def __init__(self, url, prefixe, ttl):
+        if redis is None:
+            raise RuntimeError("Le paquet 'redis' est nécessaire pour SESSION_URL.")
+        self.redis = redis.Redis.from_url(url)
+        self.prefixe, self.ttl = prefixe, ttl
+
+    def lire(self, cle):
+        brut = self.redis.get(self.prefixe + cle)
+        return None if brut is None else json.loads(brut)
+
+    def ecrire(self, cle, valeur):
+        self.redis.set(self.prefixe + cle, json.dumps(valeur), ex=self.ttl)
+
+    def supprimer(self, cle):
+        self.redis.delete(self.prefixe + cle)
+
+def creer_magasin(prefixe, taille_max, ttl):
+    if app.config['SESSION_URL']:
+        return MagasinRedis(app.config['SESSION_URL'], prefixe, ttl)
+    return MagasinMemoire(taille_max, ttl)
+
+magasin_sessions = creer_magasin('session:', app.config['SESSION_MAX'], app.config['SESSION_TTL'])
+if (isinstance(magasin_sessions, MagasinMemoire) and app.config['DB_ROLE'] == 'web'
+        and int(os.environ.get('WEB_CONCURRENCY', 1)) > 1):
+    # Chaque worker aurait ses propres sessions : déconnexions au hasard selon le worker qui répond
+    raise RuntimeError("SESSION_URL (Redis) est nécessaire avec plusieurs workers web (WEB_CONCURRENCY > 1).")
+magasin_profils = creer_magasin('profil:', app.config['USER_CACHE_SIZE'], app.config['USER_CACHE_TTL'])
+
+def empreinte_session(identifiant):
+    """Clé de stockage d'un identifiant de session : le magasin ne contient jamais les identifiants eux-mêmes."""
+    return hashlib.sha256(identifiant.encode()).hexdigest()[:32]
+
+class SessionServeur(CallbackDict, SessionMixin):
+    """
+    Session Flask : celle d'un visiteur reste dans le cookie signé (jeton CSRF, messages flash), celle d'un
+    utilisateur connecté est dans le magasin et le cookie ne contient que son `identifiant`.
+    """
+
+    def __init__(self, donnees=None, identifiant=None, nouvelle=True):
+        def modifiee(session):
+            session.modified = True
+
+        super().__init__(donnees, modifiee)
+        self.nouvelle = nouvelle
+        self.identifiant = identifiant
+        self.ancien_identifiant = None
+        self.modified = False
+
+    def renouveler(self):
+        """Connexion : nouvel identifiant côté serveur ; l'ancien (s'il y en avait un) ne donne plus accès à rien."""
+        self.detacher()
+        self.identifiant = secrets.token_urlsafe(32)
+
+    def detacher(self):
+        """Déconnexion : les données repartent dans le cookie signé et l'entrée du magasin est supprimée."""
+        self.ancien_identifiant = self.ancien_identifiant or self.identifiant
+        self.identifiant = None
+        self.modified = True
+
+class InterfaceSessionsServeur(SecureCookieSessionInterface):
+    """
+    Session signée de Flask tant que personne n'est connecté : un visiteur (robot compris) ne crée rien côté
+    serveur. À la connexion, le cookie signé ne porte plus que l'identifiant de l'entrée du magasin.
+    """
+
+    def identifiant(self, app, request):
+        """Identifiant côté serveur de la session de la requête, ou None (visiteur, cookie invalide)."""
+        contenu = self._lire_cookie(app, request)
+        return contenu.get('_id') if contenu else None
+
+    def _lire_cookie(self, app, request):
+        valeur = request.cookies.get(self.get_cookie_name(app))
+        serialiseur = self.get_signing_serializer(app)
+        if not valeur or serialiseur is None:
+            return None
+        try:
+            return serialiseur.loads(valeur, max_age=int(app.permanent_session_lifetime.total_seconds()))
+        except BadSignature:
+            return None
+
+    def open_session(self, app, request):
+        if self.get_signing_serializer(app) is None:
+            return None # Pas de SECRET_KEY : même erreur que la session par défaut de Flask
+        contenu = self._lire_cookie(app, request)
+        if contenu is None:
+            return SessionServeur()
+        if '_id' not in contenu:
+            return SessionServeur(contenu, nouvelle=False)
+        donnees = magasin_sessions.lire(empreinte_session(contenu['_id']))
+        if donnees is None:
+            return SessionServeur(nouvelle=False) # Expirée ou magasin vidé : cookie effacé à la réponse
+        return SessionServeur(donnees, contenu['_id'], nouvelle=False)
+
+    def save_session(self, app, session, response):
+        nom, domaine, chemin = self.get_cookie_name(app), self.get_cookie_domain(app), self.get_cookie_path(app)
+        if session.accessed:
+            response.vary.add('Cookie')
+        if session.ancien_identifiant:
+            magasin_sessions.supprimer(empreinte_session(session.ancien_identifiant))
+        if not session:
+            if not session.nouvelle or session.ancien_identifiant:
+                response.delete_cookie(nom, domain=domaine, path=chemin)
+            return
+        if not session.modified:
+            return
+        if session.identifiant:
+            magasin_sessions.ecrire(empreinte_session(session.identifiant), dict(session))
+            contenu = {'_id': session.identifiant}
+        else:
+            contenu = dict(session)
+        response.set_cookie(nom, self.get_signing_serializer(app).dumps(contenu),
+                            expires=self.get_expiration_time(app, session),
+                            httponly=self.get_cookie_httponly(app), secure=self.get_cookie_secure(app),
+                            samesite=self.get_cookie_samesite(app), domain=domaine, path=chemin)
+
+app.session_interface = InterfaceSessionsServeur()
+
+Profil = collections.namedtuple('Profil', 'id username email')
+
+def memoriser_profil(user):
+    profil = Profil(user.id, user.username, user.email)
+    magasin_profils.ecrire(str(user.id), profil._asdict())
+    return profil
+
+def charger_profil(user_id):
+    """Profil depuis le cache, sinon depuis la base principale (un réplica en retard ignorerait un compte tout neuf)."""
+    donnees = magasin_profils.lire(str(user_id))
+    if donnees is not None:
+        return Profil(**donnees)
+    with lectures_sur_replica(False):
+        user = db.session.get(User, user_id)
+    return memoriser_profil(user) if user else None
+
+def utilisateur_connecte():
+    """Profil (id, username, email) de l'utilisateur de la session, ou None ; chargé une seule fois par requête."""
+    if 'profil' not in g:
+        user_id = session.get('user_id')
+        g.profil = charger_profil(user_id) if user_id else None
+    return g.profil
+
+def ouvrir_session(user):
+    """Connexion : nouvel identifiant de session (pas de fixation de session possible) et profil mis en cache."""
+    jeton = session.get('csrf_token')
+    session.clear()
+    session.renouveler()
+    session['user_id'] = user.id
+    if jeton:
+        session['csrf_token'] = jeton
+    g.profil = memoriser_profil(user)
+
+def fermer_session():
+    """Déconnexion : données effacées côté serveur et sockets ouverts avec cette session fermés."""
+    if session.identifiant:
+        salle = salle_session(session.identifiant)
+        # Sockets de ce processus fermés tout de suite ; ceux des autres nœuds sont prévenus par l'événement
+        socketio.emit('session_fermee', {}, to=salle)
+        for sid, _ in list(socketio.server.manager.get_participants('/', salle)):
+            socketio.server.disconnect(sid)
+    session.clear()
+    session.detacher()
+    g.profil = None
+
+@event.listens_for(User, 'after_update')
+def _profil_modifie(mapper, connection, user):
+    # Retiré du cache au commit : une transaction annulée n'a rien changé
+    object_session(user).info.setdefault('profils_modifies', set()).add(user.id)
+
+@event.listens_for(SessionRoutage, 'after_commit')
+def _invalider_profils(session_sql):
+    for user_id in session_sql.info.pop('profils_modifies', ()):
+        magasin_profils.supprimer(str(user_id))
+
+@event.listens_for(SessionRoutage, 'after_rollback')
+def _oublier_profils_modifies(session_sql):
+    session_sql.info.pop('profils_modifies', None)
+
+# --- Mots de passe : hachage hors du worker web et limitation des tentatives ---
+
+_pool_mots_de_passe = None
+_pool_mots_de_passe_lock = threading.Lock()
+
+def pool_mots_de_passe():
+    """
+    Pool borné : au plus PASSWORD_WORKERS hachages simultanés par processus, les autres attendent leur tour.
+    Des processus en mode threading ; de vrais threads sous gevent/eventlet (voir ExecuteurHorsBoucle),
+    où PBKDF2 libère le GIL pendant le calcul.
+    """
+    global _pool_mots_de_passe
+    with _pool_mots_de_passe_lock:
+        if _pool_mots_de_passe is None:
+            if socketio.async_mode in ('gevent', 'eventlet'):
+                _pool_mots_de_passe = ExecuteurHorsBoucle(app.config['PASSWORD_WORKERS'])
+            else:
+                _pool_mots_de_passe = ProcessPoolExecutor(max_workers=app.config['PASSWORD_WORKERS'])
+        return _pool_mots_de_passe
+
+def methode_hachage():
+    return f"pbkdf2:sha256:{app.config['PASSWORD_HASH_ITERATIONS']}"
+
+class LimiteurDebit:
+    """
+    Seaux de jetons en mémoire, un par clé : `capacite` tentatives d'affilée, puis `capacite` par minute.
+    Le nombre de clés suivies est borné (les moins récentes sont oubliées).
+    """
+
+    def __init__(self, capacite, taille_max=100000):
+        self.capacite = capacite
+        self.debit = capacite / 60.0 # jetons par seconde
+        self.taille_max = taille_max
+        self._seaux = collections.OrderedDict() # clé -> (jetons, instant de la dernière mise à jour)
+        self._lock = threading.Lock()
+
+    def attente(self, cle):
+        """Consomme un jeton ; retourne 0 si la tentative est permise, sinon le nombre de secondes à attendre."""
+        maintenant = time.monotonic()
+        with self._lock:
+            jetons, dernier = self._seaux.pop(cle, (self.capacite, maintenant))
+            jetons = min(self.capacite, jetons + (maintenant - dernier) * self.debit)
+            if jetons >= 1:
+                jetons -= 1
+                attente = 0
+            else:
+                attente = (1 - jetons) / self.debit
+            self._seaux[cle] = (jetons, maintenant)
+            while len(self._seaux) > self.taille_max:
+                self._seaux.popitem(last=False)
+        return attente
+
+limiteur_pseudos = LimiteurDebit(app.config['LOGIN_ATTEMPTS_PER_USER'])
+limiteur_ip = LimiteurDebit(app.config['LOGIN_ATTEMPTS_PER_IP'])
+
+def tentative_refusee(username=None):
+    """Message d'erreur si l'IP (ou le pseudo visé) a épuisé ses tentatives, None sinon."""
+    attente = limiteur_ip.attente(request.remote_addr)
+    if username is not None:
+        attente = max(attente, limiteur_pseudos.attente(username.lower()))
+    if attente:
+        return f"Trop de tentatives. Réessayez dans {int(attente) + 1} secondes."
+    return None
+
+# --- Graphe d'amitiés en mémoire (évite toute requête SQL sur le chemin chaud du chat) ---
+
+class GrapheAmis:
+    """Listes d'adjacence user_id -> frozenset des ids d'amis, bornées en taille et en durée de vie."""
+
+    def __init__(self, taille_max, ttl):
+        self._adjacence = CacheMemoireLRU(taille_max, ttl)
+
+    def amis(self, user_id):
+        ids = self._adjacence.get(user_id)
+        if ids is None:
+            # Toujours la base principale : un réplica en retard mettrait en cache une liste périmée
+            with lectures_sur_replica(False):
+                ids = frozenset(id for (id,) in db.session.query(friends.c.friend_id).filter(friends.c.user_id == user_id))
+            self._adjacence.set(user_id, ids)
+        return ids
+
+    def ajouter_amitie(self, user_id, ami_id):
+        """Mise à jour incrémentale des deux côtés ; un utilisateur absent du cache sera chargé à la demande."""
+        for a, b in ((user_id, ami_id), (ami_id, user_id)):
+            ids = self._adjacence.get(a)
+            if ids is not None:
+                self._adjacence.set(a, ids | {b})
+
+    def invalider(self, user_id):
+        self._adjacence.pop(user_id)
+
+graphe_amis = GrapheAmis(app.config['FRIEND_CACHE_SIZE'], app.config['FRIEND_CACHE_TTL'])
+
+# --- Opérations groupées sur les amitiés (une requête SQL par opération, quel que soit le nombre d'amis) ---
+
+def _insert_ignorer_doublons(table):
+    """INSERT ... ON CONFLICT DO NOTHING dans le dialecte de la base configurée."""
+    dialecte = db.engine.dialect.name
+    if dialecte == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+        return insert(table).on_conflict_do_nothing()
+    if dialecte == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+        return insert(table).on_conflict_do_nothing()
+    if dialecte in ('mysql', 'mariadb'):
+        return table.insert().prefix_with('IGNORE')
+    raise NotImplementedError(f"INSERT sans doublon non pris en charge pour {dialecte}")
+
+def ajouter_amities(user_id, ami_ids):
+    """
+    Ajoute les amitiés (dans les deux sens) en un seul INSERT ; celles qui existent déjà sont ignorées.
+    Retourne le nombre de nouveaux amis. La transaction est validée par l'appelant.
+    """
+    ami_ids = {ami_id for ami_id in ami_ids if ami_id != user_id}
+    if not ami_ids:
+        return 0
+    lignes = [{'user_id': user_id, 'friend_id': ami_id} for ami_id in ami_ids]
+    lignes += [{'user_id': ami_id, 'friend_id': user_id} for ami_id in ami_ids]
+    # Un seul INSERT multi-lignes (et non un executemany) : rowcount est alors fiable sur tous les pilotes
+    resultat = db.session.execute(_insert_ignorer_doublons(friends).values(lignes))
+    for ami_id in ami_ids:
+        graphe_amis.ajouter_amitie(user_id, ami_id)
+    synchroniser_salles_amis(user_id, ami_ids, ajout=True)
+    # Chaque amitié compte deux lignes ; rowcount vaut -1 si le pilote ne le fournit pas
+    return max(resultat.rowcount, 0) // 2
+
+def retirer_amities(user_id, ami_ids):
+    """Supprime les amitiés (dans les deux sens) en un seul DELETE ; retourne le nombre d'amis retirés."""
+    ami_ids = set(ami_ids)
+    if not ami_ids:
+        return 0
+    resultat = db.session.execute(friends.delete().where(db.or_(
+        db.and_(friends.c.user_id == user_id, friends.c.friend_id.in_(ami_ids)),
+        db.and_(friends.c.friend_id == user_id, friends.c.user_id.in_(ami_ids)),
+    )))
+    graphe_amis.invalider(user_id)
+    for ami_id in ami_ids:
+        graphe_amis.invalider(ami_id)
+    synchroniser_salles_amis(user_id, ami_ids, ajout=False)
+    return max(resultat.rowcount, 0) // 2
+
+def lister_amis(user_ids):
+    """Amis de plusieurs utilisateurs en une requête : {user_id: [pseudo, ...]} trié par pseudo."""
+    resultat = {user_id: [] for user_id in user_ids}
+    if not resultat:
+        return resultat
+    lignes = (db.session.query(friends.c.user_id, User.username)
+              .join(User, User.id == friends.c.friend_id)
+              .filter(friends.c.user_id.in_(resultat))
+              .order_by(User.username))
+    for user_id, username in lignes:
+        resultat[user_id].append(username)
+    return resultat
+
+def amis_communs(user_id, autre_id):
+    """Pseudos des amis communs à deux utilisateurs (auto-jointure de la table d'amitiés)."""
+    autre = friends.alias('autre')
+    return [username for (username,) in (
+        db.session.query(User.username)
+        .join(friends, friends.c.friend_id == User.id)
+        .join(autre, db.and_(autre.c.friend_id == User.id, autre.c.user_id == autre_id))
+        .filter(friends.c.user_id == user_id)
+        .order_by(User.username)
+    )]
+
+def suggestions_amis(user_id, limite=10):
+    """
+    Amis d'amis qui ne sont pas encore amis, classés par nombre d'amis communs :
+    [(pseudo, nombre_d_amis_communs), ...].
+    """
+    directs = friends.alias('directs')
+    second = friends.alias('second')
+    deja_amis = db.session.query(friends.c.friend_id).filter(friends.c.user_id == user_id)
+    communs = func.count(directs.c.friend_id).label('communs')
+    return [(username, nombre) for username, nombre in (
+        db.session.query(User.username, communs)
+        .select_from(directs)
+        .join(second, second.c.user_id == directs.c.friend_id)
+        .join(User, User.id == second.c.friend_id)
+        .filter(directs.c.user_id == user_id,
+                second.c.friend_id != user_id,
+                second.c.friend_id.not_in(deja_amis))
+        .group_by(User.id, User.username)
+        .order_by(communs.desc(), User.username)
+        .limit(limite)
+    )]
+
+# --- Pool de connexions : lectures sur le réplica et saturation ---
+
+@contextlib.contextmanager
+def lectures_sur_replica(actif=True):
+    """
+    Les SELECT du bloc vont au réplica (s'il est configuré et que la session n'a pas encore écrit).
+    `actif=False` force la base principale dans un bloc englobant, pour les lectures qui doivent être à jour.
+    """
+    info = db.session.info
+    precedent = info.get('replica', False)
+    info['replica'] = actif
+    try:
+        yield
+    finally:
+        info['replica'] = precedent
+
+# Compteurs par base ('primary' ou nom du bind), depuis le démarrage du processus
+compteurs_pool = collections.defaultdict(collections.Counter)
+
+def _suivre_pool(nom, moteur):
+    compteurs = compteurs_pool[nom]
+
+    @event.listens_for(moteur, 'connect')
+    def _connexion(dbapi_connection, connection_record):
+        compteurs['connexions_ouvertes'] += 1
+
+    @event.listens_for(moteur, 'checkout')
+    def _emprunt(dbapi_connection, connection_record, connection_proxy):
+        compteurs['emprunts'] += 1
+
+    @event.listens_for(moteur, 'invalidate')
+    def _invalidation(dbapi_connection, connection_record, exception):
+        # Connexion coupée détectée (pre-ping ou erreur) puis remplacée
+        compteurs['invalidations'] += 1
+
+with app.app_context():
+    for _cle, _moteur in db.engines.items():
+        _suivre_pool(_cle or 'primary', _moteur)
+
+def etat_pools():
+    """Occupation instantanée de chaque pool et compteurs cumulés."""
+    etat = {}
+    with app.app_context():
+        moteurs = dict(db.engines)
+    for cle, moteur in moteurs.items():
+        pool = moteur.pool
+        nom = cle or 'primary'
+        info = {'pool': type(pool).__name__, **compteurs_pool[nom]}
+        if hasattr(pool, 'checkedout'):
+            # max_overflow = -1 : pas de limite
+            debordement_max = getattr(pool, '_max_overflow', 0)
+            capacite = pool.size() + debordement_max if debordement_max >= 0 else None
+            info.update(taille=pool.size(), empruntees=pool.checkedout(), disponibles=pool.checkedin(),
+                        debordement=max(pool.overflow(), 0), capacite=capacite,
+                        saturation=round(pool.checkedout() / capacite, 3) if capacite else None)
+        etat[nom] = info
+    return etat
+
+@app.errorhandler(DelaiPoolDepasse)
+def _pool_sature(erreur):
+    """Plus aucune connexion libre après DB_POOL_TIMEOUT secondes : le client réessaiera plus tard."""
+    compteurs_pool['primary']['delais_depasses'] += 1
+    print(f"⚠️ Pool de connexions saturé ({request.method} {request.path}) : {erreur}")
+    return jsonify(error='Service momentanément surchargé, veuillez réessayer.'), 503, {'Retry-After': '2'}
+
+def metriques_autorisees():
+    jeton = app.config['METRICS_TOKEN']
+    if not jeton:
+        abort(404)
+    fourni = request.headers.get('Authorization', '').removeprefix('Bearer ')
+    return secrets.compare_digest(fourni.encode(), jeton.encode())
+
+@app.route('/api/db/pool', methods=['GET'])
+def api_db_pool():
+    if not metriques_autorisees():
+        return jsonify(error='Jeton invalide.'), 401
+    return jsonify(role=app.config['DB_ROLE'], pools=etat_pools())
+
+# --- Instrumentation : requêtes SQL exécutées pendant chaque requête HTTP ---
+
+OPERATIONS_SQL = {'select', 'insert', 'update', 'delete'}
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _avant_requete_sql(conn, cursor, statement, parameters, context, executemany):
+    # Sur le contexte d'exécution, pas sur la connexion : une requête qui lève (IntegrityError) n'atteint
+    # jamais after_cursor_execute, et le contexte disparaît avec elle
+    context._debut_requete = time.perf_counter()
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _apres_requete_sql(conn, cursor, statement, parameters, context, executemany):
+    duree = time.perf_counter() - context._debut_requete
+    operation = statement.lstrip()[:6].lower()
+    duree_sql.observer(duree, operation=operation if operation in OPERATIONS_SQL else 'autre')
+    if has_request_context():
+        g.sql_requetes = g.get('sql_requetes', 0) + 1
+        g.sql_duree = g.get('sql_duree', 0.0) + duree
+
+@app.after_request
+def _statistiques_sql(response):
+    nombre = g.get('sql_requetes', 0)
+    duree_ms = g.get('sql_duree', 0.0) * 1000
+    if app.config['SQL_STATS']:
+        response.headers['X-SQL-Queries'] = str(nombre)
+        response.headers['X-SQL-Time'] = f"{duree_ms:.1f}"
+        response.headers.add('Server-Timing', f'sql;dur={duree_ms:.1f};desc="{nombre} requetes"') # En-tête en ASCII
+        pool = etat_pools()['primary']
+        if 'empruntees' in pool:
+            response.headers['X-DB-Pool'] = f"{pool['empruntees']}/{pool['capacite'] or '-'}"
+    if nombre > app.config['SQL_QUERY_WARN']:
+        print(f"⚠️ {request.method} {request.path} : {nombre} requêtes SQL ({duree_ms:.1f} ms)")
+    return response
+
+# --- Métriques (format Prometheus) et profileur par échantillonnage ---
+# Valeurs propres à chaque processus : avec plusieurs workers gunicorn, chacun expose les siennes
+# (un worker gevent par défaut). Les processus `python app.py worker` les exposent sur METRICS_PORT.
+
+BORNES_REQUETE = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+BORNES_SQL = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+BORNES_CONVERSION = (0.05, 0.25, 1, 5, 15, 30, 60, 120, 300, 600, 1800)
+
+REGISTRE_METRIQUES = []
+
+def _echapper_etiquette(valeur):
+    return str(valeur).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+def _etiquettes(noms, valeurs, supplement=''):
+    paires = [f'{nom}="{_echapper_etiquette(valeur)}"' for nom, valeur in zip(noms, valeurs)]
+    if supplement:
+        paires.append(supplement)
+    return '{' + ','.join(paires) + '}' if paires else ''
+
+class Metrique:
+    """Série Prometheus nommée ; les valeurs sont indexées par le tuple des valeurs d'étiquettes."""
+    type = None
+
+    def __init__(self, nom, aide, etiquettes=()):
+        self.nom, self.aide, self.etiquettes = nom, aide, tuple(etiquettes)
+        self._valeurs = {}
+        self._lock = threading.Lock()
+        REGISTRE_METRIQUES.append(self)
+
+    def _cle(self, etiquettes):
+        return tuple(etiquettes[nom] for nom in self.etiquettes)
+
+    def exposer(self):
+        yield f"# HELP {self.nom} {self.aide}"
+        yield f"# TYPE {self.nom} {self.type}"
+        with self._lock:
+            valeurs = list(self._valeurs.items())
+        for cle, valeur in sorted(valeurs):
+            yield from self._lignes(cle, valeur)
+
+    def _lignes(self, cle, valeur):
+        yield f"{self.nom}{_etiquettes(self.etiquettes, cle)} {valeur}"
+
+class Compteur(Metrique):
+    type = 'counter'
+
+    def inc(self, valeur=1, **etiquettes):
+        cle = self._cle(etiquettes)
+        with self._lock:
+            self._valeurs[cle] = self._valeurs.get(cle, 0) + valeur
+
+class Histogramme(Metrique):
+    type = 'histogram'
+
+    def __init__(self, nom, aide, etiquettes=(), bornes=BORNES_REQUETE):
+        super().__init__(nom, aide, etiquettes)
+        self.bornes = bornes
+
+    def observer(self, valeur, **etiquettes):
+        cle = self._cle(etiquettes)
+        with self._lock:
+            seaux = self._valeurs.get(cle)
+            if seaux is None:
+                # Un compteur par borne (non cumulés ici), puis somme et nombre d'observations
+                seaux = self._valeurs[cle] = [0] * len(self.bornes) + [0.0, 0]
+            indice = bisect.bisect_left(self.bornes, valeur)
+            if indice < len(self.bornes):
+                seaux[indice] += 1
+            seaux[-2] += valeur
+            seaux[-1] += 1
+
+    def _lignes(self, cle, seaux):
+        cumul = 0
+        for borne, nombre in zip(self.bornes, seaux):
+            cumul += nombre
+            le = f'le="{borne}"'
+            yield f"{self.nom}_bucket{_etiquettes(self.etiquettes, cle, le)} {cumul}"
+        le = 'le="+Inf"'
+        yield f"{self.nom}_bucket{_etiquettes(self.etiquettes, cle, le)} {seaux[-1]}"
+        yield f"{self.nom}_sum{_etiquettes(self.etiquettes, cle)} {seaux[-2]}"
+        yield f"{self.nom}_count{_etiquettes(self.etiquettes, cle)} {seaux[-1]}"
+
+class MetriqueCalculee(Metrique):
+    """Valeurs lues au moment de l'exposition : `fonction()` retourne {tuple des étiquettes: valeur}."""
+
+    def __init__(self, nom, aide, type, fonction, etiquettes=()):
+        super().__init__(nom, aide, etiquettes)
+        self.type, self.fonction = type, fonction
+
+    def exposer(self):
+        try:
+            self._valeurs = self.fonction()
+        except Exception as e:
+            print(f"Métrique {self.nom} indisponible: {e}")
+            self._valeurs = {}
+        yield from super().exposer()
+
+def exposer_metriques():
+    """Toutes les métriques du processus, au format texte de Prometheus."""
+    with app.app_context():
+        return '\n'.join(ligne for metrique in REGISTRE_METRIQUES for ligne in metrique.exposer()) + '\n'
+
+duree_requetes = Histogramme('http_request_duration_seconds', "Durée de traitement des requêtes HTTP (jusqu'au retour de la vue).",
+                             ('route', 'method'))
+requetes_http = Compteur('http_requests_total', 'Requêtes HTTP traitées.', ('route', 'method', 'status'))
+duree_phases = Histogramme('http_request_phase_seconds', 'Temps passé par requête HTTP en SQL, rendu Jinja et stockage.',
+                           ('route', 'phase'))
+duree_sql = Histogramme('db_query_duration_seconds', 'Durée des requêtes SQL.', ('operation',), BORNES_SQL)
+duree_conversions = Histogramme('conversion_duration_seconds', 'Durée des conversions effectivement exécutées.',
+                                ('converter',), BORNES_CONVERSION)
+conversions = Compteur('conversions_total', 'Conversions demandées, par résultat (ok, echec, cache).', ('converter', 'result'))
+octets_convertis_entree = Compteur('conversion_input_bytes_total', 'Octets lus par les conversions.', ('converter',))
+octets_convertis_sortie = Compteur('conversion_output_bytes_total', 'Octets produits par les conversions.', ('converter',))
+emissions_socketio = Compteur('socketio_emits_total', 'Événements Socket.IO émis par ce processus.', ('event',))
+evenements_socketio = Compteur('socketio_events_received_total', 'Événements Socket.IO reçus des clients.', ('event',))
+
+MetriqueCalculee('socketio_connected_clients', 'Connexions Socket.IO ouvertes sur ce processus.', 'gauge',
+                 lambda: {(): len(socketio.server.eio.sockets)})
+MetriqueCalculee('conversion_jobs', 'Jobs de conversion vidéo par statut (toute la file).', 'gauge',
+                 lambda: {(statut,): nombre for statut, nombre in
+                          db.session.query(ConversionJob.status, func.count()).group_by(ConversionJob.status)},
+                 ('status',))
+
+def _metriques_pools(champ):
+    return lambda: {(nom,): etat[champ] for nom, etat in etat_pools().items() if etat.get(champ) is not None}
+
+for _nom, _champ, _type, _aide in (
+        ('db_pool_checked_out', 'empruntees', 'gauge', 'Connexions empruntées au pool.'),
+        ('db_pool_capacity', 'capacite', 'gauge', 'Connexions au plus (pool_size + max_overflow).'),
+        ('db_pool_overflow', 'debordement', 'gauge', 'Connexions ouvertes au-delà de pool_size.'),
+        ('db_pool_connections_opened_total', 'connexions_ouvertes', 'counter', 'Connexions ouvertes vers la base.'),
+        ('db_pool_checkouts_total', 'emprunts', 'counter', 'Emprunts de connexion au pool.'),
+        ('db_pool_invalidations_total', 'invalidations', 'counter', 'Connexions coupées détectées puis remplacées.'),
+        ('db_pool_timeouts_total', 'delais_depasses', 'counter', 'Requêtes refusées faute de connexion libre.')):
+    MetriqueCalculee(_nom, _aide, _type, _metriques_pools(_champ), ('pool',))
+
+def observer_conversion(convertisseur, duree, octets_entree, octets_sortie):
+    conversions.inc(converter=convertisseur, result='ok')
+    duree_conversions.observer(duree, converter=convertisseur)
+    octets_convertis_entree.inc(octets_entree, converter=convertisseur)
+    octets_convertis_sortie.inc(octets_sortie, converter=convertisseur)
+
+# Tous les emit passent par le serveur python-socketio (socketio.emit comme emit() dans les handlers)
+_emit_serveur = socketio.server.emit
+
+def _emit_compte(evenement, *args, **kwargs):
+    emissions_socketio.inc(event=evenement)
+    return _emit_serveur(evenement, *args, **kwargs)
+
+socketio.server.emit = _emit_compte
+
+@contextlib.contextmanager
+def phase(nom):
+    """Ajoute la durée du bloc à la phase `nom` de la requête HTTP en cours (métriques et Server-Timing)."""
+    debut = time.perf_counter()
+    try:
+        yield
+    finally:
+        if has_request_context():
+            g.setdefault('phases', collections.Counter())[nom] += time.perf_counter() - debut
+
+@before_render_template.connect_via(app)
+def _avant_rendu(sender, template, context, **extra):
+    g.debut_rendu = time.perf_counter()
+
+@template_rendered.connect_via(app)
+def _apres_rendu(sender, template, context, **extra):
+    g.setdefault('phases', collections.Counter())['jinja'] += time.perf_counter() - g.pop('debut_rendu')
+
+def _primitives_systeme():
+    """start_new_thread, get_ident et sleep d'origine : le profileur doit tourner sur un vrai thread, même sous gevent/eventlet."""
+    if socketio.async_mode == 'gevent':
+        from gevent import monkey
+        return (monkey.get_original('_thread', 'start_new_thread'), monkey.get_original('_thread', 'get_ident'),
+                monkey.get_original('time', 'sleep'))
+    if socketio.async_mode == 'eventlet':
+        from eventlet import patcher
+        thread, temps = patcher.original('_thread'), patcher.original('time')
+        return thread.start_new_thread, thread.get_ident, temps.sleep
+    import _thread
+    return _thread.start_new_thread, _thread.get_ident, time.sleep
+
+class ProfileurEchantillons:
+    """
+    Relève la pile du thread appelant toutes les `intervalle` secondes, depuis un thread système dédié.
+    Sous gevent/eventlet, ce thread est celui de tout le worker : les piles des autres connexions servies
+    pendant la requête apparaissent aussi.
+    """
+
+    def __init__(self, intervalle):
+        demarrer_thread, ident_courant, self._dormir = _primitives_systeme()
+        self.intervalle = intervalle
+        self.cible = ident_courant()
+        self._echantillons = []
+        self._actif = True
+        demarrer_thread(self._echantillonner, ())
+
+    def _echantillonner(self):
+        while self._actif:
+            frame = sys._current_frames().get(self.cible)
+            pile = []
+            while frame is not None and len(pile) < 200:
+                pile.append(f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}")
+                frame = frame.f_back
+            if pile:
+                self._echantillons.append(';'.join(reversed(pile)))
+            self._dormir(self.intervalle)
+
+    def arreter(self):
+        """Piles repliées (une ligne `f1;f2;f3 nombre` par pile, format des flamegraphs), les plus fréquentes d'abord."""
+        self._actif = False
+        piles = collections.Counter(list(self._echantillons))
+        return ''.join(f"{pile} {nombre}\n" for pile, nombre in piles.most_common())
+
+profils = CacheMemoireLRU(app.config['PROFILE_KEEP'])
+
+def _profil_demande():
+    jeton = app.config['METRICS_TOKEN']
+    fourni = request.headers.get('X-Profile')
+    return app.config['PROFILING'] and jeton and fourni and secrets.compare_digest(fourni.encode(), jeton.encode())
+
+@app.before_request
+def _debut_requete():
+    g.debut_requete = time.perf_counter()
+    if _profil_demande():
+        g.profileur = ProfileurEchantillons(app.config['PROFILE_INTERVAL'])
+
+@app.after_request
+def _mesurer_requete(response):
+    if 'debut_requete' not in g:
+        return response
+    duree = time.perf_counter() - g.debut_requete
+    route = request.url_rule.rule if request.url_rule else 'aucune'
+    duree_requetes.observer(duree, route=route, method=request.method)
+    requetes_http.inc(route=route, method=request.method, status=response.status_code)
+    phases = g.get('phases', collections.Counter())
+    phases['sql'] = g.get('sql_duree', 0.0)
+    for nom in ('sql', 'jinja', 'stockage'):
+        duree_phases.observer(phases[nom], route=route, phase=nom)
+    if app.config['SQL_STATS']:
+        for nom in ('jinja', 'stockage'):
+            response.headers.add('Server-Timing', f"{nom};dur={1000 * phases[nom]:.1f}")
+        response.headers.add('Server-Timing', f"total;dur={1000 * duree:.1f}")
+
+    profileur = g.pop('profileur', None)
+    if profileur:
+        profil_id = secrets.token_hex(8)
+        profils.set(profil_id, profileur.arreter())
+        response.headers['X-Profile-Id'] = profil_id
+    return response
+
+@app.teardown_request
+def _arreter_profileur(exception=None):
+    # Requête interrompue par une exception non gérée : le thread d'échantillonnage s'arrête quand même
+    profileur = g.pop('profileur', None)
+    if profileur:
+        profileur.arreter()
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    if not metriques_autorisees():
+        return jsonify(error='Jeton invalide.'), 401
+    return app.response_class(exposer_metriques(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/metrics/profiles/<profil_id>', methods=['GET'])
+def metrics_profile(profil_id):
+    if not metriques_autorisees():
+        return jsonify(error='Jeton invalide.'), 401
+    profil = profils.get(profil_id)
+    if profil is None:
+        abort(404)
+    return app.response_class(profil, mimetype='text/plain')
+
+def servir_metriques(port):
+    """/metrics sur un port dédié, pour les processus sans serveur web (`python app.py worker`)."""
+    from wsgiref.simple_server import make_server, WSGIRequestHandler
+
+    class Silencieux(WSGIRequestHandler):
+        def log_message(self, *args):
+            pass
+
+    def application(environ, start_response):
+        jeton = app.config['METRICS_TOKEN']
+        fourni = environ.get('HTTP_AUTHORIZATION', '').removeprefix('Bearer ')
+        if environ.get('PATH_INFO') != '/metrics' or not jeton or not secrets.compare_digest(fourni.encode(), jeton.encode()):
+            start_response('404 Not Found', [('Content-Type', 'text/plain')])
+            return [b'']
+        start_response('200 OK', [('Content-Type', 'text/plain; version=0.0.4')])
+        return [exposer_metriques().encode()]
+
+    serveur = make_server('0.0.0.0', port, application, handler_class=Silencieux)
+    threading.Thread(target=serveur.serve_forever, daemon=True).start()
+    print(f"Métriques exposées sur le port {port}")
+
+# --- Feuilles de style et scripts : noms contenant leur empreinte, donc cachables indéfiniment ---
+
+DOSSIER_STATIC = os.path.join(app.root_path, 'static')
+
+def _empreintes_assets():
+    empreintes = {}
+    for nom in os.listdir(DOSSIER_STATIC) if os.path.isdir(DOSSIER_STATIC) else []:
+        with open(os.path.join(DOSSIER_STATIC, nom), 'rb') as f:
+            empreintes[nom] = hashlib.sha256(f.read()).hexdigest()[:12]
+    return empreintes
+
+ASSETS = _empreintes_assets()
+
+@app.template_global()
+def asset_url(nom):
+    """URL versionnée d'un fichier de static/ : `app.css` -> `/assets/app.<empreinte>.css`."""
+    base, ext = os.path.splitext(nom)
+    return url_for('asset', filename=f"{base}.{ASSETS[nom]}{ext}")
+
+# --- Pagination par curseur (keyset) du fil ---
+
+def encoder_curseur(element):
+    """Curseur opaque : position (created_at, id) du dernier élément de la page."""
+    brut = f"{element.created_at.isoformat()}|{element.id}"
+    return base64.urlsafe_b64encode(brut.encode()).decode().rstrip('=')
+
+def decoder_curseur(curseur):
+    """Inverse de encoder_curseur ; lève ValueError si le curseur est invalide."""
+    try:
+        brut = base64.urlsafe_b64decode(curseur + '=' * (-len(curseur) % 4)).decode()
+        date, _, id = brut.partition('|')
+        return datetime.datetime.fromisoformat(date), int(id)
+    except (UnicodeDecodeError, ValueError) as e:
+        raise ValueError("Curseur invalide.") from e
+
+def page_du_fil(modele, curseur=None, limite=None, filtre=None):
+    """
+    Une page d'éléments, du plus récent au plus ancien, et le curseur de la page suivante (ou None).
+    La condition (created_at, id) < curseur suit l'index : le coût ne dépend pas de la profondeur.
+    """
+    limite = limite or app.config['FEED_PAGE_SIZE']
+    requete = db.session.query(modele, User.username).join(User, modele.user_id == User.id)
+    if filtre is not None:
+        requete = requete.filter(filtre)
+    if curseur:
+        date, id = decoder_curseur(curseur)
+        requete = requete.filter(db.tuple_(modele.created_at, modele.id) < (date, id))
+
+    lignes = requete.order_by(modele.created_at.desc(), modele.id.desc()).limit(limite + 1).all()
+    suivant = encoder_curseur(lignes[limite - 1][0]) if len(lignes) > limite else None
+    return [element.to_dict(username) for element, username in lignes[:limite]], suivant
+
+def filtre_messages(user):
+    """Historique visible : les messages de l'utilisateur et de ses amis."""
+    ids = [user.id, *graphe_amis.amis(user.id)]
+    return ChatMessage.user_id.in_(ids)
+
+def check_csrf_token(request):
+    """Vérifie si le jeton CSRF est valide (sécurité anti-bot)."""
+    # Les formulaires l'envoient dans le corps, les appels JavaScript dans l'en-tête X-CSRF-Token
+    token = request.headers.get('X-CSRF-Token') or request.form.get('csrf_token')
+    return token == session.get('csrf_token')
+
+
+# --------------------------
+# 5. ROUTES FLASK
+# --------------------------
+
+@app.route('/', methods=['GET'])
+def index():
+    # 🍪 1. Gestion du Jeton CSRF
+    if 'csrf_token' not in session:
+        session['csrf_token'] = secrets.token_hex(16)
+        
+    current_user = utilisateur_connecte()
+    friend_names = []
+    fragments = {}
+
+    # Page en lecture seule : amis et fils sont lus sur le réplica s'il y en a un
+    with lectures_sur_replica():
+        if current_user:
+            # Récupère la liste des amis pour l'affichage
+            friend_names = lister_amis([current_user.id])[current_user.id]
+
+            # Une seule page de chaque fil, rendue depuis le cache tant que le fil n'a pas changé
+            versions = versions_contenu()
+            curseur_videos = request.args.get('videos')
+            curseur_images = request.args.get('images')
+            try:
+                fragments['videos'] = rendre_fragment(
+                    'videos', (versions['videos'], curseur_videos),
+                    lambda: _variables_page('videos', Video, curseur_videos))
+                fragments['images'] = rendre_fragment(
+                    'images', (versions['images'], curseur_images),
+                    lambda: _variables_page('images', ConvertedImage, curseur_images))
+                fragments['chat'] = rendre_fragment(
+                    'chat', (versions['messages'], current_user.id),
+                    lambda: _variables_chat(current_user))
+            except ValueError:
+                abort(400)
+
+    return render_template(
+        TEMPLATE_INDEX,
+        user_username=current_user.username if current_user else None,
+        fragments=fragments,
+        friend_names=friend_names,
+        formats_image=FORMATS_IMAGE,
+        csrf_token=session['csrf_token'] 
+    )
+
+def _variables_page(nom, modele, curseur):
+    elements, suivant = page_du_fil(modele, curseur)
+    return {nom: elements, 'next_cursor': suivant}
+
+def _variables_chat(user):
+    """Dernière page seulement ; le reste de l'historique est chargé par /api/feed/messages?cursor=."""
+    messages, suivant = page_du_fil(ChatMessage, limite=app.config['CHAT_PAGE_SIZE'], filtre=filtre_messages(user))
+    # Ordre chronologique dans la boîte de chat
+    return {'chat_messages': list(reversed(messages)), 'next_cursor': suivant}
+
+@app.route('/assets/<filename>')
+def asset(filename):
+    """Fichiers de static/ servis sous leur nom versionné, avec un cache navigateur d'un an."""
+    base, _, reste = filename.partition('.')
+    empreinte, _, ext = reste.partition('.')
+    nom = f"{base}.{ext}"
+    if ASSETS.get(nom) != empreinte:
+        abort(404)
+    reponse = send_from_directory(DOSSIER_STATIC, nom, max_age=UN_AN)
+    reponse.cache_control.public = True
+    reponse.cache_control.immutable = True
+    return reponse
+
+@app.route('/api/feed/<kind>', methods=['GET'])
+def api_feed(kind):
+    """Une page du fil en JSON : ?cursor=<curseur de la page précédente>&limit=<n>."""
+    with lectures_sur_replica():
+        return _page_du_fil_json(kind)
+
+def _page_du_fil_json(kind):
+    user = utilisateur_connecte()
+    if not user:
+        return jsonify(error='Veuillez vous connecter.'), 401
+
+    modeles = {'videos': Video, 'images': ConvertedImage, 'messages': ChatMessage}
+    if kind not in modeles:
+        abort(404)
+    limite = min(request.args.get('limit', app.config['FEED_PAGE_SIZE'], type=int), 100)
+    filtre = filtre_messages(user) if kind == 'messages' else None
+
+    try:
+        elements, suivant = page_du_fil(modeles[kind], request.args.get('cursor'), max(limite, 1), filtre)
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    return jsonify(items=elements, next_cursor=suivant)
+
+@app.route('/register', methods=['POST'])
+def register():
+    # 🔒 2. Vérification du jeton CSRF
+    if not check_csrf_token(request):
+        flash('Erreur de sécurité: Jeton invalide. Veuillez réessayer.', 'error')
+        return redirect(url_for('index'))
+        
+    email = request.form['email']
+    username = request.form['username']
+    password = request.form['password']
+
+    # Refusé avant tout hachage
+    erreur = tentative_refusee()
+    if erreur:
+        flash(erreur, 'error')
+        return redirect(url_for('index'))
+
+    def refuser_doublon():
+        # Une seule requête pour savoir lequel des deux champs est déjà pris
+        existant = User.query.filter(db.or_(User.email == email, User.username == username)).first()
+        if existant is None:
+            return False
+        flash('Cet email est déjà enregistré.' if existant.email == email else 'Ce pseudo est déjà utilisé.', 'error')
+        return True
+
+    with app.app_context():
+        if refuser_doublon():
+            return redirect(url_for('index'))
+
+        new_user = User(email=email, username=username)
+        new_user.set_password(password)
+        
+        db.session.add(new_user)
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # Inscription concurrente avec le même email ou pseudo : la contrainte d'unicité tranche
+            db.session.rollback()
+            refuser_doublon()
+            return redirect(url_for('index'))
+        
+        ouvrir_session(new_user)
+        flash(f'Compte créé et connexion réussie pour @{username}!', 'success')
+        return redirect(url_for('index'))
+
+@app.route('/login', methods=['POST'])
+def login():
+    # 🔒 2. Vérification du jeton CSRF
+    if not check_csrf_token(request):
+        flash('Erreur de sécurité: Jeton invalide. Veuillez réessayer.', 'error')
+        return redirect(url_for('index'))
+        
+    username = request.form['username']
+    password = request.form['password']
+
+    # Refusé avant tout hachage (et avant toute requête SQL)
+    erreur = tentative_refusee(username)
+    if erreur:
+        flash(erreur, 'error')
+        return redirect(url_for('index'))
+
+    with app.app_context():
+        with lectures_sur_replica():
+            user = User.query.filter_by(username=username).first()
+        if user is None and 'replica' in app.config.get('SQLALCHEMY_BINDS', {}):
+            # Compte peut-être trop récent pour le réplica
+            user = User.query.filter_by(username=username).first()
+
+        if user and user.check_password(password):
+            if user.password_needs_rehash():
+                # Le coût a changé depuis l'inscription : le mot de passe en clair est disponible, on en profite
+                user.set_password(password)
+                db.session.commit()
+            ouvrir_session(user)
+            flash(f'Connexion réussie pour @{username}!', 'success')
+        else:
+            flash('Pseudo ou mot de passe incorrect.', 'error')
+            
+        return redirect(url_for('index'))
+
+@app.route('/logout', methods=['POST'])
+def logout():
+    # 🔒 2. Vérification du jeton CSRF
+    if not check_csrf_token(request):
+        flash('Erreur de sécurité: Jeton invalide. Veuillez réessayer.', 'error')
+        return redirect(url_for('index'))
+        
+    fermer_session()
+    flash('Vous êtes déconnecté.', 'success')
+    return redirect(url_for('index'))
+
+@app.route('/upload', methods=['POST'])
+def upload_file():
+    # 🔒 2. Vérification du jeton CSRF
+    if not check_csrf_token(request):
+        flash('Erreur de sécurité: Jeton invalide. Veuillez réessayer.', 'error')
+        return redirect(url_for('index'))
+
+    user = utilisateur_connecte()
+    if not user:
+        flash('Veuillez vous connecter pour publier du contenu.', 'error')
+        return redirect(url_for('index'))
+
+    if 'file' not in request.files:
+        flash('Aucun fichier sélectionné.', 'error')
+        return redirect(url_for('index'))
+
+    file = request.files['file']
+    title = request.form.get('title', 'Vidéo sans titre')
+
+    if file.filename == '':
+        flash('Nom de fichier invalide.', 'error')
+        return redirect(url_for('index'))
+
+    if file:
+        try:
+            verifier_quota(user.id, request.content_length or 0)
+
+            # Sauvegarde du fichier dans le stockage adressé par contenu (haché pendant l'écriture),
+            # refusé dès les premiers octets si ce n'est pas une vidéo
+            input_digest = stocker_flux(file.stream, 'video')
+            sonder_media(input_digest, 'video')
+
+            # --- CONVERSION EN ARRIÈRE-PLAN ---
+            try:
+                publier_video(user, title, input_digest)
+            except Exception:
+                db.session.rollback()
+                liberer_blob(input_digest) # Aucun job ne le référence
+                raise
+            flash(f'"{title}" a été ajouté à la file de conversion.', 'success')
+
+        except FichierRefuse as e:
+            flash(f"Fichier refusé : {e}", 'error')
+        except Exception as e:
+            flash(f"Erreur lors de l'enregistrement de la vidéo: {e}", 'error')
+
+        return redirect(url_for('index'))
+    
+    flash('Erreur lors de l\'upload du fichier.', 'error')
+    return redirect(url_for('index'))
+
+
+@app.route('/convert_gif', methods=['POST'])
+def convert_gif():
+    # 🔒 2. Vérification du jeton CSRF
+    if not check_csrf_token(request):
+        flash('Erreur de sécurité: Jeton invalide. Veuillez réessayer.', 'error')
+        return redirect(url_for('index'))
+
+    user = utilisateur_connecte()
+    if not user:
+        flash('Veuillez vous connecter pour utiliser le convertisseur.', 'error')
+        return redirect(url_for('index'))
+
+    if 'gif_file' not in request.files:
+        flash('Aucun fichier GIF sélectionné.', 'error')
+        return redirect(url_for('index'))
+
+    file = request.files['gif_file']
+    if not file.filename or not file.filename.lower().endswith('.gif'):
+        flash("Seuls les fichiers GIF sont supportés.", 'error')
+        return redirect(url_for('index'))
+
+    try:
+        format, largeur, couleurs = options_gif(request.form)
+    except ValueError as e:
+        flash(str(e), 'error')
+        return redirect(url_for('index'))
+
+    try:
+        # Enregistrer le fichier GIF (haché pendant l'écriture)
+        verifier_quota(user.id, request.content_length or 0)
+        input_digest = stocker_flux(file.stream, 'gif')
+        sonder_media(input_digest, 'gif')
+        convertir_gif(input_digest, user, format, largeur, couleurs)
+        flash(f'Conversion GIF -> {FORMATS_GIF[format][1]} réussie! Téléchargez le résultat.', 'success')
+
+    except FichierRefuse as e:
+        flash(f"Fichier refusé : {e}", 'error')
+    except Exception as e:
+        flash(f"Erreur de conversion GIF : {e}", 'error')
+
+    return redirect(url_for('index'))
+
+
+@app.route('/convert_images', methods=['POST'])
+def convert_images():
     """
-    Réceptionne le message et l'émet UNIQUEMENT aux amis connectés.
+    Conversion par lots : plusieurs images et/ou archives zip (champ `files`), options `format`,
+    `quality`, `width`. La réponse est un zip produit au fil des conversions ; la progression de chaque
+    fichier est poussée par Socket.IO ('batch_progress') avec le `batch_id` fourni par le client.
     """
-    user_username = session.get('user_username', 'Anonyme')
-    text = data.get('text', '...')
+    user, erreur = _utilisateur_api()
+    if erreur:
+        return erreur
+    # Copies des fichiers envoyés : fermées (et supprimées) quand la réponse a été entièrement envoyée
+    pile = contextlib.ExitStack()
+    try:
+        format, qualite, largeur = options_images(request.form)
+        elements = lire_fichiers_lot(request.files.getlist('files'), pile)
+    except (ValueError, FichierRefuse) as e:
+        pile.close()
+        return jsonify(error=str(e)), 400
+
+    batch_id = request.form.get('batch_id', '')[:64]
+    user_id, total = user.id, len(elements)
+
+    def on_fichier(index, nom, erreur):
+        socketio.emit('batch_progress', {'batch_id': batch_id, 'index': index, 'filename': nom,
+                                         'total': total, 'error': erreur}, to=salle_utilisateur(user_id))
+
+    reponse = app.response_class(convertir_lot(elements, format, qualite, largeur, on_fichier),
+                                 mimetype='application/zip', direct_passthrough=True)
+    reponse.headers.set('Content-Disposition', 'attachment', filename=f"images_{format}.zip")
+    reponse.headers['X-Batch-Files'] = str(total)
+    reponse.call_on_close(pile.close)
+    return reponse
+
+
+# --- Upload par morceaux, reprenable (protocole inspiré de tus) ---
+# 1. POST   /uploads                   -> crée la session (nom, taille totale, type)
+# 2. PATCH  /uploads/<id>              -> ajoute un morceau à l'offset `Upload-Offset`
+# 3. HEAD   /uploads/<id>              -> offset courant, pour reprendre après une coupure
+# 4. POST   /uploads/<id>/finalize     -> lance la conversion du fichier complet
+
+ALGOS_CHECKSUM = {'sha256', 'sha1', 'md5'}
+
+# Empreinte SHA-256 du fichier complet calculée au fil des morceaux : upload_id -> (octets hachés, hasher).
+# Propre à chaque processus ; si un morceau arrive sur un autre worker, le fichier est re-haché à la fin.
+_empreintes_uploads = {}
+
+def _utilisateur_api():
+    """Contrôles communs aux routes JSON qui modifient des données : CSRF puis session (retourne (user, erreur))."""
+    if not check_csrf_token(request):
+        return None, (jsonify(error='Jeton CSRF invalide.'), 403)
+    user = utilisateur_connecte()
+    if not user:
+        return None, (jsonify(error='Veuillez vous connecter.'), 401)
+    return user, None
+
+def _charger_upload(upload_id):
+    """Retourne (upload, erreur) pour une session d'upload appartenant à l'utilisateur connecté."""
+    user, erreur = _utilisateur_api()
+    if erreur:
+        return None, erreur
+    upload = db.session.get(UploadSession, upload_id)
+    if not upload or upload.user_id != user.id:
+        return None, (jsonify(error='Upload introuvable.'), 404)
+    return upload, None
+
+def _reponse_offset(upload, code=204):
+    reponse = app.response_class(status=code)
+    reponse.headers['Upload-Offset'] = str(upload.offset)
+    reponse.headers['Upload-Length'] = str(upload.size)
+    reponse.headers['Upload-Chunk-Size'] = str(app.config['UPLOAD_CHUNK_MAX']) # Pour reprendre avec la bonne taille
+    reponse.headers['Cache-Control'] = 'no-store'
+    return reponse
+
+@app.route('/uploads', methods=['POST'])
+def create_upload():
+    user, erreur = _utilisateur_api()
+    if erreur:
+        return erreur
+
+    data = request.get_json(silent=True) or {}
+    filename = secure_filename(data.get('filename', ''))
+    kind = data.get('kind', 'video')
+    try:
+        size = int(data.get('size'))
+    except (TypeError, ValueError):
+        return jsonify(error='Taille de fichier invalide.'), 400
+
+    if not filename:
+        return jsonify(error='Nom de fichier invalide.'), 400
+    if kind not in ('video', 'gif'):
+        return jsonify(error='Type de fichier inconnu.'), 400
+    if kind == 'gif' and not filename.lower().endswith('.gif'):
+        return jsonify(error='Seuls les fichiers GIF sont supportés.'), 400
+    if size <= 0 or size > app.config['UPLOAD_MAX_SIZE']:
+        return jsonify(error='Fichier vide ou trop volumineux.'), 413
+    try:
+        verifier_quota(user.id, size)
+    except QuotaDepasse as e:
+        return jsonify(error=str(e)), 413
+    try:
+        options = data.get('options') or {}
+        options_gif(options)
+    except (AttributeError, ValueError) as e:
+        return jsonify(error=str(e) or 'Options invalides.'), 400
+
+    upload = UploadSession(
+        id=secrets.token_hex(16),
+        user_id=user.id,
+        filename=filename,
+        title=data.get('title') or 'Vidéo sans titre',
+        kind=kind,
+        size=size,
+        options=json.dumps(options),
+        parts='[]'
+    )
+    upload.storage_ref = stockage.debuter_envoi(upload.id)
+    db.session.add(upload)
+    db.session.commit()
+    _empreintes_uploads[upload.id] = (0, hashlib.sha256())
+
+    reponse = jsonify(upload_id=upload.id, offset=0, chunk_size=app.config['UPLOAD_CHUNK_MAX'])
+    reponse.status_code = 201
+    reponse.headers['Location'] = url_for('upload_status', upload_id=upload.id)
+    return reponse
+
+@app.route('/uploads/<upload_id>', methods=['HEAD', 'GET'])
+def upload_status(upload_id):
+    upload, erreur = _charger_upload(upload_id)
+    if erreur:
+        return erreur
+    return _reponse_offset(upload, 200)
+
+@app.route('/uploads/<upload_id>', methods=['PATCH'])
+def upload_chunk(upload_id):
+    upload, erreur = _charger_upload(upload_id)
+    if erreur:
+        return erreur
+
+    try:
+        offset = int(request.headers['Upload-Offset'])
+    except (KeyError, ValueError):
+        return jsonify(error='En-tête Upload-Offset manquant ou invalide.'), 400
+    if offset != upload.offset:
+        # Le client reprend à un mauvais endroit : on lui renvoie l'offset réel
+        return _reponse_offset(upload, 409)
+
+    longueur = request.content_length
+    if longueur is None:
+        return jsonify(error='Content-Length requis.'), 411
+    if longueur > app.config['UPLOAD_CHUNK_MAX'] or offset + longueur > upload.size:
+        return jsonify(error='Morceau trop volumineux.'), 413
+    if offset + longueur < upload.size and longueur < stockage.taille_min_partie:
+        return jsonify(error=f"Morceaux d'au moins {stockage.taille_min_partie} octets (sauf le dernier)."), 400
+
+    # Upload-Checksum: "<algo> <empreinte en base64>"
+    hasher, attendu = None, None
+    if 'Upload-Checksum' in request.headers:
+        algo, _, valeur = request.headers['Upload-Checksum'].partition(' ')
+        if algo not in ALGOS_CHECKSUM:
+            return jsonify(error='Algorithme de checksum non supporté.'), 400
+        try:
+            attendu = base64.b64decode(valeur, validate=True)
+        except ValueError:
+            return jsonify(error='Checksum invalide.'), 400
+        hasher = hashlib.new(algo)
+
+    # Copie de l'empreinte globale : elle n'est conservée que si le morceau est accepté
+    suivi = _empreintes_uploads.get(upload.id)
+    empreinte = suivi[1].copy() if suivi and suivi[0] == offset else None
+
+    # Le morceau est reçu en entier (en mémoire jusqu'à 1 Mio, puis dans l'espace de travail) et vérifié avant
+    # d'être confié au stockage : un morceau incomplet ou corrompu n'y laisse aucune trace
+    taille_buffer = app.config['UPLOAD_BUFFER_SIZE']
+    recu = 0
+    with tempfile.SpooledTemporaryFile(max_size=TAILLE_BUFFER_HASH, dir=_dossier_tmp_blobs()) as morceau:
+        try:
+            while recu < longueur:
+                bloc = request.stream.read(min(taille_buffer, longueur - recu))
+                if not bloc:
+                    break
+                morceau.write(bloc)
+                if hasher:
+                    hasher.update(bloc)
+                if empreinte:
+                    empreinte.update(bloc)
+                recu += len(bloc)
+        except ClientDisconnected:
+            pass
+
+        if recu != longueur:
+            return jsonify(error='Morceau incomplet.'), 400
+        if hasher and hasher.digest() != attendu:
+            return jsonify(error='Checksum du morceau incorrect.'), 460
+
+        morceau.seek(0)
+        if offset == 0:
+            # Premier morceau : le type de fichier se voit dès les premiers octets, inutile d'attendre la suite
+            try:
+                verifier_entete(morceau.read(TAILLE_ENTETE), upload.kind)
+            except FichierRefuse as e:
+                stockage.annuler_envoi(upload.id, upload.storage_ref)
+                _empreintes_uploads.pop(upload.id, None)
+                db.session.delete(upload)
+                db.session.commit()
+                return jsonify(error=str(e)), 415
+            morceau.seek(0)
+
+        parties = json.loads(upload.parts or '[]')
+        with phase('stockage'):
+            partie = stockage.ecrire_partie(upload.id, upload.storage_ref, len(parties) + 1, offset, morceau)
+
+    # UPDATE conditionnel : si le même morceau a été accepté entre-temps (par une autre instance), on s'arrête là
+    accepte = UploadSession.query.filter_by(id=upload.id, offset=offset).update({
+        'offset': offset + recu,
+        'parts': json.dumps(parties + [partie]),
+        'updated_at': datetime.datetime.utcnow(),
+    }, synchronize_session=False)
+    db.session.commit()
+    db.session.refresh(upload)
+    if not accepte:
+        return _reponse_offset(upload, 409)
+    if empreinte:
+        _empreintes_uploads[upload.id] = (upload.offset, empreinte)
+    else:
+        _empreintes_uploads.pop(upload.id, None)
+    return _reponse_offset(upload)
+
+@app.route('/uploads/<upload_id>', methods=['DELETE'])
+def cancel_upload(upload_id):
+    upload, erreur = _charger_upload(upload_id)
+    if erreur:
+        return erreur
+    stockage.annuler_envoi(upload.id, upload.storage_ref)
+    _empreintes_uploads.pop(upload.id, None)
+    db.session.delete(upload)
+    db.session.commit()
+    return '', 204
+
+@app.route('/uploads/<upload_id>/finalize', methods=['POST'])
+def finalize_upload(upload_id):
+    upload, erreur = _charger_upload(upload_id)
+    if erreur:
+        return erreur
+    if upload.offset != upload.size:
+        return _reponse_offset(upload, 409)
+
+    # Entrée du fichier complet dans le stockage adressé par contenu
+    with phase('stockage'):
+        cle = stockage.terminer_envoi(upload.id, upload.storage_ref, json.loads(upload.parts or '[]'))
+        suivi = _empreintes_uploads.pop(upload.id, None)
+        if suivi and suivi[0] == upload.size:
+            input_digest = suivi[1].hexdigest()
+        else:
+            # Morceaux reçus par plusieurs processus : le fichier assemblé est relu
+            with contextlib.closing(stockage.ouvrir(cle)) as flux:
+                input_digest, _ = hacher_flux(flux)
+        ranger_blob(cle, input_digest, upload.size)
+
+    user, kind, title = upload.user_id, upload.kind, upload.title
+    options = json.loads(upload.options or '{}')
+    db.session.delete(upload)
+    db.session.commit()
+
+    try:
+        sonder_media(input_digest, kind)
+    except FichierRefuse as e:
+        return jsonify(error=str(e)), 422
+
+    try:
+        if kind == 'gif':
+            format, largeur, couleurs = options_gif(options)
+            output_filename = convertir_gif(input_digest, db.session.get(User, user), format, largeur, couleurs)
+            flash(f'Conversion GIF -> {FORMATS_GIF[format][1]} réussie! Téléchargez le résultat.', 'success')
+            return jsonify(filename=output_filename)
+
+        try:
+            job = publier_video(db.session.get(User, user), title, input_digest)
+        except Exception:
+            db.session.rollback()
+            liberer_blob(input_digest)
+            raise
+        flash(f'"{title}" a été ajouté à la file de conversion.', 'success')
+        return jsonify(job_id=job.id), 202
+    except Exception as e:
+        return jsonify(error=f"Erreur de conversion : {e}"), 500
+
+
+@app.route('/download/<filename>')
+def download_file(filename):
+    """Permet de télécharger les fichiers convertis (vidéos)."""
+    return servir_media(filename, as_attachment=True)
+
+@app.route('/converted_images/<filename>')
+def download_converted_image(filename):
+    """Affiche les images converties (GIF)."""
+    return servir_media(filename)
+
+
+@app.route('/thumbnails/<filename>/<taille>')
+def thumbnail(filename, taille):
+    """Miniature d'un fichier converti : immuable (le nom contient l'empreinte), donc cache navigateur d'un an."""
+    digest = digest_public(filename)
+    if not digest or taille not in TAILLES_MINIATURES:
+        abort(404)
+
+    nom = nom_miniature(digest, taille)
+    if nom in request.if_none_match:
+        reponse = app.response_class(status=304)
+    else:
+        chemin = cache_miniatures.lire(nom)
+        if chemin is None:
+            # Jamais générée ou évincée du cache : on la recrée depuis le fichier converti
+            if not stockage.existe(cle_blob(digest)):
+                abort(404)
+            try:
+                generer_miniatures(filename, [taille])
+            except Exception:
+                abort(404)
+            chemin = cache_miniatures.lire(nom)
+        reponse = send_file(chemin, mimetype='image/jpeg', etag=nom, conditional=True, max_age=UN_AN)
+
+    reponse.set_etag(nom)
+    reponse.cache_control.public = True
+    reponse.cache_control.max_age = UN_AN
+    reponse.cache_control.immutable = True
+    return reponse
+
+
+@app.route('/hls/<digest>/<path:fichier>')
+def hls(digest, fichier):
+    """Playlists et segments HLS : fichiers statiques et immuables (rangés sous l'empreinte du MP4)."""
+    if not digest_public(f"{digest}.mp4"):
+        abort(404)
+    types = {'.m3u8': 'application/vnd.apple.mpegurl', '.ts': 'video/mp2t'}
+    ext = os.path.splitext(fichier)[1]
+    if ext not in types or '..' in fichier.split('/'):
+        abort(404)
+    if not stockage.url_directes:
+        reponse = send_from_directory(os.path.abspath(stockage.chemin(cle_hls(digest))), fichier,
+                                      mimetype=types[ext], max_age=UN_AN)
+        reponse.cache_control.public = True
+        reponse.cache_control.immutable = True
+        return reponse
+
+    # Stockage objet : les segments sont lus directement dans le bucket. Les playlists passent par ici pour
+    # que chaque segment y soit remplacé par une URL présignée (un bucket privé refuserait les URL relatives).
+    cle = f"{cle_hls(digest)}/{fichier}"
+    if ext == '.ts':
+        return redirect(stockage.url_signee(cle, mimetype=types[ext]))
+    try:
+        with contextlib.closing(stockage.ouvrir(cle)) as flux:
+            lignes = flux.read().decode().splitlines()
+    except FileNotFoundError:
+        abort(404)
+    dossier = posixpath.dirname(cle)
+    lignes = [stockage.url_signee(f"{dossier}/{ligne}", mimetype=types['.ts'])
+              if ligne.endswith('.ts') and not ligne.startswith('#') else ligne for ligne in lignes]
+    reponse = app.response_class('\n'.join(lignes) + '\n', mimetype=types[ext])
+    reponse.cache_control.private = True
+    reponse.cache_control.max_age = app.config['S3_URL_EXPIRES'] // 2
+    return reponse
+
+
+@app.route('/api/storage', methods=['GET'])
+def api_storage():
+    """Espace de stockage utilisé par l'utilisateur connecté et son quota (0 = illimité), en octets."""
+    user = utilisateur_connecte()
+    if not user:
+        return jsonify(error='Veuillez vous connecter.'), 401
+    return jsonify(used=espace_utilise(user.id), quota=app.config['QUOTA_USER_BYTES'],
+                   ttl_days=app.config['MEDIA_TTL_DAYS'])
+
+
+@app.route('/add_friend', methods=['POST'])
+def add_friend():
+    # 🔒 2. Vérification du jeton CSRF
+    if not check_csrf_token(request):
+        flash('Erreur de sécurité: Jeton invalide. Veuillez réessayer.', 'error')
+        return redirect(url_for('index'))
+        
+    user = utilisateur_connecte()
+    if not user:
+        flash('Veuillez vous connecter pour ajouter des amis.', 'error')
+        return redirect(url_for('index'))
     
-    if text and user_username != 'Anonyme':
-        with app.app_context():
-            sender = User.query.filter_by(username=user_username).first()
-            
-            if not sender:
-                return 
+    friend_username = request.form['friend_username']
+
+    if friend_username == user.username:
+        flash("Vous ne pouvez pas vous ajouter vous-même.", 'error')
+        return redirect(url_for('index'))
+    
+    with app.app_context():
+        # L'id de l'ami en une requête (le nôtre est en session), puis un INSERT qui ignore une amitié déjà existante
+        friend_id = db.session.query(User.id).filter_by(username=friend_username).scalar()
 
-            message_data = {'user': user_username, 'text': text}
-            chat_messages.append(message_data)
+        if friend_id is None:
+            flash(f"Le pseudo @{friend_username} n'existe pas.", 'error')
+        elif not ajouter_amities(user.id, [friend_id]):
+            db.session.rollback()
+            flash(f"@{friend_username} est déjà dans votre liste d'amis.", 'info')
+        else:
+            db.session.commit()
+            incrementer_version('messages') # L'historique visible inclut désormais les messages du nouvel ami
+            flash(f"@{friend_username} a été ajouté à vos amis!", 'success')
             
-            # 1. Émettre le message à l'expéditeur lui-même (confirmation)
-            emit('broadcast_message', message_data, room=request.sid)
+    return redirect(url_for('index'))
+
+# --- API JSON des amitiés (opérations groupées) ---
+
+def _pseudos_demandes():
+    """Liste `usernames` du corps JSON (ValueError si absente ou mal formée)."""
+    pseudos = (request.get_json(silent=True) or {}).get('usernames')
+    if not isinstance(pseudos, list) or not all(isinstance(p, str) for p in pseudos):
+        raise ValueError("Le corps doit contenir une liste `usernames`.")
+    if len(pseudos) > 500:
+        raise ValueError("Au plus 500 pseudos par requête.")
+    return set(pseudos)
+
+@app.route('/api/friends', methods=['GET'])
+def api_friends():
+    user = utilisateur_connecte()
+    if not user:
+        return jsonify(error='Veuillez vous connecter.'), 401
+    with lectures_sur_replica():
+        return jsonify(friends=lister_amis([user.id])[user.id])
+
+@app.route('/api/friends', methods=['POST', 'DELETE'])
+def api_friends_bulk():
+    """Ajoute (POST) ou retire (DELETE) plusieurs amis : {"usernames": [...]}."""
+    user, erreur = _utilisateur_api()
+    if erreur:
+        return erreur
+    try:
+        pseudos = _pseudos_demandes()
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+
+    ids = dict(db.session.query(User.username, User.id).filter(User.username.in_(pseudos)))
+    operation = ajouter_amities if request.method == 'POST' else retirer_amities
+    modifies = operation(user.id, ids.values())
+    db.session.commit()
+    if modifies:
+        incrementer_version('messages') # L'historique visible dépend de la liste d'amis
+    return jsonify(changed=modifies, unknown=sorted(pseudos - ids.keys()))
+
+@app.route('/api/friends/suggestions', methods=['GET'])
+def api_friend_suggestions():
+    user = utilisateur_connecte()
+    if not user:
+        return jsonify(error='Veuillez vous connecter.'), 401
+    with lectures_sur_replica():
+        limite = min(max(request.args.get('limit', 10, type=int), 1), 50)
+        return jsonify(suggestions=[{'user': pseudo, 'mutual': nombre} for pseudo, nombre in suggestions_amis(user.id, limite)])
+
+@app.route('/api/friends/mutual/<username>', methods=['GET'])
+def api_mutual_friends(username):
+    user = utilisateur_connecte()
+    if not user:
+        return jsonify(error='Veuillez vous connecter.'), 401
+    with lectures_sur_replica():
+        autre_id = db.session.query(User.id).filter_by(username=username).scalar()
+        if autre_id is None:
+            abort(404)
+        return jsonify(mutual=amis_communs(user.id, autre_id))
+
+
+# --------------------------
+# 6. SOCKETIO (CHAT PRIVÉ)
+# --------------------------
+
+# --- Registre de présence : quels sockets (sur tous les nœuds) appartiennent à quel utilisateur ---
+
+class RegistrePresence:
+    """Interface commune : user_id -> ensemble des sids connectés, tous workers confondus."""
+
+    def ajouter(self, user_id, sid):
+        raise NotImplementedError
+
+    def retirer(self, user_id, sid):
+        raise NotImplementedError
+
+    def sids(self, user_id):
+        raise NotImplementedError
+
+    def sids_de(self, user_ids):
+        """Sids de plusieurs utilisateurs d'un coup : {user_id: set(sids)} (utilisateurs connectés uniquement)."""
+        resultat = {user_id: self.sids(user_id) for user_id in user_ids}
+        return {user_id: sids for user_id, sids in resultat.items() if sids}
+
+    def entretenir(self):
+        """Appelée périodiquement (nettoyage des nœuds disparus, etc.)."""
+
+class PresenceMemoire(RegistrePresence):
+    """Registre propre au processus : suffisant avec un seul worker, et sert de substitut en test."""
+
+    def __init__(self):
+        self._sids = collections.defaultdict(set)
+        self._lock = threading.Lock()
+
+    def ajouter(self, user_id, sid):
+        with self._lock:
+            self._sids[user_id].add(sid)
+
+    def retirer(self, user_id, sid):
+        with self._lock:
+            self._sids[user_id].discard(sid)
+            if not self._sids[user_id]:
+                del self._sids[user_id]
+
+    def sids(self, user_id):
+        with self._lock:
+            return set(self._sids.get(user_id, ()))
+
+class PresenceRedis(RegistrePresence):
+    """
+    Registre partagé dans Redis : un set de sids par utilisateur, plus un set par nœud qui
+    permet de retirer les sockets d'un nœud disparu (crash, redéploiement) dont le battement a expiré.
+    """
+    DUREE_BATTEMENT = 90 # secondes
+
+    def __init__(self, url, prefixe_noeud):
+        if redis is None:
+            raise RuntimeError("Le paquet 'redis' est nécessaire pour PRESENCE_URL.")
+        self.redis = redis.Redis.from_url(url, decode_responses=True)
+        self.prefixe_noeud = prefixe_noeud
+        self.entretenir()
+
+    @property
+    def noeud(self):
+        # Calculé à chaque usage : avec le préchargement, ce registre est créé dans le maître gunicorn, et
+        # chaque worker forké doit avoir son propre nœud (et son propre battement) pour être nettoyé à sa mort
+        return f"{self.prefixe_noeud}:{os.getpid()}"
+
+    @staticmethod
+    def _cle(user_id):
+        return f"presence:user:{user_id}"
+
+    def ajouter(self, user_id, sid):
+        with self.redis.pipeline() as pipe:
+            pipe.sadd(self._cle(user_id), sid)
+            pipe.sadd(f"presence:node:{self.noeud}", f"{user_id}:{sid}")
+            pipe.execute()
+
+    def retirer(self, user_id, sid):
+        with self.redis.pipeline() as pipe:
+            pipe.srem(self._cle(user_id), sid)
+            pipe.srem(f"presence:node:{self.noeud}", f"{user_id}:{sid}")
+            pipe.execute()
+
+    def sids(self, user_id):
+        return self.redis.smembers(self._cle(user_id))
+
+    def sids_de(self, user_ids):
+        user_ids = list(user_ids)
+        with self.redis.pipeline(transaction=False) as pipe:
+            for user_id in user_ids:
+                pipe.smembers(self._cle(user_id))
+            resultats = pipe.execute()
+        return {user_id: sids for user_id, sids in zip(user_ids, resultats) if sids}
+
+    def entretenir(self):
+        self.redis.set(f"presence:alive:{self.noeud}", 1, ex=self.DUREE_BATTEMENT)
+        self.redis.sadd('presence:nodes', self.noeud)
+        for noeud in self.redis.smembers('presence:nodes'):
+            if noeud != self.noeud and not self.redis.exists(f"presence:alive:{noeud}"):
+                for entree in self.redis.smembers(f"presence:node:{noeud}"):
+                    user_id, _, sid = entree.partition(':')
+                    self.redis.srem(self._cle(user_id), sid)
+                self.redis.delete(f"presence:node:{noeud}")
+                self.redis.srem('presence:nodes', noeud)
+
+def creer_registre_presence():
+    if app.config['PRESENCE_URL']:
+        return PresenceRedis(app.config['PRESENCE_URL'], app.config['NODE_ID'])
+    return PresenceMemoire()
+
+presence = creer_registre_presence()
+
+def boucle_presence():
+    """Battement du nœud et nettoyage des nœuds disparus."""
+    while True:
+        socketio.sleep(PresenceRedis.DUREE_BATTEMENT / 3)
+        try:
+            presence.entretenir()
+        except Exception as e:
+            print(f"Entretien du registre de présence impossible: {e}")
+
+
+# --- Écriture des messages du chat par lots (le handler ne fait que les mettre en file) ---
+
+_messages_a_ecrire = collections.deque()
+_messages_en_attente = threading.Event()
+_ecrivain_lock = threading.Lock()
+_ecrivain_demarre = False
+
+def enregistrer_message(user_id, text):
+    """Met le message en file ; il est inséré avec les autres messages du lot par boucle_ecriture_messages."""
+    global _ecrivain_demarre
+    _messages_a_ecrire.append({'user_id': user_id, 'text': text, 'created_at': datetime.datetime.utcnow()})
+    _messages_en_attente.set()
+    if not _ecrivain_demarre:
+        with _ecrivain_lock:
+            if not _ecrivain_demarre:
+                _ecrivain_demarre = True
+                socketio.start_background_task(boucle_ecriture_messages)
+
+def ecrire_messages_en_attente():
+    """Un INSERT multi-lignes et une seule invalidation du fil pour tout le lot."""
+    lot = []
+    while _messages_a_ecrire:
+        lot.append(_messages_a_ecrire.popleft())
+    if not lot:
+        return 0
+    try:
+        db.session.execute(ChatMessage.__table__.insert(), lot)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        _messages_a_ecrire.extendleft(reversed(lot)) # Réessayé au prochain passage
+        raise
+    incrementer_version('messages')
+    return len(lot)
+
+def boucle_ecriture_messages():
+    while True:
+        _messages_en_attente.wait()
+        socketio.sleep(app.config['CHAT_FLUSH_INTERVAL']) # Regroupe les messages arrivés entre-temps
+        _messages_en_attente.clear()
+        with app.app_context():
+            try:
+                ecrire_messages_en_attente()
+            except Exception as e:
+                print(f"Écriture des messages du chat impossible: {e}")
+                _messages_en_attente.set()
+
+@atexit.register
+def _vider_messages_a_la_sortie():
+    if _messages_a_ecrire:
+        with app.app_context():
+            ecrire_messages_en_attente()
+
+
+# --- Salles Socket.IO : une par utilisateur (tous ses onglets et appareils), une par conversation ---
+
+def salle_utilisateur(user_id):
+    return f"user:{user_id}"
+
+def salle_session(identifiant):
+    """Les sockets ouverts avec une session web : fermés à la déconnexion (empreinte, jamais l'identifiant lui-même)."""
+    return f"session:{empreinte_session(identifiant)}"
+
+def salle_conversation(user_id):
+    """Les sockets des amis de l'utilisateur : un message y est émis une fois, quel que soit le nombre d'amis."""
+    return f"amis:{user_id}"
+
+def salles_chat(user_id):
+    """Salles qu'un socket de l'utilisateur rejoint à la connexion (avec app context : amis en cache)."""
+    return [salle_utilisateur(user_id), *(salle_conversation(ami_id) for ami_id in graphe_amis.amis(user_id))]
+
+def synchroniser_salles_amis(user_id, ami_ids, ajout):
+    """
+    Fait entrer (ou sortir) les sockets déjà connectés des deux côtés dans la conversation de l'autre.
+    Les sockets d'un autre nœud sont mis à jour par celui-ci (via la file de messages Socket.IO).
+    """
+    operation = socketio.server.enter_room if ajout else socketio.server.leave_room
+    sids = presence.sids_de([user_id, *ami_ids])
+    for ami_id in ami_ids:
+        for sid in sids.get(user_id, ()):
+            operation(sid, salle_conversation(ami_id), namespace='/')
+        for sid in sids.get(ami_id, ()):
+            operation(sid, salle_conversation(user_id), namespace='/')
+
+
+# --- Distribution des messages du chat : lots par conversation et contre-pression par connexion ---
+
+class DistributeurChat:
+    """
+    Les messages d'une conversation arrivés pendant la fenêtre partent en un seul événement 'chat_batch',
+    émis une fois vers les salles de l'expéditeur (le paquet est encodé une fois pour tous les destinataires).
+    Contre-pression : un socket local dont la file d'envoi engine.io dépasse `file_max` paquets (client lent,
+    onglet gelé) quitte ses salles de chat, ce qui borne sa mémoire ; une fois sa file vidée, il les rejoint
+    et reçoit 'chat_resync' pour recharger l'historique manqué.
+    """
+    PERIODE_SURVEILLANCE = 1.0 # secondes
+
+    def __init__(self, fenetre, taille_lot, file_max):
+        self.fenetre = fenetre
+        self.taille_lot = taille_lot
+        self.file_max = file_max
+        self._lots = {} # tuple de salles -> messages de la fenêtre en cours
+        self._locaux = {} # sid connecté à ce processus -> user_id
+        self._en_pause = set() # sids retirés de leurs salles en attendant que leur file se vide
+        self._lock = threading.Lock()
+        self._reveil = threading.Event()
+        self._demarre = False
+
+    def _demarrer(self):
+        with self._lock:
+            if self._demarre:
+                return
+            self._demarre = True
+        socketio.start_background_task(self._boucle)
+
+    def suivre(self, sid, user_id):
+        self._locaux[sid] = user_id
+        self._demarrer()
+
+    def oublier(self, sid):
+        """Socket déconnecté (Socket.IO le retire lui-même de ses salles)."""
+        self._locaux.pop(sid, None)
+        self._en_pause.discard(sid)
+
+    def envoyer(self, salles, message):
+        with self._lock:
+            self._lots.setdefault(tuple(salles), []).append(message)
+        self._demarrer()
+        self._reveil.set()
+
+    @staticmethod
+    def _file_connexion(sid):
+        """Paquets en attente d'écriture sur la connexion du socket (0 si elle n'est pas sur ce processus)."""
+        eio_sid = socketio.server.manager.eio_sid_from_sid(sid, '/')
+        connexion = socketio.server.eio.sockets.get(eio_sid) if eio_sid else None
+        return connexion.queue.qsize() if connexion else 0
+
+    def _surveiller(self):
+        for sid, user_id in list(self._locaux.items()):
+            taille = self._file_connexion(sid)
+            if sid not in self._en_pause and taille > self.file_max:
+                self._en_pause.add(sid)
+                for salle in salles_chat(user_id):
+                    socketio.server.leave_room(sid, salle, namespace='/')
+            elif sid in self._en_pause and taille == 0:
+                self._en_pause.discard(sid)
+                for salle in salles_chat(user_id):
+                    socketio.server.enter_room(sid, salle, namespace='/')
+                socketio.emit('chat_resync', {}, to=sid)
+
+    def _boucle(self):
+        prochaine_surveillance = time.monotonic() + self.PERIODE_SURVEILLANCE
+        while True:
+            # Réveillée par un nouveau message ; sinon périodiquement pour surveiller les connexions
+            self._reveil.wait(self.PERIODE_SURVEILLANCE)
+            socketio.sleep(self.fenetre) # Regroupe les messages arrivés entre-temps
+            self._reveil.clear()
+            with self._lock:
+                lots, self._lots = self._lots, {}
+            for salles, messages in lots.items():
+                for debut in range(0, len(messages), self.taille_lot):
+                    try:
+                        socketio.emit('chat_batch', {'messages': messages[debut:debut + self.taille_lot]},
+                                      to=list(salles))
+                    except Exception as e:
+                        print(f"Envoi d'un lot du chat impossible: {e}")
+
+            if time.monotonic() >= prochaine_surveillance:
+                prochaine_surveillance = time.monotonic() + self.PERIODE_SURVEILLANCE
+                with app.app_context():
+                    try:
+                        self._surveiller()
+                    except Exception as e:
+                        print(f"Surveillance des connexions du chat impossible: {e}")
 
-            # 2. Émettre le message à chaque ami connecté
-            friends_list = sender.friends.all()
+distributeur_chat = DistributeurChat(
+    app.config['CHAT_BATCH_WINDOW'], app.config['CHAT_BATCH_MAX'], app.config['CHAT_SEND_QUEUE_MAX'])
 
-            for friend in friends_list:
-                friend_sid = user_sid_map.get(friend.id)
 
-                if friend_sid:
-                    # Émet le message uniquement au socket de cet ami
-                    emit('broadcast_message', message_data, room=friend_sid)
-                    print(f"Message de @{user_username} envoyé à @{friend.username}.")
+@socketio.on('connect')
+def handle_connect():
+    with app.app_context(), lectures_sur_replica():
+        user = utilisateur_connecte()
+        if user:
+            # Résolu une seule fois (profil en cache) : les événements suivants de ce socket utilisent la copie
+            # de session du socket
+            session['user_username'] = user.username
+            # Fermé à la déconnexion de la session web, même si les cookies du navigateur restent
+            identifiant = app.session_interface.identifiant(app, request)
+            if identifiant:
+                join_room(salle_session(identifiant))
+            # Enregistre le socket (un utilisateur peut en avoir plusieurs) : le registre de présence sert
+            # à mettre à jour les salles des sockets connectés quand les amitiés changent
+            presence.ajouter(user.id, request.sid)
+            # Salle personnelle et conversation de chaque ami : ses messages arrivent par là
+            for salle in salles_chat(user.id):
+                join_room(salle)
+            distributeur_chat.suivre(request.sid, user.id)
+            print(f"User @{user.username} connected with SID: {request.sid}")
+
+@socketio.on('disconnect')
+def handle_disconnect():
+    user_id = session.get('user_id')
+    distributeur_chat.oublier(request.sid)
+    # Retire ce socket du registre de présence
+    if user_id:
+        presence.retirer(user_id, request.sid)
+        print(f"User @{session.get('user_username')} disconnected.")
+
+
+@socketio.on('new_message')
+def handle_new_message(data):
+    """
+    Réceptionne le message et l'émet UNIQUEMENT aux amis connectés (et à tous les onglets de l'expéditeur).
+    Aucune requête SQL : id en session, écriture différée ; un seul emit par lot, vers deux salles
+    (personnelle et conversation), quel que soit le nombre d'amis.
+    """
+    evenements_socketio.inc(event='new_message')
+    user_username = session.get('user_username', 'Anonyme')
+    user_id = session.get('user_id')
+    text = data.get('text', '...')
+    
+    if text and user_id:
+        message_data = {'user': user_username, 'text': text}
+        enregistrer_message(user_id, text)
+        distributeur_chat.envoyer([salle_utilisateur(user_id), salle_conversation(user_id)], message_data)
     else:
         # Message d'erreur à l'expéditeur
         error_data = {'user': 'Système', 'text': 'Veuillez vous connecter pour parler.'}
@@ -732,14 +4737,258 @@ def handle_new_message(data):
 
 
 # --------------------------
-# 7. LANCEMENT 
+# 7. FILE DE CONVERSION (WORKERS EN ARRIÈRE-PLAN)
+# --------------------------
+
+# Libellés affichés dans la grille de vidéos
+STATUTS_JOB = {
+    'queued': "En file d'attente",
+    'running': 'Conversion en cours',
+    'done': 'Converti',
+    'failed': 'Échec de la conversion',
+}
+
+# Réveille les workers de ce processus dès qu'un job est ajouté (sinon ils sondent la base)
+_nouveau_job = threading.Event()
+_workers_lock = threading.Lock()
+_workers_demarres = False
+INTERVALLE_SONDAGE = 2.0
+
+def enqueue_conversion(user, title, input_digest):
+    """Inscrit un job de conversion dans la file persistante et réveille les workers."""
+    job = ConversionJob(
+        user_id=user.id,
+        title=title,
+        input_digest=input_digest,
+        max_attempts=app.config['CONVERSION_MAX_ATTEMPTS']
+    )
+    db.session.add(job)
+    db.session.commit()
+    _nouveau_job.set()
+    return job
+
+def reserver_job(worker_name):
+    """
+    Prend le plus ancien job 'queued' et le passe en 'running'. Les gros jobs récents (coût estimé
+    par le sondage au-delà de CONVERSION_LARGE_JOB_COST) passent après les petits, le temps
+    CONVERSION_LARGE_JOB_MAX_WAIT : une vidéo d'une heure ne bloque pas une file de clips courts.
+    L'UPDATE conditionnel sert de verrou : si un autre worker (ou un autre processus)
+    l'a pris entre-temps, aucune ligne n'est modifiée et on réessaie avec le suivant.
+    """
+    while True:
+        patience = datetime.datetime.utcnow() - datetime.timedelta(seconds=app.config['CONVERSION_LARGE_JOB_MAX_WAIT'])
+        gros_et_recent = db.case((db.and_(MediaProbe.cost > app.config['CONVERSION_LARGE_JOB_COST'],
+                                          ConversionJob.created_at > patience), 1), else_=0)
+        job_id = db.session.query(ConversionJob.id).filter_by(status='queued') \
+            .outerjoin(MediaProbe, MediaProbe.digest == ConversionJob.input_digest) \
+            .order_by(gros_et_recent, ConversionJob.id).limit(1).scalar()
+        if job_id is None:
+            return None
+
+        pris = ConversionJob.query.filter_by(id=job_id, status='queued').update({
+            'status': 'running',
+            'attempts': ConversionJob.attempts + 1,
+            'worker': worker_name,
+            'updated_at': datetime.datetime.utcnow(),
+        }, synchronize_session=False)
+        db.session.commit()
+        if pris:
+            return db.session.get(ConversionJob, job_id)
+
+def recuperer_jobs_abandonnes():
+    """Remet en file les jobs 'running' dont le worker a disparu (redémarrage, crash)."""
+    limite = datetime.datetime.utcnow() - datetime.timedelta(seconds=app.config['CONVERSION_STALE_AFTER'])
+    ConversionJob.query.filter(
+        ConversionJob.status == 'running',
+        ConversionJob.updated_at < limite
+    ).update({'status': 'queued'}, synchronize_session=False)
+    db.session.commit()
+
+def notifier_job(job):
+    """Pousse l'état du job au propriétaire via Socket.IO (s'il est connecté)."""
+    socketio.emit('job_progress', {
+        'job_id': job.id,
+        'status': job.status,
+        'label': STATUTS_JOB[job.status],
+        'progress': round(job.progress * 100),
+        'converted_filename': job.output_filename,
+        'hls': job.status == 'done' and playlist_hls(job.output_filename),
+    }, to=salle_utilisateur(job.user_id))
+
+def _mettre_a_jour_video(job):
+    """Reporte l'état du job sur la vidéo correspondante du fil."""
+    Video.query.filter_by(job_id=job.id).update({
+        'status': job.status,
+        'converted_filename': job.output_filename,
+    }, synchronize_session=False)
+    db.session.commit()
+    incrementer_version('videos')
+
+def executer_job(job):
+    """Lance ffmpeg pour un job réservé et gère succès, nouvelle tentative ou échec définitif."""
+    dernier_pourcentage = [-1]
+
+    def on_progress(fraction):
+        pourcentage = int(fraction * 100)
+        if pourcentage == dernier_pourcentage[0]:
+            return
+        dernier_pourcentage[0] = pourcentage
+        job.progress = fraction
+        job.updated_at = datetime.datetime.utcnow()
+        db.session.commit()
+        notifier_job(job)
+
+    notifier_job(job)
+    try:
+        job.output_filename = convert_to_mp4(job.input_digest, on_progress)
+        job.status = 'done'
+        job.error = None
+        generer_miniatures_sans_erreur(job.output_filename)
+    except Exception as e:
+        db.session.rollback()
+        job.error = str(e)
+        job.progress = 0.0
+        job.status = 'queued' if job.attempts < job.max_attempts else 'failed'
+        print(f"Job {job.id}: tentative {job.attempts}/{job.max_attempts} échouée: {e}")
+
+    job.updated_at = datetime.datetime.utcnow()
+    db.session.commit()
+
+    # La vidéo source n'est plus utile une fois le job terminé (réussi ou définitivement échoué)
+    if job.status in ('done', 'failed'):
+        liberer_blob(job.input_digest)
+
+    _mettre_a_jour_video(job)
+    notifier_job(job)
+    if job.status == 'queued':
+        _nouveau_job.set()
+
+def boucle_worker(worker_name):
+    """Boucle d'un worker : réserve un job, le convertit, recommence."""
+    while True:
+        with app.app_context():
+            try:
+                job = reserver_job(worker_name)
+                if job:
+                    executer_job(job)
+                    continue
+            except Exception as e:
+                db.session.rollback()
+                print(f"Worker {worker_name}: erreur inattendue: {e}")
+
+        _nouveau_job.wait(INTERVALLE_SONDAGE)
+        _nouveau_job.clear()
+
+def demarrer_workers(nombre=None):
+    """Démarre (une seule fois par processus) le pool de workers de conversion."""
+    global _workers_demarres
+    nombre = app.config['CONVERSION_WORKERS'] if nombre is None else nombre
+
+    with _workers_lock:
+        if _workers_demarres or nombre <= 0:
+            return []
+        _workers_demarres = True
+
+    with app.app_context():
+        recuperer_jobs_abandonnes()
+
+    prefixe = f"{os.uname().nodename}:{os.getpid()}"
+    return [socketio.start_background_task(boucle_worker, f"{prefixe}:{i}") for i in range(nombre)]
+
+def boucle_balayage():
+    """Balayage périodique du stockage ; un seul processus balaie à la fois (verrou fichier)."""
+    while True:
+        socketio.sleep(app.config['SWEEP_INTERVAL'])
+        with app.app_context():
+            try:
+                stats = balayer_stockage()
+                if stats and any(stats.values()):
+                    print("Balayage du stockage : " + ", ".join(f"{k}={v}" for k, v in stats.items() if v))
+            except Exception as e:
+                db.session.rollback()
+                print(f"Balayage du stockage impossible: {e}")
+
+def demarrer_balayage():
+    if app.config['SWEEP_INTERVAL'] > 0:
+        socketio.start_background_task(boucle_balayage)
+
+_taches_demarrees = False
+
+@app.before_request
+def _demarrer_taches_de_fond():
+    # Démarrées dans chaque processus gunicorn après le fork (les threads ne survivent pas au fork)
+    global _taches_demarrees
+    if _taches_demarrees:
+        return
+    with _workers_lock:
+        if _taches_demarrees:
+            return
+        _taches_demarrees = True
+    demarrer_workers()
+    demarrer_balayage()
+    if isinstance(presence, PresenceRedis):
+        socketio.start_background_task(boucle_presence)
+
+
+# --------------------------
+# 8. LANCEMENT 
 # --------------------------
 
-# IMPORTANT : Pour Render, nous utilisons Gunicorn pour servir l'application. 
-# La commande de démarrage sur Render sera généralement: `gunicorn app:app` (ou `gunicorn app:socketio.server` si vous utilisez Flask-SocketIO)
-# Le worker doit être compatible (ex: gevent ou eventlet) si vous utilisez SocketIO en production.
+# En production : `gunicorn 'app:create_app()'` avec gunicorn.conf.py (workers gevent, schéma créé avant le fork).
+# `python app.py` lance le serveur de développement ; `python app.py init` prépare seulement l'instance.
+
+_instance_prete = False
+
+def preparer_instance():
+    """
+    Dossiers et tables manquantes. Idempotente ; exécutée une fois par déploiement, avant le fork des
+    workers (voir gunicorn.conf.py), plutôt qu'à l'import du module dans chaque worker.
+    """
+    global _instance_prete
+    for folder in [app.config['UPLOAD_FOLDER'], app.config['CONVERTED_FOLDER']]:
+        os.makedirs(folder, exist_ok=True)
+    with app.app_context():
+        try:
+            db.create_all()
+            print("Tables de la base de données créées/vérifiées avec succès.")
+        except Exception as e:
+            print(f"Échec de la création des tables lors du démarrage: {e}")
+        # Les connexions ouvertes ici ne doivent pas être partagées par les workers forkés ensuite
+        for moteur in db.engines.values():
+            moteur.dispose()
+    _instance_prete = True
+
+def create_app():
+    """
+    Point d'entrée WSGI de production. L'application reste celle du module (routes et handlers Socket.IO
+    y sont déclarés) ; la fabrique ne fait que préparer l'instance si le hook pré-fork de gunicorn.conf.py
+    ne l'a pas déjà fait (APP_INSTANCE_READY=1).
+    """
+    if not _instance_prete and os.environ.get('APP_INSTANCE_READY') != '1':
+        debut = time.perf_counter()
+        preparer_instance()
+        print(f"Instance préparée en {1000 * (time.perf_counter() - debut):.0f} ms (mode {socketio.async_mode})")
+    return app
 
 if __name__ == '__main__':
-    PORT_CHOISI = 5003 
-    # Le mode debug=True n'est pas utilisé en production sur Render
-    socketio.run(app, debug=True, port=PORT_CHOISI)
\ No newline at end of file
+    if len(sys.argv) > 1 and sys.argv[1] == 'init':
+        # Dossiers et schéma seulement (hook pré-fork, étape de déploiement) : `python app.py init`
+        preparer_instance()
+    elif len(sys.argv) > 1 and sys.argv[1] == 'worker':
+        # Processus de conversion dédié : `python app.py worker [nombre]`
+        preparer_instance()
+        nombre = int(sys.argv[2]) if len(sys.argv) > 2 else max(app.config['CONVERSION_WORKERS'], 1)
+        if app.config['METRICS_PORT']:
+            servir_metriques(app.config['METRICS_PORT'])
+        demarrer_balayage()
+        for thread in demarrer_workers(nombre):
+            thread.join()
+    elif len(sys.argv) > 1 and sys.argv[1] == 'sweep':
+        # Une passe de balayage du stockage (cron, maintenance) : `python app.py sweep`
+        preparer_instance()
+        with app.app_context():
+            print(balayer_stockage() or "Balayage déjà en cours dans un autre processus.")
+    else:
+        PORT_CHOISI = 5003 
+        # Le mode debug=True n'est pas utilisé en production sur Render
+        socketio.run(create_app(), debug=True, port=PORT_CHOISI)
@@ -0,0 +1,195 @@
+"""
+Test de charge du chat : N utilisateurs tous amis entre eux, chacun connecté par un client Socket.IO
+simulé qui envoie `--debit` messages par seconde. Chaque message est livré à N sockets (l'expéditeur et
+ses amis) ; on mesure le débit livré (messages/s), la latence p50/p99 et le nombre moyen de messages par
+événement 'chat_batch', pour chaque fenêtre de regroupement (CHAT_BATCH_WINDOW) demandée.
+
+`--lent` ajoute un client ami de tous qui cesse de lire son websocket (tampon de réception minuscule) :
+au-delà de CHAT_SEND_QUEUE_MAX paquets en attente, le serveur le sort de ses salles au lieu de bufferiser
+sans limite, puis lui envoie 'chat_resync' quand il a tout lu. Les autres clients ne doivent pas être ralentis.
+Avec les réglages par défaut il faut un débit élevé pour remplir les tampons TCP ; CHAT_SEND_QUEUE_MAX
+(passé au serveur depuis l'environnement) permet d'abaisser le seuil.
+
+    python benchmarks/bench_chat.py
+    python benchmarks/bench_chat.py --utilisateurs 30 --debit 5 --duree 10 --fenetres 0,0.02,0.05,0.1
+    CHAT_SEND_QUEUE_MAX=20 python benchmarks/bench_chat.py --debit 20 --lent
+
+Dépendances du client de test : requests, python-socketio[client], websocket-client.
+"""
+import argparse
+import json
+import os
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import websocket
+
+from bench_socket_fanout import attendre_port, client_socket, connecter, serveur
+
+PORT = 5400
+
+
+class Compteurs:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latences = []
+        self.evenements = 0
+
+
+def ecouter(client, compteurs):
+    @client.on('chat_batch')
+    def reception(lot):
+        maintenant = time.time()
+        with compteurs.lock:
+            compteurs.evenements += 1
+            compteurs.latences.extend(maintenant - json.loads(m['text'])['t'] for m in lot['messages'])
+
+
+def client_lent(url, http):
+    """Client Socket.IO minimal sur un websocket brut, qui ne lit plus rien une fois connecté."""
+    cookie = '; '.join(f"{k}={v}" for k, v in http.cookies.items())
+    ws = websocket.create_connection(url.replace('http', 'ws', 1) + '/socket.io/?EIO=4&transport=websocket',
+                                     cookie=cookie, sockopt=[(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)])
+    ws.recv() # Ouverture engine.io
+    ws.send('40') # Connexion au namespace /
+    ws.recv()
+    return ws
+
+
+def vider_client_lent(ws, delai):
+    """Lit enfin tout ce que le serveur a envoyé : (messages reçus, événements chat_resync)."""
+    recus = resync = 0
+    ws.settimeout(delai)
+    try:
+        while True:
+            paquet = ws.recv()
+            if paquet == '2':
+                ws.send('3') # Ping engine.io
+            elif paquet.startswith('42'):
+                evenement, *donnees = json.loads(paquet[2:])
+                if evenement == 'chat_batch':
+                    recus += len(donnees[0]['messages'])
+                elif evenement == 'chat_resync':
+                    resync += 1
+    except websocket.WebSocketTimeoutException:
+        pass
+    ws.close()
+    return recus, resync
+
+
+def emettre(client, nom, debit, fin, envoyes, lock):
+    n = 0
+    prochain = time.time()
+    while prochain < fin:
+        client.emit('new_message', {'text': json.dumps({'u': nom, 'i': n, 't': time.time()})})
+        n += 1
+        prochain += 1 / debit
+        time.sleep(max(prochain - time.time(), 0))
+    with lock:
+        envoyes.append(n)
+
+
+def mesurer(fenetre, utilisateurs, debit, duree, lent):
+    url = f"http://127.0.0.1:{PORT}"
+    with tempfile.TemporaryDirectory() as dossier:
+        env = dict(os.environ,
+                   DATABASE_URL=f"sqlite:///{os.path.join(dossier, 'chat.db')}",
+                   CONVERSION_WORKERS='0',
+                   SECRET_KEY='bench-chat',
+                   PASSWORD_HASH_ITERATIONS='1000',
+                   LOGIN_ATTEMPTS_PER_IP='100000',
+                   CHAT_BATCH_WINDOW=str(fenetre))
+        processus = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--serveur', str(PORT), dossier],
+                                     env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                                     start_new_session=True)
+        try:
+            attendre_port(PORT)
+            noms = [f"u{i}" for i in range(utilisateurs)] + (['lent'] if lent else [])
+            sessions = {nom: connecter(url, nom) for nom in noms}
+            for nom, http in sessions.items():
+                http.post(url + '/api/friends', json={'usernames': [n for n in noms if n != nom]},
+                          headers={'X-CSRF-Token': http.csrf})
+
+            compteurs = Compteurs()
+            clients = {}
+            for i in range(utilisateurs):
+                clients[f"u{i}"] = client_socket(url, sessions[f"u{i}"])
+                ecouter(clients[f"u{i}"], compteurs)
+            ws_lent = client_lent(url, sessions['lent']) if lent else None
+            time.sleep(0.5)
+
+            envoyes, lock = [], threading.Lock()
+            debut = time.time()
+            threads = [threading.Thread(target=emettre, args=(clients[f"u{i}"], f"u{i}", debit, debut + duree,
+                                                              envoyes, lock)) for i in range(utilisateurs)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            # Chaque message est livré aux `utilisateurs` clients rapides (expéditeur compris)
+            attendus = sum(envoyes) * utilisateurs
+            limite = time.time() + 30
+            while len(compteurs.latences) < attendus and time.time() < limite:
+                time.sleep(0.05)
+            ecoule = time.time() - debut
+            # La surveillance des connexions passe toutes les secondes : 3 s laissent le temps au chat_resync
+            lent_recus, lent_resync = vider_client_lent(ws_lent, 3) if lent else (0, 0)
+
+            for client in clients.values():
+                client.disconnect()
+        finally:
+            # Tout le groupe : les processus du pool de hachage des mots de passe garderaient le port ouvert
+            os.killpg(processus.pid, signal.SIGTERM)
+            processus.wait()
+
+    latences = sorted(compteurs.latences)
+    return {
+        'envoyes': sum(envoyes),
+        'livres': len(latences),
+        'attendus': attendus,
+        'livres_par_seconde': len(latences) / ecoule,
+        'p50_ms': 1000 * statistics.median(latences) if latences else float('nan'),
+        'p99_ms': 1000 * latences[max(int(len(latences) * 0.99) - 1, 0)] if latences else float('nan'),
+        'messages_par_evenement': len(latences) / max(compteurs.evenements, 1),
+        'lent_recus': lent_recus,
+        'lent_resync': lent_resync,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--utilisateurs', type=int, default=20)
+    parser.add_argument('--debit', type=float, default=2.0, help='Messages par seconde et par utilisateur')
+    parser.add_argument('--duree', type=float, default=5.0, help="Durée de l'envoi (secondes)")
+    parser.add_argument('--fenetres', default='0,0.05', help='Valeurs de CHAT_BATCH_WINDOW à mesurer')
+    parser.add_argument('--lent', action='store_true', help='Ajoute un client qui ne lit plus son websocket')
+    parser.add_argument('--serveur', nargs=2, metavar=('PORT', 'DOSSIER'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serveur:
+        serveur(int(args.serveur[0]), args.serveur[1])
+        return
+
+    print(f"{args.utilisateurs} utilisateurs x {args.debit} msg/s pendant {args.duree} s")
+    entete = f"{'fenêtre s':>10}{'livrés':>16}{'livrés/s':>10}{'p50 ms':>9}{'p99 ms':>9}{'msg/lot':>9}"
+    if args.lent:
+        entete += f"{'lent reçus':>12}{'resync':>8}"
+    print(entete)
+    for fenetre in (float(v) for v in args.fenetres.split(',')):
+        r = mesurer(fenetre, args.utilisateurs, args.debit, args.duree, args.lent)
+        ligne = (f"{fenetre:>10}{r['livres']:>9}/{r['attendus']:<6}{r['livres_par_seconde']:>10.0f}"
+                 f"{r['p50_ms']:>9.1f}{r['p99_ms']:>9.1f}{r['messages_par_evenement']:>9.1f}")
+        if args.lent:
+            ligne += f"{r['lent_recus']:>12}{r['lent_resync']:>8}"
+        print(ligne)
+
+
+if __name__ == '__main__':
+    main()
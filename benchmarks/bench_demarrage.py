@@ -0,0 +1,156 @@
+"""
+Benchmark du démarrage en production (gunicorn 'app:create_app()' avec gunicorn.conf.py) et de la tenue
+des connexions websocket, selon la classe de worker et le préchargement de l'application :
+
+    démarrage   du lancement de gunicorn à la première réponse HTTP 200 (démarrage à froid)
+    RSS         mémoire résidente du maître et des workers
+    websockets  connexions Socket.IO ouvertes et gardées ouvertes avec succès (sur --websockets demandées)
+    threads     threads système du worker pendant que ces connexions sont ouvertes
+    GET ms      latence d'une page pendant ce temps
+
+En gthread, chaque websocket occupe un thread du worker (GUNICORN_THREADS) ; avec gevent, une green thread.
+
+    python benchmarks/bench_demarrage.py
+    python benchmarks/bench_demarrage.py --modes gthread,gevent,gevent-sans-preload --websockets 500 --workers 2
+
+Dépendances : gunicorn, gevent (pour les modes gevent), requests, websocket-client.
+"""
+import argparse
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+import websocket
+
+RACINE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PAGE = os.sysconf('SC_PAGE_SIZE')
+
+
+def port_libre():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def processus_gunicorn(pid_maitre):
+    with open(f"/proc/{pid_maitre}/task/{pid_maitre}/children") as f:
+        return [pid_maitre] + [int(pid) for pid in f.read().split()]
+
+
+def rss_mo(pids):
+    total = 0
+    for pid in pids:
+        with open(f"/proc/{pid}/statm") as f:
+            total += int(f.read().split()[1]) * PAGE
+    return total / 1024 / 1024
+
+
+def threads_workers(pids):
+    total = 0
+    for pid in pids[1:]:
+        with open(f"/proc/{pid}/status") as f:
+            total += next(int(l.split()[1]) for l in f if l.startswith('Threads:'))
+    return total
+
+
+def ouvrir_websocket(url, ouverts, lock, fermer):
+    """Connexion Socket.IO minimale (poignée de main engine.io + namespace), gardée ouverte jusqu'à `fermer`."""
+    try:
+        ws = websocket.create_connection(url.replace('http', 'ws', 1) + '/socket.io/?EIO=4&transport=websocket',
+                                         timeout=10)
+        ws.recv()
+        ws.send('40')
+        ws.recv()
+    except Exception:
+        return
+    with lock:
+        ouverts.append(ws)
+    fermer.wait()
+    ws.close()
+
+
+def mesurer(mode, workers, nombre_websockets):
+    classe, _, variante = mode.partition('-')
+    port = port_libre()
+    url = f"http://127.0.0.1:{port}"
+    with tempfile.TemporaryDirectory() as dossier:
+        env = dict(os.environ,
+                   PYTHONPATH=RACINE,
+                   DATABASE_URL=f"sqlite:///{os.path.join(dossier, 'demarrage.db')}",
+                   CONVERSION_WORKERS='0',
+                   SECRET_KEY='bench-demarrage',
+                   GUNICORN_WORKER_CLASS=classe,
+                   GUNICORN_PRELOAD='0' if variante == 'sans-preload' else '1',
+                   WEB_CONCURRENCY=str(workers))
+        debut = time.perf_counter()
+        serveur = subprocess.Popen(
+            [sys.executable, '-m', 'gunicorn', '-c', os.path.join(RACINE, 'gunicorn.conf.py'), '-b', f"127.0.0.1:{port}",
+             'app:create_app()'], cwd=dossier, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+            start_new_session=True)
+        try:
+            demarrage = None
+            while time.perf_counter() - debut < 60:
+                try:
+                    if requests.get(url + '/', timeout=1).status_code == 200:
+                        demarrage = time.perf_counter() - debut
+                        break
+                except requests.RequestException:
+                    time.sleep(0.02)
+            if demarrage is None:
+                raise RuntimeError(f"gunicorn ({mode}) n'a pas répondu")
+            time.sleep(0.5) # Les autres workers finissent de démarrer
+
+            ouverts, lock, fermer = [], threading.Lock(), threading.Event()
+            threads = [threading.Thread(target=ouvrir_websocket, args=(url, ouverts, lock, fermer), daemon=True)
+                       for _ in range(nombre_websockets)]
+            for thread in threads:
+                thread.start()
+            limite = time.time() + 15
+            while len(ouverts) < nombre_websockets and time.time() < limite:
+                time.sleep(0.1)
+
+            pids = processus_gunicorn(serveur.pid)
+            avant = time.perf_counter()
+            try:
+                requests.get(url + '/', timeout=10)
+                get_ms = 1000 * (time.perf_counter() - avant)
+            except requests.RequestException:
+                get_ms = float('nan') # Plus aucun thread libre pour servir la page
+            resultat = {
+                'demarrage_ms': 1000 * demarrage,
+                'rss_mo': rss_mo(pids),
+                'websockets': len(ouverts),
+                'threads': threads_workers(pids),
+                'get_ms': get_ms,
+            }
+            fermer.set()
+        finally:
+            # Tout le groupe : les pools de processus de l'application garderaient le port ouvert
+            os.killpg(serveur.pid, signal.SIGTERM)
+            serveur.wait()
+    return resultat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--modes', default='gthread,gthread-sans-preload,gevent,gevent-sans-preload')
+    parser.add_argument('--workers', type=int, default=1, help='WEB_CONCURRENCY')
+    parser.add_argument('--websockets', type=int, default=200, help='Connexions websocket gardées ouvertes')
+    args = parser.parse_args()
+
+    print(f"{args.workers} worker(s), {args.websockets} websockets demandées")
+    print(f"{'mode':>22}{'démarrage ms':>14}{'RSS Mo':>9}{'websockets':>12}{'threads':>9}{'GET ms':>9}")
+    for mode in args.modes.split(','):
+        r = mesurer(mode, args.workers, args.websockets)
+        print(f"{mode:>22}{r['demarrage_ms']:>14.0f}{r['rss_mo']:>9.0f}{r['websockets']:>12}"
+              f"{r['threads']:>9}{r['get_ms']:>9.1f}")
+
+
+if __name__ == '__main__':
+    main()
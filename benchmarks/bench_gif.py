@@ -0,0 +1,140 @@
+"""
+Benchmark du moteur GIF (moteur_gif) : images par seconde et pic de mémoire (RSS)
+en fonction du nombre de frames et de la résolution du GIF source.
+
+Chaque mesure tourne dans un sous-processus neuf pour que le pic de RSS lui soit propre
+(le RSS des processus du pool et de ffmpeg est compté à part, dans "rss_enfants_mo").
+
+    python benchmarks/bench_gif.py
+    python benchmarks/bench_gif.py --formats webp,mp4 --frames 100,2000 --tailles 320x240
+
+--gevent fait la conversion dans un processus patché par gevent, comme dans un worker web gunicorn, et
+mesure le plus long gel de la boucle d'événements (les autres connexions du worker attendent pendant ce
+temps). Une conversion qui dépasse --delai est un échec (code de sortie 1) : c'est le signe d'un worker bloqué.
+
+    python benchmarks/bench_gif.py --gevent --frames 10,200 --tailles 200x150,480x360 --largeur 100
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+RACINE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def generer_gif(chemin, frames, largeur, hauteur):
+    """GIF synthétique : un disque qui traverse un dégradé, 40 ms par frame."""
+    from PIL import Image, ImageDraw
+
+    def images():
+        for i in range(frames):
+            img = Image.new('RGB', (largeur, hauteur), (i % 256, 80, 160))
+            x = (i * 7) % largeur
+            ImageDraw.Draw(img).ellipse((x, hauteur // 4, x + hauteur // 2, 3 * hauteur // 4), fill=(250, 220, 40))
+            yield img.quantize(64)
+
+    sequence = images()
+    premiere = next(sequence)
+    premiere.save(chemin, 'GIF', save_all=True, append_images=sequence, duration=40, loop=0)
+
+
+def mesurer(chemin_gif, format, largeur, couleurs, dossier, cooperatif=False):
+    """Exécuté dans le sous-processus : une conversion, puis les métriques en JSON sur stdout."""
+    gel = [0.0]
+    if cooperatif:
+        from gevent import monkey
+        monkey.patch_all()
+        import gevent
+
+        def battre():
+            # Réveil attendu toutes les 10 ms : tout retard au-delà est un gel de la boucle
+            while True:
+                avant = time.perf_counter()
+                gevent.sleep(0.01)
+                gel[0] = max(gel[0], time.perf_counter() - avant - 0.01)
+
+        gevent.spawn(battre)
+    os.chdir(dossier)
+    os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(dossier, 'bench.db')}"
+    sys.path.insert(0, RACINE)
+    import app as application
+    from PIL import Image
+
+    with Image.open(chemin_gif) as gif:
+        frames = gif.n_frames
+    if cooperatif:
+        gevent.sleep(0.05) # Référence du battement prise avant la conversion
+
+    sortie = os.path.join(dossier, f"sortie.{application.FORMATS_GIF[format][0]}")
+    pool = application.pool_gif()
+    debut = time.perf_counter()
+    application.moteur_gif(chemin_gif, sortie, format, largeur, couleurs, pool=pool)
+    duree = time.perf_counter() - debut
+    pool.shutdown()
+
+    # ru_maxrss est en kilo-octets sous Linux
+    print(json.dumps({
+        'frames_par_seconde': round(frames / duree, 1),
+        'duree_s': round(duree, 3),
+        'rss_mo': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'rss_enfants_mo': round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1),
+        'taille_sortie_ko': round(os.path.getsize(sortie) / 1024, 1),
+        'gel_max_ms': round(1000 * gel[0], 1),
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--formats', default='webp,apng,mp4,sprite')
+    parser.add_argument('--frames', default='50,500,2000')
+    parser.add_argument('--tailles', default='160x120,480x360')
+    parser.add_argument('--largeur', type=int, help='Option de redimensionnement passée au moteur')
+    parser.add_argument('--couleurs', type=int, help='Option de réduction de palette passée au moteur')
+    parser.add_argument('--gevent', action='store_true', help='Conversion sous gevent, comme dans un worker web')
+    parser.add_argument('--delai', type=float, default=120, help='Secondes au-delà desquelles une conversion échoue')
+    parser.add_argument('--mesurer', nargs=3, metavar=('GIF', 'FORMAT', 'DOSSIER'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.mesurer:
+        mesurer(args.mesurer[0], args.mesurer[1], args.largeur, args.couleurs, args.mesurer[2], args.gevent)
+        return
+
+    echecs = 0
+    print(f"{'format':<8}{'frames':>8}{'taille':>10}{'frames/s':>11}{'RSS Mo':>9}{'RSS pool Mo':>13}"
+          + (f"{'gel max ms':>12}" if args.gevent else ''))
+    with tempfile.TemporaryDirectory() as dossier:
+        for taille in args.tailles.split(','):
+            largeur, hauteur = (int(v) for v in taille.split('x'))
+            for frames in (int(v) for v in args.frames.split(',')):
+                chemin_gif = os.path.join(dossier, f"{frames}_{taille}.gif")
+                generer_gif(chemin_gif, frames, largeur, hauteur)
+
+                for format in args.formats.split(','):
+                    commande = [sys.executable, os.path.abspath(__file__), '--mesurer', chemin_gif, format, dossier]
+                    if args.largeur:
+                        commande += ['--largeur', str(args.largeur)]
+                    if args.couleurs:
+                        commande += ['--couleurs', str(args.couleurs)]
+                    if args.gevent:
+                        commande.append('--gevent')
+                    try:
+                        sortie = subprocess.run(commande, capture_output=True, text=True, check=True,
+                                                timeout=args.delai).stdout
+                    except subprocess.TimeoutExpired:
+                        echecs += 1
+                        print(f"{format:<8}{frames:>8}{taille:>10}  bloqué : pas de résultat après {args.delai:.0f} s")
+                        continue
+                    resultat = json.loads(sortie.strip().splitlines()[-1])
+                    print(f"{format:<8}{frames:>8}{taille:>10}{resultat['frames_par_seconde']:>11}"
+                          f"{resultat['rss_mo']:>9}{resultat['rss_enfants_mo']:>13}"
+                          + (f"{resultat['gel_max_ms']:>12}" if args.gevent else ''))
+    if echecs:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+"""
+Benchmark du rendu de la page d'accueil `/` (utilisateur connecté) : requêtes par seconde
+selon le nombre d'éléments dans les fils (vidéos, images et messages), avec et sans cache de fragments.
+
+L'application est appelée en WSGI dans le processus (client de test Flask) sur une base SQLite
+jetable : on mesure le coût de l'application, pas celui du réseau.
+
+    python benchmarks/bench_index.py
+    python benchmarks/bench_index.py --elements 10,1000,10000 --duree 5
+"""
+import argparse
+import datetime
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+RACINE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def mesurer(elements, duree, cache, dossier):
+    """Exécuté dans un sous-processus (base et caches neufs) : affiche le résultat en JSON."""
+    os.chdir(dossier)
+    os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(dossier, f'index_{elements}_{int(cache)}.db')}"
+    os.environ['FRAGMENT_CACHE_SIZE'] = '512' if cache else '0'
+    os.environ['CONVERSION_WORKERS'] = '0'
+    sys.path.insert(0, RACINE)
+    import app as application
+    application.preparer_instance()
+
+    with application.app.app_context():
+        db = application.db
+        auteur = application.User(email='bench@example.com', username='bench')
+        auteur.set_password('bench')
+        db.session.add(auteur)
+        db.session.commit()
+        auteur_id = auteur.id
+
+        debut = datetime.datetime.utcnow() - datetime.timedelta(days=1)
+        for modele, valeurs in (
+            (application.Video, lambda i: {'title': f"Vidéo {i}", 'status': 'done', 'converted_filename': f"{i:064x}.mp4"}),
+            (application.ConvertedImage, lambda i: {'filename': f"{i:064x}.png", 'format': 'PNG'}),
+            (application.ChatMessage, lambda i: {'text': f"Message numéro {i}"}),
+        ):
+            db.session.execute(modele.__table__.insert(), [
+                {'user_id': auteur_id, 'created_at': debut + datetime.timedelta(seconds=i), **valeurs(i)}
+                for i in range(elements)
+            ])
+        db.session.commit()
+
+    client = application.app.test_client()
+    client.get('/')
+    with client.session_transaction() as s:
+        s['user_id'] = auteur_id
+
+    # Échauffement (compilation, premier remplissage du cache) puis mesure
+    for _ in range(5):
+        assert client.get('/').status_code == 200
+    requetes = 0
+    fin = time.perf_counter() + duree
+    debut_mesure = time.perf_counter()
+    while time.perf_counter() < fin:
+        client.get('/')
+        requetes += 1
+    ecoule = time.perf_counter() - debut_mesure
+
+    print(json.dumps({'requetes_par_seconde': round(requetes / ecoule, 1),
+                      'latence_ms': round(1000 * ecoule / requetes, 2)}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--elements', default='10,1000,10000', help="Nombre d'éléments dans chaque fil")
+    parser.add_argument('--duree', type=float, default=3.0, help='Durée de chaque mesure (secondes)')
+    parser.add_argument('--mesurer', nargs=3, metavar=('ELEMENTS', 'CACHE', 'DOSSIER'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.mesurer:
+        mesurer(int(args.mesurer[0]), args.duree, args.mesurer[1] == '1', args.mesurer[2])
+        return
+
+    print(f"{'éléments':>10}{'cache':>8}{'req/s':>10}{'latence ms':>12}")
+    with tempfile.TemporaryDirectory() as dossier:
+        for elements in (int(v) for v in args.elements.split(',')):
+            for cache in (False, True):
+                commande = [sys.executable, os.path.abspath(__file__), '--duree', str(args.duree),
+                            '--mesurer', str(elements), '1' if cache else '0', dossier]
+                sortie = subprocess.run(commande, capture_output=True, text=True, check=True).stdout
+                resultat = json.loads(sortie.strip().splitlines()[-1])
+                print(f"{elements:>10}{'oui' if cache else 'non':>8}"
+                      f"{resultat['requetes_par_seconde']:>10}{resultat['latence_ms']:>12}")
+
+
+if __name__ == '__main__':
+    main()
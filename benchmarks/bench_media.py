@@ -0,0 +1,155 @@
+"""
+Benchmark de l'envoi des fichiers convertis (`/download/<fichier>`) sur un gros fichier :
+débit et temps CPU consommé par le worker gunicorn selon le mode d'envoi.
+
+    copie      gunicorn --no-sendfile : le worker lit le fichier et l'écrit sur le socket (ancien comportement)
+    sendfile   wsgi.file_wrapper + sendfile() : zéro-copie, le noyau envoie les octets
+    plages     sendfile, requêtes `Range` de 1 Mio à des positions aléatoires (déplacement dans une vidéo)
+    x-accel    MEDIA_SENDFILE_MODE=x-accel : le worker ne produit que les en-têtes, nginx enverrait le fichier
+               (sans nginx devant, on mesure le coût restant côté Python : requêtes/s et CPU par requête)
+
+Nécessite gunicorn (requirements.txt) et Linux (/proc pour le temps CPU du worker).
+
+    python benchmarks/bench_media.py
+    python benchmarks/bench_media.py --taille 1024 --duree 10 --clients 8
+"""
+import argparse
+import hashlib
+import http.client
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+RACINE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TICKS = os.sysconf('SC_CLK_TCK')
+PLAGE = 1024 * 1024
+
+
+def creer_fichier(dossier, taille_mo):
+    """Écrit un blob aléatoire là où l'application le cherche (converted/blobs/dd/<empreinte>)."""
+    empreinte = hashlib.sha256()
+    temporaire = os.path.join(dossier, 'fichier.tmp')
+    with open(temporaire, 'wb') as f:
+        for _ in range(taille_mo):
+            bloc = os.urandom(1024 * 1024)
+            empreinte.update(bloc)
+            f.write(bloc)
+    digest = empreinte.hexdigest()
+    destination = os.path.join(dossier, 'converted', 'blobs', digest[:2])
+    os.makedirs(destination, exist_ok=True)
+    os.replace(temporaire, os.path.join(destination, digest))
+    return f"{digest}.mp4", taille_mo * 1024 * 1024
+
+
+def port_libre():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def cpu_workers(pid_maitre):
+    """Temps CPU (secondes) cumulé des workers gunicorn, lu dans /proc."""
+    total = 0
+    with open(f"/proc/{pid_maitre}/task/{pid_maitre}/children") as f:
+        enfants = f.read().split()
+    for pid in enfants:
+        with open(f"/proc/{pid}/stat") as f:
+            champs = f.read().rsplit(')', 1)[1].split()
+        total += int(champs[11]) + int(champs[12]) # utime + stime
+    return total / TICKS
+
+
+def demarrer_serveur(dossier, mode, port):
+    env = dict(os.environ,
+               PYTHONPATH=RACINE,
+               DATABASE_URL=f"sqlite:///{os.path.join(dossier, 'media.db')}",
+               CONVERSION_WORKERS='0',
+               MEDIA_SENDFILE_MODE='x-accel' if mode == 'x-accel' else '')
+    commande = [sys.executable, '-m', 'gunicorn', '-w', '1', '-b', f"127.0.0.1:{port}", '--log-level', 'warning']
+    if mode == 'copie':
+        commande.append('--no-sendfile')
+    serveur = subprocess.Popen(commande + ['app:create_app()'], cwd=dossier, env=env, stdout=subprocess.DEVNULL)
+    for _ in range(200):
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.1).close()
+            time.sleep(0.5) # Le worker est forké après l'ouverture du socket
+            return serveur
+        except OSError:
+            time.sleep(0.05)
+    serveur.kill()
+    raise RuntimeError("gunicorn n'a pas démarré")
+
+
+def client(port, chemin, taille, mode, fin, compteurs):
+    octets = requetes = 0
+    while time.perf_counter() < fin:
+        connexion = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+        entetes = {}
+        if mode == 'plages':
+            debut = random.randrange(0, taille - PLAGE)
+            entetes['Range'] = f"bytes={debut}-{debut + PLAGE - 1}"
+        connexion.request('GET', chemin, headers=entetes)
+        reponse = connexion.getresponse()
+        while True:
+            bloc = reponse.read(1024 * 1024)
+            if not bloc:
+                break
+            octets += len(bloc)
+        assert reponse.status in (200, 206), reponse.status
+        connexion.close()
+        requetes += 1
+    with compteurs['lock']:
+        compteurs['octets'] += octets
+        compteurs['requetes'] += requetes
+
+
+def mesurer(dossier, nom, taille, mode, duree, clients):
+    port = port_libre()
+    serveur = demarrer_serveur(dossier, mode, port)
+    try:
+        compteurs = {'octets': 0, 'requetes': 0, 'lock': threading.Lock()}
+        cpu_debut = cpu_workers(serveur.pid)
+        debut = time.perf_counter()
+        threads = [threading.Thread(target=client, args=(port, f"/download/{nom}", taille, mode,
+                                                         debut + duree, compteurs)) for _ in range(clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        ecoule = time.perf_counter() - debut
+        cpu = cpu_workers(serveur.pid) - cpu_debut
+    finally:
+        serveur.terminate()
+        serveur.wait()
+    return {
+        'mo_par_seconde': compteurs['octets'] / ecoule / 1024 / 1024,
+        'requetes_par_seconde': compteurs['requetes'] / ecoule,
+        'cpu_worker_pct': 100 * cpu / ecoule,
+        'cpu_ms_par_requete': 1000 * cpu / max(compteurs['requetes'], 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--taille', type=int, default=256, help='Taille du fichier servi (Mio)')
+    parser.add_argument('--duree', type=float, default=5.0, help='Durée de chaque mesure (secondes)')
+    parser.add_argument('--clients', type=int, default=4, help='Connexions simultanées')
+    parser.add_argument('--modes', default='copie,sendfile,plages,x-accel')
+    args = parser.parse_args()
+
+    print(f"{'mode':>10}{'Mio/s':>10}{'req/s':>10}{'CPU worker %':>14}{'CPU ms/req':>12}")
+    with tempfile.TemporaryDirectory() as dossier:
+        nom, taille = creer_fichier(dossier, args.taille)
+        for mode in args.modes.split(','):
+            r = mesurer(dossier, nom, taille, mode, args.duree, args.clients)
+            print(f"{mode:>10}{r['mo_par_seconde']:>10.0f}{r['requetes_par_seconde']:>10.1f}"
+                  f"{r['cpu_worker_pct']:>14.1f}{r['cpu_ms_par_requete']:>12.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+"""
+Benchmark de l'encodage vidéo parallèle par morceaux (encoder_video) : temps réel et accélération
+par rapport à l'encodage en une passe, selon le nombre de processus ffmpeg simultanés (ENCODE_WORKERS).
+
+Les vidéos de test sont synthétiques, générées par les sources lavfi de ffmpeg (testsrc2 + sine),
+avec une image clé toutes les 2 secondes comme la plupart des sources réelles.
+`--jobs 2` lance deux conversions en même temps pour vérifier le partage équitable des processus.
+
+    python benchmarks/bench_segments.py
+    python benchmarks/bench_segments.py --duree 600 --taille 1280x720 --workers 1,2,4,8 --jobs 2
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+RACINE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def generer_video(chemin, duree, taille):
+    subprocess.run([
+        'ffmpeg', '-y', '-nostdin', '-loglevel', 'error',
+        '-f', 'lavfi', '-i', f"testsrc2=size={taille}:rate=30:duration={duree}",
+        '-f', 'lavfi', '-i', f"sine=frequency=440:duration={duree}",
+        '-c:v', 'mpeg4', '-q:v', '3', '-g', '60', '-c:a', 'mp3', chemin,
+    ], check=True)
+
+
+def mesurer(source, workers, jobs, hls, dossier):
+    """Exécuté dans un sous-processus (pool et configuration neufs) : affiche le résultat en JSON."""
+    os.chdir(dossier)
+    os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(dossier, 'segments.db')}"
+    os.environ['CONVERSION_WORKERS'] = '0'
+    os.environ['ENCODE_WORKERS'] = str(max(workers, 1))
+    if not hls:
+        os.environ['HLS_RENDITIONS'] = ''
+    sys.path.insert(0, RACINE)
+    import app as application
+
+    def convertir(n, durees):
+        sortie = os.path.join(dossier, f"sortie_{workers}_{n}.mp4")
+        dossier_hls = tempfile.mkdtemp(dir=dossier) if hls else None
+        debut = time.perf_counter()
+        with application.app.app_context():
+            application.encoder_video(source, sortie, dossier_hls, parallele=workers > 0)
+        durees[n] = time.perf_counter() - debut
+
+    durees = [None] * jobs
+    debut = time.perf_counter()
+    threads = [threading.Thread(target=convertir, args=(n, durees)) for n in range(jobs)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    print(json.dumps({'total_s': time.perf_counter() - debut, 'par_job_s': durees}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--duree', type=int, default=240, help='Durée de la vidéo de test (secondes)')
+    parser.add_argument('--taille', default='1280x720')
+    coeurs = os.cpu_count() or 1
+    parser.add_argument('--workers', default=','.join(str(w) for w in sorted({1, 2, 4, coeurs}) if w <= coeurs),
+                        help='Valeurs de ENCODE_WORKERS à mesurer')
+    parser.add_argument('--jobs', type=int, default=1, help='Conversions simultanées')
+    parser.add_argument('--sans-hls', action='store_true', help='MP4 seul (HLS_RENDITIONS vide)')
+    parser.add_argument('--mesurer', nargs=3, metavar=('SOURCE', 'WORKERS', 'DOSSIER'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.mesurer:
+        mesurer(args.mesurer[0], int(args.mesurer[1]), args.jobs, not args.sans_hls, args.mesurer[2])
+        return
+
+    print(f"{coeurs} cœurs, vidéo {args.taille} de {args.duree} s, {args.jobs} job(s) simultané(s)")
+    print(f"{'mode':>14}{'temps s':>10}{'accélération':>14}{'par job s':>20}")
+    with tempfile.TemporaryDirectory() as dossier:
+        source = os.path.join(dossier, 'source.avi')
+        generer_video(source, args.duree, args.taille)
+        reference = None
+        # 0 = encodage en une passe (un seul ffmpeg par vidéo), la référence
+        for workers in [0] + [int(w) for w in args.workers.split(',')]:
+            commande = [sys.executable, os.path.abspath(__file__), '--jobs', str(args.jobs),
+                        '--mesurer', source, str(workers), dossier]
+            if args.sans_hls:
+                commande.append('--sans-hls')
+            sortie = subprocess.run(commande, capture_output=True, text=True, check=True).stdout
+            resultat = json.loads(sortie.strip().splitlines()[-1])
+            reference = reference or resultat['total_s']
+            mode = 'une passe' if workers == 0 else f"{workers} workers"
+            par_job = ' / '.join(f"{d:.1f}" for d in resultat['par_job_s'])
+            print(f"{mode:>14}{resultat['total_s']:>10.1f}{reference / resultat['total_s']:>13.2f}x{par_job:>20}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,166 @@
+"""
+Test de charge du chat : latence de livraison d'un message à N amis dont les sockets sont
+répartis sur W workers (processus serveur distincts partageant la file de messages Socket.IO).
+
+Plusieurs workers nécessitent une file de messages commune (Redis local par exemple) ;
+sans --message-queue, seul le cas à un worker est mesurable (registre de présence en mémoire).
+
+    python benchmarks/bench_socket_fanout.py --workers 1
+    python benchmarks/bench_socket_fanout.py --message-queue redis://localhost:6379/15 --workers 1,2,4 --amis 50
+
+Dépendances du client de test : requests, python-socketio[client], websocket-client.
+"""
+import argparse
+import json
+import os
+import re
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+import socketio
+
+RACINE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PORT_BASE = 5300
+
+
+def serveur(port, dossier):
+    """Exécuté dans un sous-processus : un worker de l'application sur `port`."""
+    os.chdir(dossier)
+    sys.path.insert(0, RACINE)
+    import app as application
+    application.socketio.run(application.create_app(), host='127.0.0.1', port=port, allow_unsafe_werkzeug=True)
+
+
+def attendre_port(port, delai=30):
+    fin = time.time() + delai
+    while time.time() < fin:
+        with socket.socket() as s:
+            if s.connect_ex(('127.0.0.1', port)) == 0:
+                return
+        time.sleep(0.1)
+    raise RuntimeError(f"Le worker du port {port} n'a pas démarré.")
+
+
+def connecter(url, username, inscrire=True):
+    """Inscrit (ou connecte) l'utilisateur par HTTP et retourne la session requests."""
+    http = requests.Session()
+    csrf = re.search(r'data-csrf="([^"]+)"', http.get(url + '/').text).group(1)
+    donnees = {'csrf_token': csrf, 'username': username, 'password': 'bench'}
+    if inscrire:
+        http.post(url + '/register', data={**donnees, 'email': f"{username}@bench.local"})
+    else:
+        http.post(url + '/login', data=donnees)
+    http.csrf = csrf
+    return http
+
+
+def client_socket(url, http):
+    client = socketio.Client(reconnection=False)
+    cookie = '; '.join(f"{k}={v}" for k, v in http.cookies.items())
+    client.connect(url, headers={'Cookie': cookie}, transports=['websocket'])
+    return client
+
+
+def mesurer(workers, amis, messages, intervalle, message_queue):
+    with tempfile.TemporaryDirectory() as dossier:
+        env = dict(os.environ,
+                   DATABASE_URL=f"sqlite:///{os.path.join(dossier, 'chat.db')}",
+                   CONVERSION_WORKERS='0',
+                   SECRET_KEY='bench-socket')
+        if message_queue:
+            env['SOCKETIO_MESSAGE_QUEUE'] = message_queue
+
+        processus = []
+        try:
+            # Le premier worker crée les tables avant que les autres ne démarrent
+            for i in range(workers):
+                port = PORT_BASE + i
+                processus.append(subprocess.Popen(
+                    [sys.executable, os.path.abspath(__file__), '--serveur', str(port), dossier],
+                    env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+                attendre_port(port)
+            urls = [f"http://127.0.0.1:{PORT_BASE + i}" for i in range(workers)]
+
+            expediteur = connecter(urls[0], 'expediteur')
+            latences, lock = [], threading.Lock()
+            recus = threading.Semaphore(0)
+            clients = []
+            for i in range(amis):
+                nom = f"ami{i}"
+                connecter(urls[0], nom)
+                expediteur.post(urls[0] + '/add_friend', data={'csrf_token': expediteur.csrf, 'friend_username': nom})
+
+            for i in range(amis):
+                url = urls[i % workers] # Amis répartis sur tous les workers
+                client = client_socket(url, connecter(url, f"ami{i}", inscrire=False))
+
+                @client.on('chat_batch')
+                def reception(lot):
+                    maintenant = time.time()
+                    for data in lot['messages']:
+                        envoye = json.loads(data['text'])['t']
+                        with lock:
+                            latences.append(maintenant - envoye)
+                        recus.release()
+
+                clients.append(client)
+
+            emetteur = client_socket(urls[0], expediteur)
+            time.sleep(0.5)
+            for i in range(messages):
+                emetteur.emit('new_message', {'text': json.dumps({'i': i, 't': time.time()})})
+                time.sleep(intervalle)
+
+            attendus = messages * amis
+            fin = time.time() + 30
+            for _ in range(attendus):
+                if not recus.acquire(timeout=max(fin - time.time(), 0)):
+                    break
+
+            for client in clients + [emetteur]:
+                client.disconnect()
+        finally:
+            for p in processus:
+                p.terminate()
+                p.wait()
+
+    latences.sort()
+    return {
+        'livres': len(latences),
+        'attendus': attendus,
+        'p50_ms': round(1000 * statistics.median(latences), 2) if latences else None,
+        'p99_ms': round(1000 * latences[int(len(latences) * 0.99) - 1], 2) if latences else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', default='1', help='Nombres de workers à mesurer (ex: 1,2,4)')
+    parser.add_argument('--amis', type=int, default=20)
+    parser.add_argument('--messages', type=int, default=50)
+    parser.add_argument('--intervalle', type=float, default=0.02, help='Pause entre deux messages (secondes)')
+    parser.add_argument('--message-queue', help='URL de la file de messages partagée (ex: redis://localhost:6379/15)')
+    parser.add_argument('--serveur', nargs=2, metavar=('PORT', 'DOSSIER'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serveur:
+        serveur(int(args.serveur[0]), args.serveur[1])
+        return
+
+    print(f"{'workers':>8}{'livrés':>14}{'p50 ms':>10}{'p99 ms':>10}")
+    for workers in (int(v) for v in args.workers.split(',')):
+        if workers > 1 and not args.message_queue:
+            print(f"{workers:>8}  ignoré : --message-queue est nécessaire au-delà d'un worker")
+            continue
+        r = mesurer(workers, args.amis, args.messages, args.intervalle, args.message_queue)
+        print(f"{workers:>8}{r['livres']:>8}/{r['attendus']:<5}{r['p50_ms']:>10}{r['p99_ms']:>10}")
+
+
+if __name__ == '__main__':
+    main()
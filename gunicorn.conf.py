@@ -0,0 +1,54 @@
+"""
+Configuration gunicorn de production, lue automatiquement depuis le dossier de l'application :
+
+    gunicorn 'app:create_app()'
+
+GUNICORN_WORKER_CLASS   gevent (défaut s'il est installé) ou gthread. Avec gevent, chaque connexion Socket.IO est une
+                        green thread : des milliers de websockets par worker. En gthread, chaque websocket occupe
+                        un des GUNICORN_THREADS threads du worker.
+WEB_CONCURRENCY         Nombre de workers (1 par défaut). Au-delà, SOCKETIO_MESSAGE_QUEUE est nécessaire, ainsi
+                        qu'un équilibreur à sessions collantes si les clients peuvent se replier sur le long-polling.
+GUNICORN_PRELOAD        1 (défaut) : l'application est importée une fois dans le maître, puis les workers sont forkés
+                        (démarrage plus rapide, mémoire partagée). 0 : chaque worker l'importe lui-même.
+"""
+import importlib.util
+import os
+import subprocess
+import sys
+import time
+
+_lancement = time.time()
+
+
+def _installe(module):
+    return importlib.util.find_spec(module) is not None
+
+
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS') or ('gevent' if _installe('gevent') else 'gthread')
+workers = int(os.environ.get('WEB_CONCURRENCY', 1))
+threads = int(os.environ.get('GUNICORN_THREADS', 100))
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', 1000))
+preload_app = os.environ.get('GUNICORN_PRELOAD', '1') == '1'
+
+if preload_app and worker_class == 'gevent':
+    # L'application est importée dans le maître : la bibliothèque standard doit être patchée avant, sinon
+    # les verrous, sockets et threads créés à l'import resteraient bloquants dans les workers
+    from gevent import monkey
+    monkey.patch_all()
+
+
+def on_starting(server):
+    """Maître, avant tout fork : dossiers et schéma une seule fois pour tous les workers."""
+    if preload_app:
+        return # create_app() vient de s'exécuter dans le maître, au chargement de l'application
+    debut = time.perf_counter()
+    # Dans un processus séparé : le maître ne doit pas importer l'application (les workers le font après leur patch)
+    subprocess.run([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app.py'), 'init'],
+                   check=True)
+    os.environ['APP_INSTANCE_READY'] = '1' # Hérité par les workers : create_app() ne refait rien
+    server.log.info("Instance préparée en %.0f ms", 1000 * (time.perf_counter() - debut))
+
+
+def post_worker_init(worker):
+    worker.log.info("Worker %s (%s) prêt %.0f ms après le lancement de gunicorn",
+                    worker.pid, worker_class, 1000 * (time.time() - _lancement))
@@ -0,0 +1,381 @@
+var socket = io();
+// Données de la page (voir les attributs data-* de <body>)
+var user_username = document.body.dataset.user;
+
+// --- Réception de messages ---
+function creerMessage(data) {
+    var div = document.createElement('div');
+    div.className = 'message';
+    var pseudo = document.createElement('span');
+    if (data.user === 'Système') {
+        pseudo.style.cssText = 'font-weight: 700; color: #FF0000;';
+        pseudo.textContent = '[' + data.user + ']';
+    } else {
+        pseudo.className = 'user-pseudo';
+        pseudo.textContent = '@' + data.user;
+    }
+    div.appendChild(pseudo);
+    div.appendChild(document.createTextNode(': ' + data.text));
+    return div;
+}
+
+function afficherMessages(messages) {
+    var messagesDiv = document.getElementById('messages');
+    // On ne suit le bas du chat que si l'utilisateur y était déjà (pas pendant la lecture de l'historique)
+    var enBas = messagesDiv.scrollHeight - messagesDiv.scrollTop - messagesDiv.clientHeight < 30;
+    messages.forEach(function(data) {
+        messagesDiv.appendChild(creerMessage(data));
+    });
+    if (enBas) {
+        messagesDiv.scrollTop = messagesDiv.scrollHeight;
+    }
+}
+
+socket.on('broadcast_message', function(data) {
+    afficherMessages([data]);
+});
+
+// Messages regroupés par le serveur (un lot par conversation et par fenêtre de quelques dizaines de ms)
+socket.on('chat_batch', function(lot) {
+    afficherMessages(lot.messages);
+});
+
+// Ce client ne suivait plus (file d'envoi pleine côté serveur) : des messages ont pu être perdus, on repart de l'historique
+socket.on('chat_resync', function() {
+    rechargerChat();
+});
+
+// Déconnexion depuis un autre onglet ou appareil : la session n'existe plus, la page repart en visiteur
+socket.on('session_fermee', function() {
+    window.location.reload();
+});
+
+socket.on('disconnect', function(raison) {
+    // Fermé par le serveur (déconnexion) : Socket.IO ne se reconnecte pas seul dans ce cas
+    if (raison === 'io server disconnect') {
+        window.location.reload();
+    }
+});
+
+// --- Historique du chat : chargé page par page en remontant (pagination par curseur) ---
+var chargementHistorique = null;
+
+function boutonHistorique(curseur) {
+    var bouton = document.createElement('button');
+    bouton.type = 'button';
+    bouton.className = 'chat-plus-anciens';
+    bouton.dataset.cursor = curseur;
+    bouton.textContent = 'Messages plus anciens';
+    return bouton;
+}
+
+async function pageChat(curseur) {
+    var url = '/api/feed/messages?limit=30' + (curseur ? '&cursor=' + encodeURIComponent(curseur) : '');
+    var reponse = await fetch(url, {credentials: 'same-origin'});
+    if (!reponse.ok) {
+        throw new Error('Historique indisponible (' + reponse.status + ')');
+    }
+    return reponse.json();
+}
+
+function chargerPlusAnciens() {
+    var messagesDiv = document.getElementById('messages');
+    var bouton = messagesDiv && messagesDiv.querySelector('.chat-plus-anciens');
+    if (!bouton || chargementHistorique) {
+        return;
+    }
+    chargementHistorique = pageChat(bouton.dataset.cursor).then(function(page) {
+        var hauteur = messagesDiv.scrollHeight;
+        var fragment = document.createDocumentFragment();
+        if (page.next_cursor) {
+            fragment.appendChild(boutonHistorique(page.next_cursor));
+        }
+        page.items.slice().reverse().forEach(function(data) { // Du plus récent au plus ancien dans l'API
+            fragment.appendChild(creerMessage(data));
+        });
+        bouton.replaceWith(fragment);
+        messagesDiv.scrollTop += messagesDiv.scrollHeight - hauteur; // Garde la position de lecture
+    }).catch(function(e) {
+        console.error(e);
+    }).finally(function() {
+        chargementHistorique = null;
+    });
+}
+
+function rechargerChat() {
+    pageChat(null).then(function(page) {
+        var messagesDiv = document.getElementById('messages');
+        messagesDiv.replaceChildren();
+        if (page.next_cursor) {
+            messagesDiv.appendChild(boutonHistorique(page.next_cursor));
+        }
+        page.items.slice().reverse().forEach(function(data) {
+            messagesDiv.appendChild(creerMessage(data));
+        });
+        messagesDiv.scrollTop = messagesDiv.scrollHeight;
+    }).catch(function(e) {
+        console.error(e);
+    });
+}
+
+(function() {
+    var messagesDiv = document.getElementById('messages');
+    if (!messagesDiv) {
+        return;
+    }
+    messagesDiv.addEventListener('click', function(e) {
+        if (e.target.classList.contains('chat-plus-anciens')) {
+            chargerPlusAnciens();
+        }
+    });
+    messagesDiv.addEventListener('scroll', function() {
+        if (messagesDiv.scrollTop < 20) {
+            chargerPlusAnciens();
+        }
+    });
+})();
+
+// --- Progression des conversions en arrière-plan ---
+socket.on('job_progress', function(data) {
+    var status = document.getElementById('job-status-' + data.job_id);
+    if (status) {
+        status.textContent = data.status === 'running' ? data.label + ' (' + data.progress + '%)' : data.label;
+    }
+    var download = document.getElementById('job-download-' + data.job_id);
+    if (download && data.status === 'done' && data.converted_filename) {
+        download.innerHTML = '<a href="/download/' + encodeURIComponent(data.converted_filename) + '" download>Télécharger</a>';
+        var miniature = document.getElementById('job-thumb-' + data.job_id);
+        if (miniature && data.hls) {
+            var video = document.createElement('video');
+            video.className = 'lecteur-hls';
+            video.controls = true;
+            video.preload = 'none';
+            video.playsInline = true;
+            video.poster = '/thumbnails/' + encodeURIComponent(data.converted_filename) + '/l';
+            video.dataset.hls = '/hls/' + data.converted_filename.split('.')[0] + '/master.m3u8';
+            video.dataset.mp4 = '/converted_images/' + encodeURIComponent(data.converted_filename);
+            miniature.replaceWith(video);
+            preparerLecteur(video);
+        } else if (miniature) {
+            miniature.src = '/thumbnails/' + encodeURIComponent(data.converted_filename) + '/m';
+        }
+    }
+});
+
+// --- Lecteur vidéo : streaming adaptatif HLS, la lecture démarre dès le premier segment reçu ---
+function preparerLecteur(video) {
+    if (video.canPlayType('application/vnd.apple.mpegurl')) {
+        video.src = video.dataset.hls; // Safari / iOS : HLS natif (preload="none" : rien n'est téléchargé avant lecture)
+    } else if (window.Hls && Hls.isSupported()) {
+        // Le débit s'adapte à la connexion ; le chargement ne commence qu'au clic sur lecture
+        var hls = new Hls({autoStartLoad: false, capLevelToPlayerSize: true});
+        hls.loadSource(video.dataset.hls);
+        hls.attachMedia(video);
+        video.addEventListener('play', function() { hls.startLoad(); }, {once: true});
+    } else {
+        video.src = video.dataset.mp4; // Repli : MP4 progressif (faststart, plages d'octets)
+    }
+}
+
+document.querySelectorAll('video.lecteur-hls').forEach(preparerLecteur);
+
+// --- Upload par morceaux (reprenable après une coupure réseau) ---
+var csrf_token = document.body.dataset.csrf;
+
+function attendre(ms) {
+    return new Promise(function(resolve) { setTimeout(resolve, ms); });
+}
+
+async function checksumMorceau(morceau) {
+    if (!(window.crypto && crypto.subtle)) {
+        return null; // Contexte non sécurisé (http) : pas de WebCrypto, pas de checksum
+    }
+    var empreinte = new Uint8Array(await crypto.subtle.digest('SHA-256', await morceau.arrayBuffer()));
+    var binaire = '';
+    for (var i = 0; i < empreinte.length; i++) {
+        binaire += String.fromCharCode(empreinte[i]);
+    }
+    return 'sha256 ' + btoa(binaire);
+}
+
+async function lireOffset(url) {
+    var reponse = await fetch(url, {method: 'HEAD', headers: {'X-CSRF-Token': csrf_token}});
+    return reponse.ok ? parseInt(reponse.headers.get('Upload-Offset'), 10) : null;
+}
+
+async function lireTailleMorceaux(url, defaut) {
+    // Reprise : le serveur impose la taille des morceaux (le stockage S3 refuse les parties trop petites)
+    var reponse = await fetch(url, {method: 'HEAD', headers: {'X-CSRF-Token': csrf_token}});
+    return parseInt(reponse.headers.get('Upload-Chunk-Size'), 10) || defaut;
+}
+
+async function uploadParMorceaux(file, kind, title, options, afficher) {
+    // La session d'upload est mémorisée pour reprendre le même fichier après un rechargement
+    var cle = 'upload:' + kind + ':' + file.name + ':' + file.size + ':' + file.lastModified;
+    var url = localStorage.getItem(cle);
+    var offset = url ? await lireOffset(url) : null;
+    var chunkSize = offset === null ? 4 * 1024 * 1024 : await lireTailleMorceaux(url, 4 * 1024 * 1024);
+
+    if (offset === null) {
+        var creation = await fetch('/uploads', {
+            method: 'POST',
+            headers: {'Content-Type': 'application/json', 'X-CSRF-Token': csrf_token},
+            body: JSON.stringify({filename: file.name, size: file.size, kind: kind, title: title, options: options})
+        });
+        var info = await creation.json();
+        if (!creation.ok) {
+            throw new Error(info.error);
+        }
+        url = creation.headers.get('Location');
+        offset = info.offset;
+        chunkSize = info.chunk_size;
+        localStorage.setItem(cle, url);
+    }
+
+    var essais = 0;
+    while (offset < file.size) {
+        var morceau = file.slice(offset, offset + chunkSize);
+        var headers = {
+            'X-CSRF-Token': csrf_token,
+            'Upload-Offset': String(offset),
+            'Content-Type': 'application/offset+octet-stream'
+        };
+        var checksum = await checksumMorceau(morceau);
+        if (checksum) {
+            headers['Upload-Checksum'] = checksum;
+        }
+        try {
+            var reponse = await fetch(url, {method: 'PATCH', headers: headers, body: morceau});
+            if (reponse.status === 415) {
+                // Fichier refusé dès le premier morceau (type non reconnu) : inutile de réessayer
+                localStorage.removeItem(cle);
+                var refus = new Error((await reponse.json()).error);
+                refus.definitif = true;
+                throw refus;
+            }
+            if (reponse.status !== 204 && reponse.status !== 409) {
+                throw new Error('HTTP ' + reponse.status);
+            }
+            offset = parseInt(reponse.headers.get('Upload-Offset'), 10);
+            essais = 0;
+        } catch (erreur) {
+            if (erreur.definitif || ++essais > 5) {
+                throw erreur;
+            }
+            await attendre(1000 * essais);
+            offset = (await lireOffset(url)) ?? offset;
+        }
+        afficher('Envoi : ' + Math.floor(100 * offset / file.size) + '%');
+    }
+
+    var fin = await fetch(url + '/finalize', {method: 'POST', headers: {'X-CSRF-Token': csrf_token}});
+    localStorage.removeItem(cle);
+    var resultat = await fin.json();
+    if (!fin.ok) {
+        throw new Error(resultat.error);
+    }
+    return resultat;
+}
+
+['upload-form', 'gif-form'].forEach(function(id) {
+    var form = document.getElementById(id);
+    if (!form || !window.fetch) {
+        return; // Sans fetch, le formulaire classique reste utilisé
+    }
+    form.addEventListener('submit', async function(e) {
+        e.preventDefault();
+        var file = form.querySelector('input[type=file]').files[0];
+        var titre = form.querySelector('input[name=title]');
+        var statut = form.querySelector('.upload-progress');
+        var afficher = function(texte) { statut.textContent = texte; };
+        // Options de conversion (format, largeur...) : tous les champs gif_*
+        var options = {};
+        form.querySelectorAll('[name^=gif_]:not([type=file])').forEach(function(champ) {
+            options[champ.name] = champ.value;
+        });
+        form.querySelector('button').disabled = true;
+        try {
+            await uploadParMorceaux(file, form.dataset.kind, titre ? titre.value : null, options, afficher);
+            window.location.reload();
+        } catch (erreur) {
+            afficher("Échec de l'envoi : " + erreur.message);
+            form.querySelector('button').disabled = false;
+        }
+    });
+});
+
+// --- Conversion d'images par lots : un seul envoi, progression par fichier, zip téléchargé à la fin ---
+var progressionLots = {};
+
+socket.on('batch_progress', function(data) {
+    var suivi = progressionLots[data.batch_id];
+    if (suivi) {
+        suivi.termines += 1;
+        suivi.afficher(suivi.termines + ' / ' + data.total + ' : ' + data.filename + (data.error ? ' (échec)' : ''));
+    }
+});
+
+(function() {
+    var form = document.getElementById('batch-form');
+    if (!form || !window.fetch) {
+        return;
+    }
+    form.addEventListener('submit', async function(e) {
+        e.preventDefault();
+        var statut = form.querySelector('.upload-progress');
+        var afficher = function(texte) { statut.textContent = texte; };
+        var donnees = new FormData(form);
+        var batchId = Date.now().toString(36) + Math.random().toString(36).slice(2);
+        donnees.append('batch_id', batchId);
+        progressionLots[batchId] = {termines: 0, afficher: afficher};
+        form.querySelector('button').disabled = true;
+        afficher('Envoi...');
+        try {
+            var reponse = await fetch(form.action, {method: 'POST', headers: {'X-CSRF-Token': csrf_token}, body: donnees});
+            if (!reponse.ok) {
+                throw new Error((await reponse.json()).error);
+            }
+            var archive = await reponse.blob();
+            var lien = document.createElement('a');
+            lien.href = URL.createObjectURL(archive);
+            lien.download = 'images.zip';
+            lien.click();
+            setTimeout(function() { URL.revokeObjectURL(lien.href); }, 1000);
+            afficher('Terminé : ' + reponse.headers.get('X-Batch-Files') + ' fichier(s).');
+        } catch (erreur) {
+            afficher('Échec de la conversion : ' + erreur.message);
+        } finally {
+            delete progressionLots[batchId];
+            form.querySelector('button').disabled = false;
+        }
+    });
+})();
+
+// --- Envoi de messages ---
+function sendMessage() {
+    var input = document.getElementById('message_input');
+    var content = input.value;
+
+    if (content && user_username) {
+        socket.emit('new_message', {
+            user: user_username,
+            text: content
+        });
+        input.value = '';
+    }
+}
+
+// Envoyer avec la touche Entrée
+document.getElementById('message_input').addEventListener('keypress', function(e) {
+    if (e.key === 'Enter') {
+        sendMessage();
+    }
+});
+
+// Scroll au bas au chargement
+document.addEventListener('DOMContentLoaded', (event) => {
+    var messagesDiv = document.getElementById('messages');
+    if (messagesDiv) {
+        messagesDiv.scrollTop = messagesDiv.scrollHeight;
+    }
+});